@@ -0,0 +1,122 @@
+# Benchmark: CSV export and statistics over a synthetic query result, read
+# through the RowIterator path (write_csv) and as Arrow record batches
+# (write_csv_arrow).
+#
+# Runs offline; requires the packages in src/email_csv/requirements.txt.
+#
+#   python benchmarks/arrow_read_benchmark.py --rows 1000000
+import argparse
+import io
+import os
+import random
+import sys
+import time
+
+import pyarrow as pa
+from google.cloud.bigquery import SchemaField
+from google.cloud.bigquery.table import Row
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "email_csv"))
+import main
+from report_queries import EXPORT_COLUMNS
+
+# BigQuery types of the exported columns
+COLUMN_TYPES = {
+    "TestStartTime": "DATETIME", "ClientLat": "FLOAT", "ClientLon": "FLOAT",
+    "DownloadValue": "FLOAT", "UploadValue": "FLOAT", "Ping": "FLOAT",
+    "ServerLatency": "FLOAT", "IspDownloadAvg": "INTEGER", "IspUploadAvg": "INTEGER",
+}
+
+
+class DiscardFile(io.RawIOBase):
+    """Binary sink that counts and drops everything written to it."""
+
+    def __init__(self):
+        self.bytes_written = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        return len(data)
+
+
+class FakeRowIterator:
+    """Stands in for bigquery.table.RowIterator over pre-generated batches."""
+
+    def __init__(self, batches):
+        self.batches = batches
+        self.schema = [SchemaField(name, COLUMN_TYPES.get(name, "STRING")) for name in EXPORT_COLUMNS]
+
+    @property
+    def pages(self):
+        # RowIterator builds Row objects as it parses each page, so the
+        # conversion is part of the timed path
+        field_to_index = {name: i for i, name in enumerate(EXPORT_COLUMNS)}
+        for batch in self.batches:
+            columns = [batch.column(i).to_pylist() for i in range(batch.num_columns)]
+            yield [Row(values, field_to_index) for values in zip(*columns)]
+
+    def to_arrow_iterable(self, bqstorage_client=None):
+        return iter(self.batches)
+
+
+def generate_batches(num_rows, batch_size):
+    """Generates synthetic Multistream export rows as Arrow record batches."""
+    rng = random.Random(0)
+    isps = ["Comcast", "Spectrum", "Frontier", "Ziply", "Starlink"]
+    batches = []
+    for start in range(0, num_rows, batch_size):
+        size = min(batch_size, num_rows - start)
+        columns = {
+            "TestStartTime": pa.array([1675209600000000 + i * 60000000 for i in range(start, start + size)], pa.timestamp("us")),
+            "ClientIP": ["10.0.{}.{}".format(i % 256, i % 254 + 1) for i in range(size)],
+            "ClientLat": [rng.uniform(42.0, 46.0) for _ in range(size)],
+            "ClientLon": [rng.uniform(-124.0, -117.0) for _ in range(size)],
+            "DownloadValue": [rng.uniform(1e6, 5e8) if rng.random() > 0.01 else None for _ in range(size)],
+            "DownloadUnit": ["bit/s"] * size,
+            "UploadValue": [rng.uniform(1e5, 5e7) if rng.random() > 0.01 else None for _ in range(size)],
+            "UploadUnit": ["bit/s"] * size,
+            "Ping": [rng.uniform(5, 200) for _ in range(size)],
+            "PingUnit": ["ms"] * size,
+            "ServerLatency": [rng.uniform(5, 200) for _ in range(size)],
+            "ServerLatencyUnit": ["ms"] * size,
+            "Isp": [rng.choice(isps) for _ in range(size)],
+            "IspDownloadAvg": [rng.randint(1000, 500000) for _ in range(size)],
+            "IspUploadAvg": [rng.randint(100, 50000) for _ in range(size)],
+        }
+        batches.append(pa.RecordBatch.from_pydict({name: columns[name] for name in EXPORT_COLUMNS}))
+    return batches
+
+
+def run(name, num_rows, export):
+    start = time.perf_counter()
+    stats, bytes_written = export()
+    elapsed = time.perf_counter() - start
+    print("{:<10} {:>10,} rows  {:>8.2f} s  {:>12,.0f} rows/s  {:>12,} bytes  avg download {:.3f}".format(
+        name, num_rows, elapsed, num_rows / elapsed, bytes_written, stats["DownloadValue"].mean))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare RowIterator and Arrow CSV export throughput.")
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--batch-size", type=int, default=main.CSV_CHUNK_ROWS)
+    args = parser.parse_args()
+
+    batches = generate_batches(args.rows, args.batch_size)
+
+    def rows_path():
+        sink = DiscardFile()
+        csv_file = io.TextIOWrapper(sink, newline="", encoding="utf-8")
+        stats, = main.write_csv(FakeRowIterator(batches), [csv_file])
+        csv_file.flush()
+        return stats, sink.bytes_written
+
+    def arrow_path():
+        sink = DiscardFile()
+        stats, = main.write_csv_arrow(FakeRowIterator(batches), [sink])
+        return stats, sink.bytes_written
+
+    run("RowIterator", args.rows, rows_path)
+    run("Arrow", args.rows, arrow_path)
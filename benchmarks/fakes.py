@@ -0,0 +1,312 @@
+# In-process stand-ins for the BigQuery, Cloud Storage and SendGrid clients,
+# implementing just the calls send_csv_email and get_new_data make. They keep
+# no more than the benchmarks need: uploaded report data is counted and
+# dropped, so peak RSS reflects the functions rather than the fakes.
+import datetime as dt
+import io
+import itertools
+import threading
+
+from google.api_core.exceptions import NotFound
+from google.cloud.bigquery import SchemaField
+from google.cloud.bigquery.table import Row
+
+# BigQuery types of the columns the report queries select
+COLUMN_TYPES = {
+    "TestStartTime": "DATETIME", "ClientLat": "FLOAT", "ClientLon": "FLOAT",
+    "DownloadValue": "FLOAT", "UploadValue": "FLOAT", "Ping": "FLOAT",
+    "ServerLatency": "FLOAT", "IspDownloadAvg": "INTEGER", "IspUploadAvg": "INTEGER",
+    "ReportTimestamp": "TIMESTAMP",
+}
+
+
+# -- Cloud Storage -------------------------------------------------------------
+
+class _BlobWriter(io.RawIOBase):
+    """Write handle of a FakeBlob; counts the data and keeps it only if asked."""
+
+    def __init__(self, blob, keep):
+        self._blob = blob
+        self._chunks = [] if keep else None
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._blob.size += len(data)
+        if self._chunks is not None:
+            self._chunks.append(bytes(data))
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._blob._finalize(b"".join(self._chunks) if self._chunks is not None else None)
+        super().close()
+
+    def terminate(self):
+        # Cancels the upload, as BlobWriter.terminate() does: nothing is stored
+        self._chunks = None
+        super().close()
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.size = 0
+        self.generation = None
+        self.content_type = None
+
+    def _finalize(self, data):
+        with self.bucket.client.lock:
+            stored = self.bucket.client.objects.get((self.bucket.name, self.name))
+            self.generation = (stored.generation if stored is not None else 0) + 1
+            if data is not None:
+                self.size = len(data)
+            self.bucket.client.objects[(self.bucket.name, self.name)] = _StoredObject(data, self.size, self.generation)
+
+    def open(self, mode="rb", chunk_size=None, ignore_flush=False, content_type=None, **kwargs):
+        if mode == "rb":
+            return io.BytesIO(self.download_as_bytes())
+        self.content_type = content_type
+        self.size = 0
+        return _BlobWriter(self, self.bucket.client.keep_uploads)
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None, **kwargs):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        stored = self.bucket.client.objects.get((self.bucket.name, self.name))
+        if if_generation_match is not None and (stored.generation if stored else 0) != if_generation_match:
+            from google.api_core.exceptions import PreconditionFailed
+            raise PreconditionFailed("generation mismatch")
+        self.content_type = content_type
+        self._finalize(data)
+
+    def download_as_bytes(self, if_generation_match=None, start=None, end=None, **kwargs):
+        stored = self.bucket.client.objects[(self.bucket.name, self.name)]
+        if stored.data is None:
+            raise ValueError("Benchmark fakes do not keep the contents of gs://{}/{}".format(self.bucket.name, self.name))
+        if start is not None or end is not None:
+            return stored.data[start or 0:None if end is None else end + 1]
+        return stored.data
+
+    def download_as_string(self, **kwargs):
+        return self.download_as_bytes(**kwargs)
+
+    def reload(self, **kwargs):
+        stored = self.bucket.client.objects[(self.bucket.name, self.name)]
+        self.size = stored.size
+        self.generation = stored.generation
+
+    def exists(self, **kwargs):
+        return (self.bucket.name, self.name) in self.bucket.client.objects
+
+    def delete(self, **kwargs):
+        self.bucket.client.objects.pop((self.bucket.name, self.name), None)
+
+    def generate_signed_url(self, **kwargs):
+        return "https://storage.googleapis.com/{}/{}?X-Goog-Signature=fake".format(self.bucket.name, self.name)
+
+
+class _StoredObject:
+    __slots__ = ("data", "size", "generation")
+
+    def __init__(self, data, size, generation):
+        self.data = data
+        self.size = size
+        self.generation = generation
+
+
+class FakeBucket:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def blob(self, name, **kwargs):
+        return FakeBlob(self, name)
+
+    def get_blob(self, name, **kwargs):
+        stored = self.client.objects.get((self.name, name))
+        if stored is None:
+            return None
+        blob = FakeBlob(self, name)
+        blob.size = stored.size
+        blob.generation = stored.generation
+        return blob
+
+
+class FakeStorageClient:
+    """storage.Client holding objects in a dictionary.
+
+    Args:
+        keep_uploads: Keep the contents of objects written with
+            blob.open("wb"); reports are only counted by default.
+    """
+
+    def __init__(self, keep_uploads=False):
+        self.keep_uploads = keep_uploads
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, name):
+        return FakeBucket(self, name)
+
+    def list_blobs(self, bucket_name, prefix="", **kwargs):
+        bucket = self.bucket(bucket_name)
+        return [bucket.get_blob(name) for stored_bucket, name in sorted(self.objects)
+                if stored_bucket == bucket_name and name.startswith(prefix)]
+
+    def put(self, bucket_name, name, data):
+        """Stores an object directly, e.g. the contacts file or an upload."""
+        self.bucket(bucket_name).blob(name).upload_from_string(data)
+
+
+# -- BigQuery ------------------------------------------------------------------
+
+class FakeRowIterator:
+    """RowIterator over num_rows rows, cycling through a pool of generated rows.
+
+    Pages are built on the fly from the pool so that memory does not grow
+    with num_rows; building the Row objects stays in the timed path, as it
+    is in the real RowIterator.
+    """
+
+    def __init__(self, columns, pool, num_rows, page_size):
+        self.schema = [SchemaField(name, COLUMN_TYPES.get(name, "STRING")) for name in columns]
+        self._columns = columns
+        self._pool = pool
+        self.total_rows = num_rows
+        self._page_size = page_size or 10000
+
+    @property
+    def pages(self):
+        field_to_index = {name: i for i, name in enumerate(self._columns)}
+        values = itertools.cycle(self._pool)
+        for start in range(0, self.total_rows, self._page_size):
+            size = min(self._page_size, self.total_rows - start)
+            yield [Row(next(values), field_to_index) for _ in range(size)]
+
+    def __iter__(self):
+        for page in self.pages:
+            yield from page
+
+    def to_arrow_iterable(self, bqstorage_client=None):
+        import pyarrow as pa
+
+        for page in self.pages:
+            columns = list(zip(*(row.values() for row in page)))
+            yield pa.RecordBatch.from_arrays([pa.array(column) for column in columns], names=self._columns)
+
+
+class FakeQueryJob:
+    def __init__(self, client, query, job_id=None):
+        self.client = client
+        self.query = query
+        self.job_id = job_id or "query_{}".format(id(self))
+        self.num_dml_affected_rows = 0
+        self.error_result = None
+        self.errors = None
+
+    def result(self, page_size=None, **kwargs):
+        return self.client.query_result(self.query, page_size)
+
+
+class FakeLoadJob:
+    def __init__(self, client, uris, destination, job_id):
+        self.job_id = job_id
+        self.destination = destination
+        self.error_result = None
+        self.errors = None
+        # A load job reads every source object; count their rows like BigQuery would
+        self.output_rows = 0
+        for uri in [uris] if isinstance(uris, str) else uris:
+            bucket_name, name = uri[len("gs://"):].split("/", 1)
+            data = client.storage.objects[(bucket_name, name)].data
+            self.output_rows += data.count(b"\n")
+        client.loaded_rows += self.output_rows
+
+    def result(self, **kwargs):
+        return self
+
+
+class FakeBigQueryClient:
+    """bigquery.Client answering the report and ingest queries from a row pool.
+
+    Args:
+        storage: FakeStorageClient the load jobs read from.
+        pool: List of Multistream rows (dictionaries) cycled through to
+            answer export queries.
+        num_rows: Number of rows every export query returns.
+    """
+
+    def __init__(self, storage=None, pool=(), num_rows=0):
+        self.project = "benchmark-project"
+        self.storage = storage
+        self.pool = list(pool)
+        self.num_rows = num_rows
+        self.loaded_rows = 0
+        self.queries = []
+        self.lock = threading.Lock()
+        self._jobs = {}
+
+    def query(self, query, job_config=None, job_id=None, **kwargs):
+        with self.lock:
+            self.queries.append(query)
+        return FakeQueryJob(self, query, job_id)
+
+    def query_result(self, query, page_size):
+        if query.lstrip().startswith("MERGE") or "GROUPING SETS" in query:
+            # Rollup refreshes and server-side aggregates: nothing to stream
+            return FakeRowIterator([], [], 0, page_size)
+        select = query[len("SELECT "):query.index(" FROM ")]
+        columns = [column.split(" AS ")[-1].strip() for column in select.split(",")]
+        now = dt.datetime.now(dt.timezone.utc)
+        pool = []
+        for i, row in enumerate(self.pool):
+            # Spread the pool over the last day so routed windows see rows
+            timestamp = now - dt.timedelta(seconds=(i * 86399) // max(len(self.pool), 1) + 1)
+            pool.append(tuple(timestamp if name == "ReportTimestamp" else row.get(name) for name in columns))
+        return FakeRowIterator(columns, pool, self.num_rows, page_size)
+
+    def load_table_from_uri(self, source_uris, destination, job_id=None, job_config=None, **kwargs):
+        job = FakeLoadJob(self, source_uris, destination, job_id)
+        with self.lock:
+            self._jobs[job_id] = job
+        return job
+
+    def get_job(self, job_id, **kwargs):
+        if job_id not in self._jobs:
+            raise NotFound("Job {} not found".format(job_id))
+        return self._jobs[job_id]
+
+
+# -- SendGrid -----------------------------------------------------------------
+
+class FakeResponse:
+    status_code = 202
+
+
+class FakeSendGridClient:
+    """SendGridAPIClient that renders every message and counts the recipients."""
+
+    def __init__(self):
+        self.requests = 0
+        self.recipients = 0
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+
+    def send(self, message):
+        body = message.get()
+        size = len(str(body))
+        with self.lock:
+            self.requests += 1
+            self.recipients += sum(len(personalization.get("to", [])) for personalization in body.get("personalizations", []))
+            self.bytes_sent += size
+        return FakeResponse()
+
+
+class FakeCredentials:
+    """Stands in for the default credentials when signing report URLs."""
+    valid = True
+    token = "fake-token"
+    service_account_email = "benchmark@benchmark-project.iam.gserviceaccount.com"
@@ -0,0 +1,224 @@
+# Benchmark: end-to-end send_csv_email and get_new_data runs against the
+# in-process fakes in fakes.py, over synthetic Murakami data from
+# synthetic_data.py. Each run happens in a fresh process and reports wall
+# time, peak RSS and rows/sec.
+#
+# Runs offline; requires the packages in src/email_csv/requirements.txt and
+# src/export_to_bq/requirements.txt.
+#
+#   python benchmarks/pipeline_benchmark.py
+#   python benchmarks/pipeline_benchmark.py --target email --rows 10000 100000 1000000
+#   python benchmarks/pipeline_benchmark.py --output before.json
+#   python benchmarks/pipeline_benchmark.py --baseline before.json --max-regression 0.2
+#
+# With --baseline the script exits with status 1 if any run is slower in
+# rows/sec, or uses more peak memory, than the baseline by more than
+# --max-regression, so it can gate performance changes.
+import argparse
+import base64
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+EMAIL_CSV_DIR = os.path.join(ROOT, "src", "email_csv")
+EXPORT_TO_BQ_DIR = os.path.join(ROOT, "src", "export_to_bq")
+
+# Distinct generated rows cycled through to build the query results and uploads
+POOL_SIZE = 5000
+
+
+class FakeCloudEvent:
+    """CloudEvent with the attributes and data the functions read."""
+
+    def __init__(self, data, attributes=None):
+        self.data = data
+        self._attributes = attributes or {}
+
+    def __getitem__(self, key):
+        return self._attributes[key]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_email(args):
+    """Runs send_csv_email once over args.rows exported rows."""
+    os.environ.update({
+        "SENDGRID_API_KEY": "benchmark",
+        "PROJECT_ID": "benchmark-project",
+        "DATASET_ID": "DeviceBroadbandData",
+        "TABLE_ID": "Multistream",
+        "BUCKET_NAME": "benchmark-reports",
+        "CONTACTS_BUCKET": "benchmark-contacts",
+        "CONTACTS_FILE_NAME": "contacts.csv",
+        "QUERY_FREQUENCY": "1",
+        "SENDER_EMAIL": "reports@example.com",
+        "READ_API": args.read_api,
+        "STATS_MODE": "local",
+        "REPORT_MODE": "full",
+        "EXPORT_MODE": "stream",
+        "WINDOW_MODE": "rolling",
+        "ROLLUP_TABLE_ID": "",
+    })
+    sys.path.insert(0, EMAIL_CSV_DIR)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import clients
+    import main
+    from fakes import FakeBigQueryClient, FakeCredentials, FakeSendGridClient, FakeStorageClient
+    from synthetic_data import generate_rows
+
+    gcs = FakeStorageClient()
+    contacts = "email\n" + "".join("user{}@example.com\n".format(i) for i in range(args.contacts))
+    gcs.put("benchmark-contacts", "contacts.csv", contacts)
+    bigquery_client = FakeBigQueryClient(gcs, generate_rows("Multistream", POOL_SIZE), args.rows)
+    sendgrid_client = FakeSendGridClient()
+    clients._credentials = FakeCredentials()
+    clients._clients.update({
+        "bigquery": bigquery_client,
+        "bigquery_storage": None,
+        "storage": gcs,
+        ("sendgrid", "benchmark"): sendgrid_client,
+    })
+    message = json.dumps({"cadences": args.cadences}).encode("utf-8")
+    event = FakeCloudEvent({"message": {"data": base64.b64encode(message).decode("utf-8")}})
+
+    setup_rss = peak_rss_mb()
+    start = time.perf_counter()
+    main.send_csv_email(event)
+    elapsed = time.perf_counter() - start
+    return {
+        "rows": args.rows,
+        "seconds": elapsed,
+        "rows_per_second": args.rows / elapsed,
+        "setup_rss_mb": setup_rss,
+        "peak_rss_mb": peak_rss_mb(),
+        "emails": sendgrid_client.requests,
+        "uploaded_bytes": sum(stored.size for stored in gcs.objects.values()),
+    }
+
+
+def run_ingest(args):
+    """Runs get_new_data once per uploaded file, args.rows rows in total."""
+    os.environ.update({
+        "INGEST_MODE": args.ingest_mode,
+        "ROLLUP_MODE": "load",
+        "BATCH_WINDOW_SECONDS": "0.5",
+    })
+    sys.path.insert(0, EXPORT_TO_BQ_DIR)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from concurrent.futures import ThreadPoolExecutor
+    from unittest import mock
+    import DeviceBroadbandData_DML as DML
+    import main
+    from fakes import FakeBigQueryClient, FakeStorageClient
+    from synthetic_data import ndjson_files
+
+    # Every upload reuses one of a few distinct files, so the fake bucket
+    # does not grow with the number of rows
+    gcs = FakeStorageClient(keep_uploads=True)
+    pool = [data for name, data in ndjson_files("Multistream", POOL_SIZE, args.rows_per_file)]
+    events = []
+    for i in range((args.rows + args.rows_per_file - 1) // args.rows_per_file):
+        data = pool[i % len(pool)]
+        name = "murakami/multi-stream-{:07d}.jsonl".format(i)
+        gcs.put("benchmark-uploads", name, data)
+        events.append(FakeCloudEvent(
+            {"bucket": "benchmark-uploads", "name": name, "generation": "1", "size": str(len(data)), "timeCreated": "0"},
+            {"id": str(i), "type": "google.cloud.storage.object.v1.finalized"},
+        ))
+    bigquery_client = FakeBigQueryClient(gcs)
+    DML._client = bigquery_client
+
+    setup_rss = peak_rss_mb()
+    with mock.patch.object(main.storage, "Client", return_value=gcs):
+        start = time.perf_counter()
+        if args.ingest_mode == "batch":
+            with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                list(executor.map(main.get_new_data, events))
+        else:
+            for event in events:
+                main.get_new_data(event)
+        elapsed = time.perf_counter() - start
+    return {
+        "rows": bigquery_client.loaded_rows,
+        "seconds": elapsed,
+        "rows_per_second": bigquery_client.loaded_rows / elapsed,
+        "setup_rss_mb": setup_rss,
+        "peak_rss_mb": peak_rss_mb(),
+        "files": len(events),
+        "rollup_refreshes": sum(query.startswith("MERGE") for query in bigquery_client.queries),
+    }
+
+
+def run_worker(args):
+    result = run_email(args) if args.worker == "email" else run_ingest(args)
+    # The last line of output is read by the parent process
+    print(json.dumps(result))
+
+
+def check_regressions(results, baseline, max_regression):
+    """Returns a message for every run that regressed against the baseline."""
+    failures = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        before = baseline[key]
+        if result["rows_per_second"] < before["rows_per_second"] * (1 - max_regression):
+            failures.append("{}: {:,.0f} rows/s, baseline {:,.0f}".format(key, result["rows_per_second"], before["rows_per_second"]))
+        if result["peak_rss_mb"] > before["peak_rss_mb"] * (1 + max_regression):
+            failures.append("{}: peak RSS {:.0f} MB, baseline {:.0f} MB".format(key, result["peak_rss_mb"], before["peak_rss_mb"]))
+    return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark send_csv_email and get_new_data against in-process fakes.")
+    parser.add_argument("--target", nargs="+", choices=["email", "ingest"], default=["email", "ingest"])
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--cadences", nargs="+", default=["daily"], help="report cadences requested by the Pub/Sub message")
+    parser.add_argument("--read-api", choices=["rest", "storage"], default="rest")
+    parser.add_argument("--contacts", type=int, default=100)
+    parser.add_argument("--ingest-mode", choices=["single", "batch"], default="single")
+    parser.add_argument("--rows-per-file", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=80, help="concurrent events in batch ingest mode")
+    parser.add_argument("--output", help="write the results to a JSON file")
+    parser.add_argument("--baseline", help="JSON file from a previous --output to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.2)
+    parser.add_argument("--worker", choices=["email", "ingest"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        args.rows = args.rows[0]
+        run_worker(args)
+        sys.exit(0)
+
+    results = {}
+    print("{:<8} {:>10} {:>10} {:>14} {:>14}".format("target", "rows", "seconds", "rows/s", "peak RSS MB"))
+    for target in args.target:
+        for rows in args.rows:
+            # A fresh process per run, so peak RSS belongs to that run alone
+            command = [sys.executable, os.path.abspath(__file__), "--worker", target, "--rows", str(rows),
+                       "--cadences", *args.cadences, "--read-api", args.read_api, "--contacts", str(args.contacts),
+                       "--ingest-mode", args.ingest_mode, "--rows-per-file", str(args.rows_per_file),
+                       "--concurrency", str(args.concurrency)]
+            output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            results["{}:{}".format(target, rows)] = result
+            print("{:<8} {:>10,} {:>10.2f} {:>14,.0f} {:>14.1f}".format(
+                target, result["rows"], result["seconds"], result["rows_per_second"], result["peak_rss_mb"]))
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            failures = check_regressions(results, json.load(baseline_file), args.max_regression)
+        for failure in failures:
+            print("REGRESSION " + failure)
+        sys.exit(1 if failures else 0)
@@ -0,0 +1,120 @@
+# Synthetic Murakami test results matching the Multistream (Ookla) and NDT-7
+# table schemas. The schemas are read from src/export_to_bq/schemas.json,
+# which `DDL.py --dump-schemas` writes from multistream_schema and
+# ndt7_schema, so the generated rows follow the DDL without connecting to
+# BigQuery.
+import datetime as dt
+import json
+import os
+import random
+
+SCHEMA_FILE = os.path.join(os.path.dirname(__file__), "..", "src", "export_to_bq", "schemas.json")
+
+ISPS = ["Comcast", "Spectrum", "Frontier", "Ziply", "Starlink", "CenturyLink"]
+LOCATIONS = ["Portland", "Eugene", "Salem", "Bend", "Medford", "Astoria"]
+CONNECTION_TYPES = ["wired", "wireless"]
+NETWORK_TYPES = ["home", "business", "public"]
+DEVICES = ["murakami-{:03d}".format(i) for i in range(200)]
+
+
+def load_schemas():
+    """Returns a dictionary mapping table name to a list of (name, type) fields."""
+    with open(SCHEMA_FILE) as schema_file:
+        schemas = json.load(schema_file)
+    return {table: [(field["name"], field["type"]) for field in fields] for table, fields in schemas.items()}
+
+
+def _speed(rng):
+    # Log-normal around ~100 Mbps, with the slow tail that the 25/3 Mbps
+    # statistics are about
+    return rng.lognormvariate(18.4, 1.1)
+
+
+def _value(name, field_type, rng, start_time):
+    """Generates one plausible value for a column, by name where known, else by type."""
+    if name == "Isp":
+        return rng.choice(ISPS)
+    if name == "MurakamiLocation":
+        return rng.choice(LOCATIONS)
+    if name == "MurakamiDeviceID":
+        return rng.choice(DEVICES)
+    if name == "MurakamiConnectionType":
+        return rng.choice(CONNECTION_TYPES)
+    if name == "MurakamiNetworkType":
+        return rng.choice(NETWORK_TYPES)
+    if name in ("DownloadValue", "UploadValue"):
+        speed = _speed(rng) / (10 if name == "UploadValue" else 1)
+        return None if rng.random() < 0.01 else round(speed, 1)
+    if name.endswith("Unit"):
+        return "ms" if name.startswith(("Ping", "ServerLatency", "MinRTT")) else "bit/s"
+    if name in ("Ping", "ServerLatency", "MinRTTValue"):
+        return round(rng.uniform(5, 200), 3)
+    if name in ("ClientLat", "ServerLat"):
+        return round(rng.uniform(42.0, 46.0), 6)
+    if name in ("ClientLon", "ServerLon"):
+        return round(rng.uniform(-124.0, -117.0), 6)
+    if name in ("ClientIP", "ServerIP"):
+        return "10.{}.{}.{}".format(rng.randrange(256), rng.randrange(256), rng.randrange(1, 255))
+    if field_type in ("TIMESTAMP", "DATETIME"):
+        value = start_time + dt.timedelta(seconds=30 if name == "TestEndTime" else 0)
+        # DATETIME columns take no time zone
+        return value.isoformat() if field_type == "TIMESTAMP" else value.replace(tzinfo=None).isoformat()
+    if name.endswith("Error"):
+        return None
+    if field_type == "INTEGER":
+        return rng.randrange(1000000)
+    if field_type == "FLOAT":
+        return round(rng.uniform(0, 1000), 3)
+    return "{}-{}".format(name.lower(), rng.randrange(1000))
+
+
+def generate_rows(table, num_rows, seed=0, days=1, now=None):
+    """Generates test results for a table as dictionaries.
+
+    Args:
+        table: "Multistream" or "NDT-7".
+        num_rows: Number of rows to generate.
+        seed: Random seed, so every run produces the same data.
+        days: The tests are spread evenly over this many days before now.
+        now: Timezone-aware end of the period, defaults to the current time.
+
+    Yields:
+        Dictionary mapping column name to value, ready for json.dumps.
+    """
+    fields = load_schemas()[table]
+    rng = random.Random(seed)
+    now = now or dt.datetime.now(dt.timezone.utc)
+    step = dt.timedelta(days=days) / max(num_rows, 1)
+    for i in range(num_rows):
+        start_time = now - step * (num_rows - i)
+        row = {name: _value(name, field_type, rng, start_time) for name, field_type in fields}
+        row["TestName"] = "ookla" if table == "Multistream" else "ndt7"
+        yield row
+
+
+def ndjson_files(table, num_rows, rows_per_file, seed=0):
+    """Groups generated rows into newline-delimited JSON uploads.
+
+    Object names contain "multi-stream" or "ndt7" so export_to_bq routes
+    them to the right table, as Murakami's uploads do.
+
+    Args:
+        table: "Multistream" or "NDT-7".
+        num_rows: Total number of rows.
+        rows_per_file: Rows in each uploaded file.
+        seed: Random seed.
+
+    Yields:
+        (object name, file contents as bytes) tuples.
+    """
+    kind = "multi-stream" if table == "Multistream" else "ndt7"
+    lines = []
+    file_index = 0
+    for row in generate_rows(table, num_rows, seed):
+        lines.append(json.dumps(row))
+        if len(lines) == rows_per_file:
+            yield "murakami/{}-{:07d}.jsonl".format(kind, file_index), ("\n".join(lines) + "\n").encode("utf-8")
+            lines = []
+            file_index += 1
+    if lines:
+        yield "murakami/{}-{:07d}.jsonl".format(kind, file_index), ("\n".join(lines) + "\n").encode("utf-8")
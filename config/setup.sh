@@ -47,11 +47,27 @@ else
   echo "Create GCS bucket: $mybucket"
 fi
 
+# Delete the cleaned copies of uploads and the per-object load records a
+# week after they were written; the uploads themselves are kept
+lifecycle_file=$(mktemp)
+echo '{"rule": [{"action": {"type": "Delete"}, "condition": {"age": 7, "matchesPrefix": ["_ingest/clean/", "_ingest/loads/"]}}]}' > $lifecycle_file
+gsutil lifecycle set $lifecycle_file gs://$mybucket
+rm $lifecycle_file
+
+# Every function is deployed from its own folder with its own copy of the
+# shared modules; refuse to deploy copies that differ from src/export_to_bq
+python3 config/sync_shared.py --check || exit 1
+
 # Make the tables
 python3 src/database_BigQuery/DDL.py
 
+# Ship the table schemas with Export to BQ so it can skip fetching them on cold starts
+python3 src/database_BigQuery/DDL.py --dump-schemas src/export_to_bq/schemas.json
+
 
-# Deploy Export to BQ
+# Deploy Export to BQ. Every upload is loaded on its own (INGEST_MODE=single);
+# to batch the uploads of many devices into fewer load jobs, add
+# --cpu=1 --concurrency=80 --set-env-vars=INGEST_MODE=batch
 echo "Connecting GCS bucket $mybucket to Export to BigQuery Cloud Function"
 
 gcloud functions deploy get-new-upload \
@@ -64,6 +80,20 @@ gcloud functions deploy get-new-upload \
 --trigger-event-filters="bucket=$mybucket" \
 --service-account=${PROJECT_NUMBER}-compute@developer.gserviceaccount.com
 
+# Recompute the last two days of the daily rollup every hour, so reports see
+# recent tests, and the last month every night, catching tests uploaded late
+bq query \
+--use_legacy_sql=false \
+--display_name="Refresh recent MultistreamDaily rollup" \
+--schedule="every 1 hours" \
+"$(python3 src/export_to_bq/rollups.py --print-sql --days 2)"
+
+bq query \
+--use_legacy_sql=false \
+--display_name="Refresh MultistreamDaily rollup" \
+--schedule="every day 06:00" \
+"$(python3 src/export_to_bq/rollups.py --print-sql --days 31)"
+
 # Create Pub/Sub Topic
 gcloud pubsub topics create export_to_csv
 
@@ -77,16 +107,19 @@ gcloud functions deploy email-csv \
 --source=./src/email_csv \
 --entry-point send_csv_email \
 --trigger-topic=export_to_csv \
+--timeout=540 \
 --service-account=${PROJECT_NUMBER}-compute@developer.gserviceaccount.com
 
+# On Mondays the daily and weekly reports are due together and are built
+# from one scan of the weekly window
 gcloud scheduler jobs create pubsub weekly_export_to_csv \
---schedule="00 7 * * *" \
+--schedule="0 9 * * 1" \
 --location="$REGION" \
 --topic export_to_csv \
---message-body="Sent Weekly Email" 
+--message-body='{"cadences": ["daily", "weekly"]}'
 
 gcloud scheduler jobs create pubsub daily_export_to_csv \
---schedule="0 9 * * *" \
+--schedule="0 9 * * 0,2-6" \
 --location="$REGION" \
 --topic export_to_csv \
 --message-body="Sent Daily Email"
\ No newline at end of file
@@ -0,0 +1,59 @@
+# Shared modules: each Cloud Function is deployed from its own folder, so a
+# module used by more than one function is kept as a copy in each folder.
+# The copy in src/export_to_bq is the one to edit; this script copies it to
+# the other folders, or with --check fails if any copy differs from it.
+#
+#   python config/sync_shared.py
+#   python config/sync_shared.py --check
+#
+# setup.sh runs the check before deploying, and export_to_bq's
+# shared_modules_test.py runs it with the unit tests.
+import argparse
+import os
+import shutil
+import sys
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+SOURCE_DIR = "export_to_bq"
+
+# Shared module and the folders holding a copy of it
+SHARED_MODULES = {
+    "query_builder.py": ["database_BigQuery", "email_csv"],
+    "query_cache.py": ["database_BigQuery"],
+    "metrics.py": ["email_csv"],
+}
+
+
+def stale_copies():
+    """Returns the (source, copy) paths of every copy that differs from its source."""
+    stale = []
+    for module, folders in SHARED_MODULES.items():
+        source = os.path.join(SRC_DIR, SOURCE_DIR, module)
+        with open(source, "rb") as source_file:
+            expected = source_file.read()
+        for folder in folders:
+            copy = os.path.join(SRC_DIR, folder, module)
+            if os.path.islink(copy) or not os.path.isfile(copy):
+                stale.append((source, copy))
+                continue
+            with open(copy, "rb") as copy_file:
+                if copy_file.read() != expected:
+                    stale.append((source, copy))
+    return stale
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Copy the shared modules from src/export_to_bq to the other functions.")
+    parser.add_argument("--check", action="store_true", help="only fail if a copy differs from its source")
+    args = parser.parse_args()
+
+    for source, copy in stale_copies():
+        if args.check:
+            print("{} differs from {}; run python config/sync_shared.py".format(
+                os.path.relpath(copy), os.path.relpath(source)))
+            continue
+        if os.path.islink(copy):
+            os.remove(copy)
+        shutil.copyfile(source, copy)
+        print("Copied {} to {}".format(os.path.relpath(source), os.path.relpath(copy)))
+    sys.exit(1 if args.check and stale_copies() else 0)
@@ -8,7 +8,10 @@
 # --    Author: Google Cloud Guides
 # --    URL: https://cloud.google.com/bigquery/docs/tables
 # --    Last updated: 2023-01-31 UTC
+import argparse
+import json
 import os
+from google.api_core.exceptions import NotFound
 from google.cloud import bigquery
 from dotenv import load_dotenv
 
@@ -17,6 +20,7 @@ load_dotenv()
 dataset = os.getenv("DATASET_NAME")
 ndt7_table_name = os.getenv("NDT7_TABLE_NAME")
 multistream_table_name = os.getenv("MULTISTREAM_TABLE_NAME")
+rollup_table_name = os.getenv("ROLLUP_TABLE_NAME", "MultistreamDaily")
 
 client = bigquery.Client()
 # -- #####################################################
@@ -52,6 +56,11 @@ ndt7_schema = [
     bigquery.SchemaField("TestStartTime", "DATETIME", mode="NULLABLE")
 ]
 
+# Daily partitions on the test start time; NDT-7 has no Isp column
+ndt7_partitioning = bigquery.TimePartitioning(
+    type_=bigquery.TimePartitioningType.DAY, field="TestStartTime")
+ndt7_clustering = ["MurakamiDeviceID", "MurakamiLocation"]
+
 # -- -----------------------------------------------------
 # -- Table Multistream
 # -- -----------------------------------------------------
@@ -96,29 +105,245 @@ multistream_schema = [
     bigquery.SchemaField("ServerURL", "STRING", mode="NULLABLE"),
     bigquery.SchemaField("TestName", "STRING", mode="NULLABLE"),
     bigquery.SchemaField("TestStartTime", "DATETIME", mode="NULLABLE"),
-    bigquery.SchemaField("DownloadUnit", "STRING", mode="NULLABLE")
+    bigquery.SchemaField("DownloadUnit", "STRING", mode="NULLABLE"),
+    # Filled in by BigQuery when a row is loaded; watermark reports select
+    # rows by it so tests uploaded late are still reported
+    bigquery.SchemaField("IngestedAt", "TIMESTAMP", mode="NULLABLE",
+                         default_value_expression="CURRENT_TIMESTAMP()")
 ]
 
+# Daily partitions on the test timestamp that every report filters on
+multistream_partitioning = bigquery.TimePartitioning(
+    type_=bigquery.TimePartitioningType.DAY, field="TimeStamp")
+multistream_clustering = ["Isp", "MurakamiDeviceID", "MurakamiLocation"]
 
-if __name__ == '__main__':
-    client.delete_dataset(
-        project_dataset, delete_contents=True, not_found_ok=True)
-    print("Deleted dataset '{}'.".format(project_dataset))
+# -- -----------------------------------------------------
+# -- Table MultistreamDaily (rollup)
+# -- -----------------------------------------------------
+# One row per day, Isp, device and location of the Multistream tests, kept
+# up to date by export_to_bq/rollups.py. Reports over long windows read these
+# rows instead of the raw tests. The *_sketch columns are KLL quantile
+# sketches which can be merged across days for percentiles.
+rollup_table_id = project_dataset + '.' + rollup_table_name
+
+rollup_fields = ["DownloadValue", "UploadValue", "Ping"]
+# Fields with a count of the tests below the 25/3 Mbps standard (in bps)
+rollup_thresholds = {"DownloadValue": 25000000, "UploadValue": 3000000}
+rollup_schema = [
+    bigquery.SchemaField("Day", "DATE", mode="REQUIRED"),
+    bigquery.SchemaField("Isp", "STRING", mode="NULLABLE"),
+    bigquery.SchemaField("MurakamiDeviceID", "STRING", mode="NULLABLE"),
+    bigquery.SchemaField("MurakamiLocation", "STRING", mode="NULLABLE"),
+    bigquery.SchemaField("TestCount", "INTEGER", mode="REQUIRED"),
+]
+for field in rollup_fields:
+    rollup_schema += [
+        bigquery.SchemaField(field + "_count", "INTEGER", mode="REQUIRED"),
+        bigquery.SchemaField(field + "_sum", "FLOAT", mode="NULLABLE"),
+        bigquery.SchemaField(field + "_min", "FLOAT", mode="NULLABLE"),
+        bigquery.SchemaField(field + "_max", "FLOAT", mode="NULLABLE"),
+        bigquery.SchemaField(field + "_sketch", "BYTES", mode="NULLABLE"),
+    ]
+    if field in rollup_thresholds:
+        rollup_schema.append(bigquery.SchemaField(field + "_below", "INTEGER", mode="REQUIRED"))
+rollup_schema.append(bigquery.SchemaField("UpdatedAt", "TIMESTAMP", mode="REQUIRED"))
 
-    dataset = bigquery.Dataset(project_dataset)
-    dataset.location = "us-west1"
-    dataset = client.create_dataset(dataset, timeout=30)
-    print("Created dataset {}.{}".format(client.project, dataset.dataset_id))
+rollup_partitioning = bigquery.TimePartitioning(
+    type_=bigquery.TimePartitioningType.DAY, field="Day")
+rollup_clustering = ["Isp", "MurakamiDeviceID", "MurakamiLocation"]
 
+# -- #####################################################
+# -- TABLE CREATION
+# -- #####################################################
+def create_table(table_id, schema, partitioning, clustering):
+    """
+    create_table() creates a BigQuery table with the given schema, time
+    partitioning and clustering fields.
 
-    multistream_table = bigquery.Table(multistream_table_id, schema=multistream_schema)
-    multistream_table = client.create_table(multistream_table)
+    table_id: 'project_id.dataset_id.table_name' of the table to create
+    schema: list of bigquery.SchemaField
+    partitioning: bigquery.TimePartitioning of the table
+    clustering: list of column names to cluster the table by
+    return: created bigquery.Table
+    """
+    table = bigquery.Table(table_id, schema=schema)
+    table.time_partitioning = partitioning
+    table.clustering_fields = clustering
+    table = client.create_table(table)
     print(
-        "Created table {}.{}.{}".format(multistream_table.project, multistream_table.dataset_id, multistream_table.table_id)
+        "Created table {}.{}.{}".format(table.project, table.dataset_id, table.table_id)
     )
+    return table
 
-    ndt7_table = bigquery.Table(ndt7_table_id, schema=ndt7_schema)
-    ndt7_table = client.create_table(ndt7_table)
-    print(
-        "Created table {}.{}.{}".format(ndt7_table.project, ndt7_table.dataset_id, ndt7_table.table_id)
-    )
\ No newline at end of file
+
+# Standard SQL names of the legacy type names used in the schemas
+SQL_TYPES = {"INTEGER": "INT64", "FLOAT": "FLOAT64", "BOOLEAN": "BOOL"}
+
+
+def column_definition(field):
+    """
+    column_definition() returns the DDL column definition of a schema field,
+    keeping its mode and default value.
+
+    field: bigquery.SchemaField
+    return: string, e.g. "`IngestedAt` TIMESTAMP DEFAULT CURRENT_TIMESTAMP()"
+    """
+    definition = "`{}` {}".format(field.name, SQL_TYPES.get(field.field_type, field.field_type))
+    if field.mode == "REQUIRED":
+        definition += " NOT NULL"
+    if field.default_value_expression:
+        definition += " DEFAULT " + field.default_value_expression
+    return definition
+
+
+def migrate_table(table_id, schema, partitioning, clustering):
+    """
+    migrate_table() rewrites an existing unpartitioned table into the
+    partitioned and clustered layout without losing data. The rows are first
+    copied into a staging table with the new layout and counted; columns of
+    schema the original does not have yet are filled with NULL. The original
+    is counted again, and the migration is abandoned if rows were loaded into
+    it meanwhile. Only then is it replaced by a single CREATE OR REPLACE
+    TABLE statement reading the staging table, so the table always exists,
+    and the staging table is deleted once the new row count has been checked.
+    Pause ingestion while migrating: rows loaded during the replace are lost.
+
+    table_id: 'project_id.dataset_id.table_name' of the table to migrate
+    schema: list of bigquery.SchemaField
+    partitioning: bigquery.TimePartitioning to apply
+    clustering: list of column names to cluster the table by
+    return: None
+    """
+    table = client.get_table(table_id)
+    if table.time_partitioning is not None and table.clustering_fields == clustering:
+        print("Table {} is already partitioned".format(table_id))
+        return
+
+    # Copy every row into a staging table with the new layout, naming each
+    # column so columns added to the schema since are filled with NULL
+    existing = {field.name.lower() for field in table.schema}
+    columns = ", ".join(
+        "`{}`".format(field.name) if field.name.lower() in existing
+        else "CAST(NULL AS {}) AS `{}`".format(SQL_TYPES.get(field.field_type, field.field_type), field.name)
+        for field in schema)
+    staging_id = table_id + "_partitioned"
+    client.delete_table(staging_id, not_found_ok=True)
+    create_table(staging_id, schema, partitioning, clustering)
+    job_config = bigquery.QueryJobConfig(
+        destination=staging_id,
+        write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+    )
+    client.query("SELECT {} FROM `{}`".format(columns, table_id), job_config=job_config).result()
+
+    staging_rows = client.get_table(staging_id).num_rows
+    if staging_rows != table.num_rows:
+        raise RuntimeError("Staging table {} has {} rows, expected {}; {} left unchanged".format(
+            staging_id, staging_rows, table.num_rows, table_id))
+
+    # Rows loaded since the staging copy would be lost with the original
+    live_rows = client.get_table(table_id).num_rows
+    if live_rows != staging_rows:
+        client.delete_table(staging_id)
+        raise RuntimeError("Table {} has {} rows, {} were copied to staging; {} left unchanged. "
+                           "Pause ingestion and run the migration again".format(
+                               table_id, live_rows, staging_rows, table_id))
+
+    # Replace the original in one statement, so readers and loads see either
+    # the old or the new table but never a missing one
+    field_types = {field.name: field.field_type for field in schema}
+    replace_query = "CREATE OR REPLACE TABLE `{}` ({}) PARTITION BY {}_TRUNC(`{}`, {}) CLUSTER BY {} AS SELECT {} FROM `{}`".format(
+        table_id, ", ".join(column_definition(field) for field in schema),
+        field_types[partitioning.field], partitioning.field, partitioning.type_,
+        ", ".join("`{}`".format(name) for name in clustering),
+        ", ".join("`{}`".format(field.name) for field in schema), staging_id)
+    client.query(replace_query).result()
+    migrated_rows = client.get_table(table_id).num_rows
+    if migrated_rows != staging_rows:
+        raise RuntimeError("Table {} has {} rows after migration, expected {}; staging table {} kept".format(
+            table_id, migrated_rows, staging_rows, staging_id))
+    client.delete_table(staging_id)
+    print("Migrated {} rows of {} to a partitioned table".format(migrated_rows, table_id))
+
+
+def add_missing_columns(table_id, schema):
+    """
+    add_missing_columns() adds the columns of schema that an existing table
+    does not have yet, e.g. columns added in later versions.
+
+    table_id: 'project_id.dataset_id.table_name' of the table to update
+    schema: list of bigquery.SchemaField
+    return: None
+    """
+    table = client.get_table(table_id)
+    existing = {field.name.lower() for field in table.schema}
+    missing = [field for field in schema if field.name.lower() not in existing]
+    if missing:
+        table.schema = list(table.schema) + missing
+        client.update_table(table, ["schema"])
+        print("Added columns {} to {}".format(", ".join(field.name for field in missing), table_id))
+
+
+def create_missing_table(table_id, schema, partitioning, clustering):
+    """
+    create_missing_table() creates a table only if it does not exist yet, so
+    tables added in later versions can be created without recreating the
+    dataset.
+
+    table_id: 'project_id.dataset_id.table_name' of the table to create
+    partitioning: bigquery.TimePartitioning of the table
+    clustering: list of column names to cluster the table by
+    return: None
+    """
+    try:
+        client.get_table(table_id)
+        print("Table {} already exists".format(table_id))
+    except NotFound:
+        create_table(table_id, schema, partitioning, clustering)
+
+
+def dump_schemas(path):
+    """
+    dump_schemas() writes the table schemas to a JSON file mapping table name
+    to a list of schema fields. export_to_bq seeds its schema cache from this
+    file so cold starts do not have to fetch the schemas from BigQuery.
+
+    path: path of the JSON file to write
+    return: None
+    """
+    schemas = {
+        multistream_table_name: [field.to_api_repr() for field in multistream_schema],
+        ndt7_table_name: [field.to_api_repr() for field in ndt7_schema],
+    }
+    with open(path, "w") as schema_file:
+        json.dump(schemas, schema_file, indent=2)
+    print("Wrote table schemas to {}".format(path))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Create the DeviceBroadbandData dataset and tables.")
+    parser.add_argument("--migrate", action="store_true",
+                        help="rewrite the existing tables into the partitioned layout and create missing tables and columns instead of recreating the dataset")
+    parser.add_argument("--dump-schemas", metavar="PATH",
+                        help="only write the table schemas to a JSON file, e.g. src/export_to_bq/schemas.json")
+    args = parser.parse_args()
+
+    if args.dump_schemas:
+        dump_schemas(args.dump_schemas)
+    elif args.migrate:
+        migrate_table(multistream_table_id, multistream_schema, multistream_partitioning, multistream_clustering)
+        migrate_table(ndt7_table_id, ndt7_schema, ndt7_partitioning, ndt7_clustering)
+        add_missing_columns(multistream_table_id, multistream_schema)
+        create_missing_table(rollup_table_id, rollup_schema, rollup_partitioning, rollup_clustering)
+    else:
+        client.delete_dataset(
+            project_dataset, delete_contents=True, not_found_ok=True)
+        print("Deleted dataset '{}'.".format(project_dataset))
+
+        dataset = bigquery.Dataset(project_dataset)
+        dataset.location = "us-west1"
+        dataset = client.create_dataset(dataset, timeout=30)
+        print("Created dataset {}.{}".format(client.project, dataset.dataset_id))
+
+        create_table(multistream_table_id, multistream_schema, multistream_partitioning, multistream_clustering)
+        create_table(ndt7_table_id, ndt7_schema, ndt7_partitioning, ndt7_clustering)
+        create_table(rollup_table_id, rollup_schema, rollup_partitioning, rollup_clustering)
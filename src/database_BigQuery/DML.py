@@ -8,7 +8,16 @@
 # --    Author: Google Cloud Guides
 # --    URL: https://cloud.google.com/bigquery/docs/tables
 # --    Last updated: 2023-01-31 UTC
+import os
+import threading
+from dotenv import load_dotenv
 from google.cloud import bigquery
+from google.cloud import bigquery_storage
+from query_builder import (DAY_WINDOW, DOWN_UPLOAD_COLUMNS, REPORT_COLUMNS, WINDOW_DAYS, aggregate_select,
+                           day_parameters, select_query, time_window, window_parameters)
+from query_cache import QueryCache
+
+load_dotenv()
 
 client = bigquery.Client()
 # Project
@@ -24,6 +33,41 @@ ndt7_table = client.get_table(ndt7_table_id)
 multistream_table_id = '.'.join([project_id, dataset_id, "Multistream"])
 multistream_table_query_id = '`' + multistream_table_id + '`'
 multistream_table = client.get_table(multistream_table_id)
+    # Daily rollup of the Multistream Table, kept up to date by
+    # export_to_bq/rollups.py
+rollup_table_id = '.'.join([project_id, dataset_id, "MultistreamDaily"])
+rollup_table_query_id = '`' + rollup_table_id + '`'
+
+# Read queries are answered from a cache for QUERY_CACHE_TTL_SECONDS, in
+# memory and, if QUERY_CACHE_DIR is set, on disk. Queries estimated by a
+# dry run to process more than MAXIMUM_BYTES_BILLED bytes are refused.
+query_cache = QueryCache(
+    lambda: client,
+    max_entries=int(os.getenv("QUERY_CACHE_MAX_ENTRIES", 128)),
+    ttl_seconds=float(os.getenv("QUERY_CACHE_TTL_SECONDS", 300)),
+    window_seconds=float(os.getenv("QUERY_CACHE_WINDOW_SECONDS", 300)),
+    disk_dir=os.getenv("QUERY_CACHE_DIR") or None,
+    max_rows=int(os.getenv("QUERY_CACHE_MAX_ROWS", 100000)),
+    maximum_bytes_billed=int(os.getenv("MAXIMUM_BYTES_BILLED", 10 * 1024 ** 3)) or None,
+)
+
+# The Storage Read API client of as_arrow queries is created on first use
+# and shared by every query, as creating one opens a new gRPC channel
+_bqstorage_client = None
+_bqstorage_lock = threading.Lock()
+
+def get_bqstorage_client() -> bigquery_storage.BigQueryReadClient:
+    """
+    get_bqstorage_client() returns the module-wide BigQuery Storage Read API
+    client, creating it on first use.
+
+    return: bigquery_storage.BigQueryReadClient
+    """
+    global _bqstorage_client
+    with _bqstorage_lock:
+        if _bqstorage_client is None:
+            _bqstorage_client = bigquery_storage.BigQueryReadClient()
+        return _bqstorage_client
 
 """#### General Table Functions ###############################################"""
 def display_table_info(table: bigquery.Table) -> None:
@@ -47,17 +91,32 @@ def display_table_info(table: bigquery.Table) -> None:
     print("Table has {} rows\n".format(table_rows))
     print("-----------------------------------------------------------")
 
-def send_query(query: str) -> bigquery.QueryJob.result:
+def send_query(query: str, as_arrow: bool = False, use_cache: bool = True,
+               parameters: list = None) -> bigquery.QueryJob.result:
     """
     send_query() takes a given query string and creates a QueryJob class based
     on the given BigQuery query. The function then executes the query job and
-    returns the iterator of the QueryJob class upon completion of the query job
+    returns its rows upon completion of the query job. Repeated read queries
+    are answered from query_cache. A query whose dry run estimates more than
+    MAXIMUM_BYTES_BILLED bytes raises query_cache.QueryCostError instead of
+    running. If as_arrow is set the results are instead read through the
+    BigQuery Storage Read API, without the cache, and returned as an iterator
+    of Arrow record batches.
     
     query: BigQuery query string
-    return: QueryJob.result() iterator
+    as_arrow: return pyarrow.RecordBatch objects instead of rows
+    use_cache: set to False to always run the query
+    parameters: optional list of bigquery query parameters, e.g. from
+                window_parameters()
+    return: list of rows, QueryJob.result() iterator when use_cache is
+            False or the result is too large to cache, or iterator of
+            pyarrow.RecordBatch
     """
-    query_job = client.query(query)
-    return query_job.result()
+    if as_arrow:
+        return query_cache.run(query, parameters).result().to_arrow_iterable(bqstorage_client=get_bqstorage_client())
+    if not use_cache:
+        return query_cache.run(query, parameters).result()
+    return query_cache.query(query, parameters)
 
 """#### CREATE ################################################################"""
 def insert_json_uri(table: bigquery.Table, table_id: str, bucket_uri: str) -> None:
@@ -97,40 +156,70 @@ def insert_json_uri(table: bigquery.Table, table_id: str, bucket_uri: str) -> No
 
 """#### READ ##################################################################"""
 # Query Statements
+# Window boundaries are named parameters aligned to the hour rather than
+# CURRENT_TIMESTAMP(), so repeated reports hit BigQuery's result cache;
+# run the windowed queries with send_query(query, parameters=...).
 multistream_queries = {
     "selectAll": """SELECT * FROM {}\n""".format(multistream_table_query_id),
-    "selectDown/Upload": """SELECT TestName, ClientIP, TestStartTime, TestEndTime, DownloadValue, DownloadUnit, UploadValue, UploadUnit FROM {}\n""".format(multistream_table_query_id),
-    "requested": """SELECT
-                        Timestamp,
-                        TestStartTime,
-                        ClientIP,
-                        ClientLat,
-                        ClientLon,
-                        DownloadValue,
-                        DownloadUnit,
-                        UploadValue,
-                        UploadUnit,
-                        Ping,
-                        PingUnit,
-                        ServerLatency,
-                        ServerLatencyUnit,
-                        Isp,
-                        IspDownloadAvg,
-                        IspUploadAvg
-                    FROM
-                        `cs467-capstone-dummy-data.DeviceBroadbandData.Multistream`
-                    WHERE
-                        Timestamp > TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 7 DAY) AND Timestamp <= CURRENT_TIMESTAMP()
-                    ORDER BY
-                        Timestamp"""
+    "selectDown/Upload": select_query(multistream_table_id, DOWN_UPLOAD_COLUMNS),
+    "requested": select_query(multistream_table_id, REPORT_COLUMNS, time_window("Multistream"), order_by="Timestamp"),
 }
+# Days in the window of the windowed queries in multistream_queries
+multistream_query_days = {"requested": 7}
 """Time Selection"""
-times = {
-    "daily": """WHERE Timestamp > TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 1 DAY)\n""",
-    "weekly": """WHERE Timestamp > TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 7 DAY)\n""",
-    "monthly": """WHERE Timestamp > TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 31 DAY)\n""",
-    "yearly": """WHERE Timestamp > TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 365 DAY)\n"""
-}
+# Days covered by each window. times select the window of Multistream tests
+# and ndt7_times that of NDT-7 tests, which has no Timestamp column; it is
+# set by window_parameters(time_days[time], table_name=...) for the table.
+time_days = WINDOW_DAYS
+times = {time: time_window("Multistream") for time in time_days}
+ndt7_times = {time: time_window("NDT-7") for time in time_days}
+
+"""Rollup Statements"""
+# Summaries over the daily rollup read one row per day, Isp, device and
+# location instead of every test, so their cost grows with the number of
+# days in the window rather than the number of tests. A window of n days
+# covers the last n calendar days, today included, set by
+# day_parameters(time_days[time]).
+rollup_times = {time: DAY_WINDOW for time in time_days}
+# Summary columns, from the rollup and from the raw tests
+rollup_summary = ["SUM(TestCount) AS Tests"]
+raw_summary = ["COUNT(*) AS Tests"]
+for field, name in [("DownloadValue", "Download"), ("UploadValue", "Upload"), ("Ping", "Ping")]:
+    rollup_summary += [
+        "SUM({0}_sum) / NULLIF(SUM({0}_count), 0) AS {1}Avg".format(field, name),
+        "MIN({0}_min) AS {1}Min".format(field, name),
+        "MAX({0}_max) AS {1}Max".format(field, name),
+        "KLL_QUANTILES.MERGE_POINT_FLOAT64({0}_sketch, 0.5) AS {1}Median".format(field, name),
+    ]
+    raw_summary += [
+        "AVG({0}) AS {1}Avg".format(field, name),
+        "MIN({0}) AS {1}Min".format(field, name),
+        "MAX({0}) AS {1}Max".format(field, name),
+        "APPROX_QUANTILES({0}, 100)[OFFSET(50)] AS {1}Median".format(field, name),
+    ]
+# Windows at least this long are summarised from the rollup, as in email_csv
+ROLLUP_MIN_DAYS = int(os.getenv("ROLLUP_MIN_DAYS", 7))
+
+def summary_query(time: str, group_by: str = None) -> tuple:
+    """
+    summary_query() builds the query summarising the Multistream tests of one
+    of the windows in times. Windows of ROLLUP_MIN_DAYS days or more read
+    the daily rollup; shorter ones aggregate the raw tests.
+
+    time: key of times, e.g. "monthly"
+    group_by: optional column to summarise per value of, one of Isp,
+              MurakamiDeviceID or MurakamiLocation
+    return: tuple of the query string and its list of query parameters
+    """
+    if group_by not in (None, "Isp", "MurakamiDeviceID", "MurakamiLocation"):
+        raise ValueError("Cannot summarise by {}".format(group_by))
+    if time_days[time] >= ROLLUP_MIN_DAYS:
+        query = aggregate_select(rollup_table_id, rollup_summary, rollup_times[time], group_by)
+        parameters = day_parameters(time_days[time])
+    else:
+        query = aggregate_select(multistream_table_id, raw_summary, times[time], group_by)
+        parameters = window_parameters(time_days[time])
+    return query, parameters
 
 """#### Testing Functions #####################################################"""
 def test_queries(query_dict: dict) -> None:
@@ -138,13 +227,15 @@ def test_queries(query_dict: dict) -> None:
     test_queries() runs through all of the queries in a given query dictionary
     and prints the results to STDOUT.
 
-    query_dict: dictionary of query statements to test
+    query_dict: dictionary of query statements, or of (query, parameters)
+                tuples, to test
     return: None
     """
     limiter = "LIMIT 1"
     for query in query_dict.keys():
         print("Running Query: {}".format(query))
-        for row in send_query(query_dict[query]+limiter):
+        statement, parameters = query_dict[query] if isinstance(query_dict[query], tuple) else (query_dict[query], None)
+        for row in send_query(statement+limiter, parameters=parameters):
             print(row)
         print("-----------------------------------------------------------")
 
@@ -183,4 +274,6 @@ if __name__ == '__main__':
 
     # -------------------------------------------------------------------------
     if isTesting:
-        test_queries(multistream_queries)  # run all read queries for test purposes
+        test_queries({name: (query, window_parameters(multistream_query_days[name]) if name in multistream_query_days else None)
+                      for name, query in multistream_queries.items()})  # run all read queries for test purposes
+        test_queries({time: summary_query(time) for time in times})
@@ -0,0 +1,161 @@
+import base64
+import datetime as dt
+import gzip
+import io
+import zipfile
+from google.oauth2 import service_account
+import clients
+
+# File extension and MIME type of the attachment for each ATTACHMENT_MODE
+ATTACHMENT_TYPES = {
+    "raw": ("", "text/csv"),
+    "gzip": (".gz", "application/gzip"),
+    "zip": (".zip", "application/zip"),
+}
+
+
+class _CappedBuffer(io.RawIOBase):
+    """Write-only buffer that base64 encodes data as it is written and stops
+    keeping it once it passes max_bytes.
+
+    Once overflowed, further writes are only counted, so memory stays bounded
+    by max_bytes however much is written. The buffer is not seekable, which
+    makes gzip and zipfile stream into it without rewinding. Encoding as the
+    data arrives spreads the work over the export instead of leaving it
+    until the email is sent.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.overflowed = False
+        self._encoded = []
+        # Bytes left over after the last whole 3-byte group
+        self._pending = b""
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            self.overflowed = True
+            self._encoded = []
+            self._pending = b""
+        elif not self.overflowed:
+            pending = self._pending + bytes(data)
+            whole = len(pending) - len(pending) % 3
+            self._encoded.append(base64.b64encode(pending[:whole]))
+            self._pending = pending[whole:]
+        return len(data)
+
+    def getvalue(self):
+        return base64.b64decode(self.getvalue_base64())
+
+    def getvalue_base64(self):
+        return b"".join(self._encoded) + base64.b64encode(self._pending)
+
+
+class AttachmentSink(io.RawIOBase):
+    """Binary sink that compresses the CSV into an email attachment as it is written.
+
+    Args:
+        mode: "raw", "gzip" or "zip".
+        file_name: Name of the CSV file; the mode's extension is appended.
+        max_bytes: Largest compressed attachment kept. Past this size the
+            sink reports overflowed and the report should link to the GCS
+            copy instead.
+    """
+
+    def __init__(self, mode, file_name, max_bytes):
+        if mode not in ATTACHMENT_TYPES:
+            raise ValueError("Unknown attachment mode {}".format(mode))
+        extension, self.file_type = ATTACHMENT_TYPES[mode]
+        self.file_name = file_name + extension
+        self._buffer = _CappedBuffer(max_bytes)
+        self._zip = None
+        if mode == "gzip":
+            self._stream = gzip.GzipFile(filename=file_name, mode="wb", fileobj=self._buffer)
+        elif mode == "zip":
+            self._zip = zipfile.ZipFile(self._buffer, "w", compression=zipfile.ZIP_DEFLATED)
+            self._stream = self._zip.open(file_name, "w", force_zip64=True)
+        else:
+            self._stream = self._buffer
+
+    @property
+    def overflowed(self):
+        return self._buffer.overflowed
+
+    @property
+    def size(self):
+        # Compressed bytes written so far, counted past max_bytes too
+        return self._buffer.size
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if not self._buffer.overflowed:
+            self._stream.write(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            if self._stream is not self._buffer:
+                self._stream.close()
+            if self._zip is not None:
+                self._zip.close()
+        super().close()
+
+    def base64_content(self):
+        """Gets the finished attachment, base64 encoded as it was written.
+
+        Args:
+            None
+
+        Returns:
+            Base64 encoded attachment as a string.
+        """
+        return self._buffer.getvalue_base64().decode("utf-8")
+
+
+class TeeWriter(io.RawIOBase):
+    """Binary sink that writes everything to several other sinks."""
+
+    def __init__(self, *sinks):
+        self._sinks = sinks
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        for sink in self._sinks:
+            sink.write(data)
+        return len(data)
+
+
+def signed_url(blob, hours):
+    """Creates a time-limited V4 signed URL to download a blob.
+
+    Service account key credentials sign locally. Default credentials in
+    Cloud Functions cannot, so the IAM signBlob API is used with the
+    function's service account instead.
+
+    Args:
+        blob: Blob to link to.
+        hours: Number of hours the link stays valid (at most 168).
+
+    Returns:
+        Signed URL as a string.
+    """
+    credentials = clients.credentials()
+    expiration = dt.timedelta(hours=hours)
+    if isinstance(credentials, service_account.Credentials):
+        return blob.generate_signed_url(version="v4", expiration=expiration, method="GET")
+    return blob.generate_signed_url(
+        version="v4",
+        expiration=expiration,
+        method="GET",
+        service_account_email=credentials.service_account_email,
+        access_token=credentials.token,
+    )
@@ -0,0 +1,104 @@
+import os
+import threading
+from google.auth import default
+from google.auth.transport.requests import Request
+from google.cloud import bigquery
+from google.cloud import bigquery_storage
+from google.cloud import storage
+from google.oauth2 import service_account
+from sendgrid import SendGridAPIClient
+
+# Clients are created on first use and kept for the life of the instance, so
+# invocations landing on a warm instance reuse the credentials and the HTTP
+# connection pools instead of authenticating and opening new connections.
+_lock = threading.RLock()
+_credentials = None
+_clients = {}
+
+SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
+
+
+def credentials():
+    """Gets credentials to authenticate Google APIs.
+
+    The credentials are loaded once per instance and refreshed under a lock
+    when the access token has expired, so concurrent invocations never race
+    on the refresh.
+
+    Args:
+        None
+
+    Returns:
+        Credentials to authenticate the API.
+    """
+    global _credentials
+    with _lock:
+        if _credentials is None:
+            # Get Application Default Credentials if running in Cloud Functions
+            if os.getenv("IS_LOCAL") is None:
+                _credentials, project = default(scopes=SCOPES)
+            # To use this file locally set IS_LOCAL=1 and populate env var GOOGLE_APPLICATION_CREDENTIALS
+            # with path to service account json key file
+            else:
+                _credentials = service_account.Credentials.from_service_account_file(
+                    os.getenv("GOOGLE_APPLICATION_CREDENTIALS"), scopes=SCOPES,
+                )
+        if not _credentials.valid:
+            _credentials.refresh(Request())
+        return _credentials
+
+
+def _get_client(key, factory):
+    """Returns the cached client for key, creating it with factory if needed."""
+    with _lock:
+        if key not in _clients:
+            _clients[key] = factory()
+        return _clients[key]
+
+
+def bigquery_client():
+    """Gets the instance-wide BigQuery client.
+
+    Args:
+        None
+
+    Returns:
+        bigquery.Client
+    """
+    return _get_client("bigquery", lambda: bigquery.Client(credentials=credentials()))
+
+
+def bigquery_read_client():
+    """Gets the instance-wide BigQuery Storage Read API client.
+
+    Args:
+        None
+
+    Returns:
+        bigquery_storage.BigQueryReadClient
+    """
+    return _get_client("bigquery_storage", lambda: bigquery_storage.BigQueryReadClient(credentials=credentials()))
+
+
+def storage_client():
+    """Gets the instance-wide Cloud Storage client.
+
+    Args:
+        None
+
+    Returns:
+        storage.Client
+    """
+    return _get_client("storage", lambda: storage.Client(credentials=credentials()))
+
+
+def sendgrid_client(api_key):
+    """Gets the instance-wide SendGrid client for an API key.
+
+    Args:
+        api_key: SendGrid API key.
+
+    Returns:
+        SendGridAPIClient
+    """
+    return _get_client(("sendgrid", api_key), lambda: SendGridAPIClient(api_key))
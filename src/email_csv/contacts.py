@@ -0,0 +1,72 @@
+import csv
+import re
+import threading
+
+# Loose check that a contact looks like a single email address
+EMAIL_PATTERN = re.compile(r"^[^@\s,;<>\"]+@[^@\s,;<>\"]+\.[^@\s,;<>\"]+$")
+
+# Parsed contact lists kept across invocations on a warm instance, keyed by
+# (bucket, file name) and tagged with the object generation they came from
+_cache = {}
+_lock = threading.Lock()
+
+
+def parse_contacts(csv_data):
+    """Extracts the email addresses from the contacts CSV.
+
+    The first row is a header and the first column holds the addresses.
+    Invalid addresses are skipped and duplicates are removed, ignoring case
+    and keeping the first occurrence.
+
+    Args:
+        csv_data: Contents of the contacts CSV as bytes.
+
+    Returns:
+        List of email addresses.
+    """
+    email_list = []
+    seen = set()
+    csv_reader = csv.reader(csv_data.decode("utf-8-sig").splitlines())
+    next(csv_reader, None)
+    for row in csv_reader:
+        if not row or not row[0].strip():
+            continue
+        email = row[0].strip()
+        if not EMAIL_PATTERN.match(email):
+            print("Skipping invalid contact: {}".format(email))
+            continue
+        if email.lower() not in seen:
+            seen.add(email.lower())
+            email_list.append(email)
+    return email_list
+
+
+def load_contacts(gcs, bucket_name, file_name):
+    """Gets the contact list, downloading it only when it has changed.
+
+    A metadata request compares the object's generation with the cached
+    copy. The file is only downloaded and parsed again when the generation
+    differs, and the download is pinned to that generation.
+
+    Args:
+        gcs: Storage client.
+        bucket_name: Bucket holding the contacts CSV.
+        file_name: Name of the contacts CSV.
+
+    Returns:
+        List of email addresses.
+    """
+    key = (bucket_name, file_name)
+    blob = gcs.bucket(bucket_name).get_blob(file_name)
+    if blob is None:
+        raise FileNotFoundError("Contacts file gs://{}/{} not found".format(bucket_name, file_name))
+
+    with _lock:
+        cached = _cache.get(key)
+    if cached is not None and cached[0] == blob.generation:
+        return cached[1]
+
+    email_list = parse_contacts(blob.download_as_bytes(if_generation_match=blob.generation))
+    with _lock:
+        _cache[key] = (blob.generation, email_list)
+    return email_list
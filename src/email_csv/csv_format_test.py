@@ -0,0 +1,27 @@
+import random
+import struct
+
+import pyarrow as pa
+
+from main import csv_field_array
+
+
+def test_floats_are_written_as_repr_writes_them():
+    rng = random.Random(4)
+    values = [0.0, -0.0, 1.0, -1.0, 0.1, 25000000.0, 1e-4, 9.99e-5, 1e-5, 123456789012345.6, 1e15,
+              9999999999999998.0, 1e16, 1e22, 5e-324, 1.7976931348623157e308,
+              float("nan"), float("inf"), float("-inf"), None]
+    values += [rng.uniform(0, 1e9) for _ in range(1000)]
+    values += [float(rng.randint(0, 10 ** 12)) for _ in range(1000)]
+    # Arbitrary bit patterns cover every magnitude
+    values += [struct.unpack("d", struct.pack("Q", rng.getrandbits(64)))[0] for _ in range(1000)]
+
+    fields = csv_field_array(pa.array(values, pa.float64())).to_pylist()
+
+    assert fields == ["" if value is None else repr(value) for value in values]
+
+
+def test_strings_are_quoted_as_csv_writer_quotes_them():
+    fields = csv_field_array(pa.array(["plain", "a,b", 'say "hi"', "x\ny", None])).to_pylist()
+
+    assert fields == ["plain", '"a,b"', '"say ""hi"""', '"x\ny"', ""]
@@ -0,0 +1,162 @@
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import URLError
+from python_http_client.exceptions import HTTPError
+from sendgrid.helpers.mail import Personalization, To
+
+# SendGrid accepts at most 1000 personalizations per request
+MAX_PERSONALIZATIONS = 1000
+
+
+class RateLimiter:
+    """Token bucket limiting how many requests start per second.
+
+    Args:
+        rate: Requests allowed per second; 0 or less disables the limit.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next_start = time.monotonic()
+
+    def wait(self):
+        """Blocks until the caller may start its next request."""
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + 1.0 / self.rate
+        time.sleep(max(0.0, start - now))
+
+
+class DeliveryResult:
+    """Outcome of sending one batch of recipients."""
+
+    def __init__(self, recipients, status_code=None, error=None, attempts=1):
+        self.recipients = recipients
+        self.status_code = status_code
+        self.error = error
+        self.attempts = attempts
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def add_recipients(message, recipients):
+    """Adds every recipient to a message as a separate personalization.
+
+    Each recipient only sees their own address in the To header.
+
+    Args:
+        message: sendgrid Mail without recipients.
+        recipients: List of email addresses.
+
+    Returns:
+        The message.
+    """
+    for email in recipients:
+        personalization = Personalization()
+        personalization.add_to(To(email))
+        message.add_personalization(personalization)
+    return message
+
+
+# Errors raised while sending: SendGrid responses, and network failures and
+# timeouts, which have no status code
+SEND_ERRORS = (HTTPError, URLError, ConnectionError, TimeoutError)
+
+
+def is_retryable(error):
+    """Returns True for send errors worth retrying (network errors, rate limits and 5xx)."""
+    status = getattr(error, "status_code", None)
+    return status is None or status == 429 or status >= 500
+
+
+def is_recipient_error(error):
+    """Returns True if SendGrid rejected a request because of one of its recipients.
+
+    SendGrid answers 400 with the field of every invalid value, e.g.
+    personalizations.3.to.0.email for a bad address.
+    """
+    if getattr(error, "status_code", None) != 400:
+        return False
+    try:
+        errors = json.loads(error.body).get("errors") or []
+    except (TypeError, ValueError, AttributeError):
+        return False
+    return any(str(item.get("field") or "").startswith("personalizations") for item in errors)
+
+
+def send_batch(sg, build_message, recipients, limiter, max_attempts, base_delay):
+    """Sends one batch, retrying it on its own if it fails.
+
+    Transient errors are retried with exponential backoff. If SendGrid
+    rejects a batch of several recipients because of one of them, e.g. a bad
+    address, it is split and each recipient is sent separately so the others
+    still get the report. Other errors, such as a bad API key, fail the
+    whole batch.
+
+    Args:
+        sg: SendGridAPIClient.
+        build_message: Callable returning a new Mail without recipients.
+        recipients: List of email addresses in the batch.
+        limiter: RateLimiter shared by all batches.
+        max_attempts: Attempts per batch before giving up; at least one is made.
+        base_delay: Seconds before the first retry.
+
+    Returns:
+        List of DeliveryResult.
+    """
+    error = None
+    attempts = 0
+    for attempt in range(max(1, max_attempts)):
+        limiter.wait()
+        attempts += 1
+        try:
+            response = sg.send(add_recipients(build_message(), recipients))
+            return [DeliveryResult(recipients, status_code=response.status_code, attempts=attempts)]
+        except SEND_ERRORS as send_error:
+            error = send_error
+            if not is_retryable(send_error):
+                break
+            time.sleep(random.uniform(0, base_delay * 2 ** attempt))
+
+    if len(recipients) > 1 and is_recipient_error(error):
+        results = []
+        for email in recipients:
+            results += send_batch(sg, build_message, [email], limiter, max_attempts, base_delay)
+        return results
+    return [DeliveryResult(recipients, status_code=getattr(error, "status_code", None), error=error,
+                           attempts=attempts)]
+
+
+def deliver(sg, build_message, recipients, batch_size=MAX_PERSONALIZATIONS, concurrency=4,
+            rate_per_second=0, max_attempts=3, base_delay=1.0):
+    """Sends a message to every recipient in concurrent, rate-limited batches.
+
+    Args:
+        sg: SendGridAPIClient.
+        build_message: Callable returning a new Mail without recipients.
+        recipients: List of email addresses.
+        batch_size: Recipients per request, at most MAX_PERSONALIZATIONS.
+        concurrency: Number of batches sent at the same time.
+        rate_per_second: Most requests started per second; 0 for no limit.
+        max_attempts: Attempts per batch before giving up; at least one is made.
+        base_delay: Seconds before the first retry of a batch.
+
+    Returns:
+        List of DeliveryResult, one per request that finally succeeded or failed.
+    """
+    batch_size = max(1, min(batch_size, MAX_PERSONALIZATIONS))
+    batches = [recipients[i:i + batch_size] for i in range(0, len(recipients), batch_size)]
+    limiter = RateLimiter(rate_per_second)
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = [executor.submit(send_batch, sg, build_message, batch, limiter, max_attempts, base_delay)
+                   for batch in batches]
+        return [result for future in futures for result in future.result()]
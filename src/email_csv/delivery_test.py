@@ -0,0 +1,58 @@
+import json
+
+from python_http_client.exceptions import HTTPError
+
+from delivery import RateLimiter, deliver, send_batch
+
+BAD_ADDRESS = "rejected@example.invalid"
+
+
+class FakeResponse:
+    status_code = 202
+
+
+class FakeSendGrid:
+    """Rejects requests holding BAD_ADDRESS like SendGrid, and fails the first `failures` requests."""
+
+    def __init__(self, failures=0, status=503):
+        self.requests = []
+        self.failures = failures
+        self.status = status
+
+    def send(self, message):
+        recipients = [personalization.tos[0]["email"] for personalization in message.personalizations]
+        self.requests.append(recipients)
+        if len(self.requests) <= self.failures:
+            raise HTTPError(self.status, "error", b"{}", {})
+        if BAD_ADDRESS in recipients:
+            body = {"errors": [{"field": "personalizations.{}.to.0.email".format(recipients.index(BAD_ADDRESS)),
+                                "message": "Invalid email"}]}
+            raise HTTPError(400, "Bad Request", json.dumps(body).encode("utf-8"), {})
+        return FakeResponse()
+
+
+def build_message():
+    from sendgrid.helpers.mail import Mail
+    return Mail(from_email="reports@example.com", subject="report", plain_text_content="report")
+
+
+def test_rejected_batch_is_split():
+    sg = FakeSendGrid()
+    recipients = ["a@example.com", BAD_ADDRESS, "b@example.com"]
+    results = deliver(sg, build_message, recipients, batch_size=3, max_attempts=1)
+    assert [(result.recipients, result.ok) for result in results] == [
+        (["a@example.com"], True), ([BAD_ADDRESS], False), (["b@example.com"], True)]
+    assert sorted(sg.requests[0]) == sorted(recipients)
+
+
+def test_other_errors_are_not_split():
+    sg = FakeSendGrid(failures=10, status=401)
+    results = send_batch(sg, build_message, ["a@example.com", "b@example.com"], RateLimiter(0), 3, 0)
+    assert len(results) == 1 and results[0].status_code == 401 and results[0].attempts == 1
+    assert len(sg.requests) == 1
+
+
+def test_transient_errors_are_retried():
+    sg = FakeSendGrid(failures=2, status=503)
+    results = send_batch(sg, build_message, ["a@example.com"], RateLimiter(0), 3, 0)
+    assert results[0].ok and results[0].attempts == 3
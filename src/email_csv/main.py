@@ -1,44 +1,841 @@
-import base64
 import functions_framework
 from google.cloud import bigquery
-from google.cloud import storage
 import datetime as dt
-import io
+import base64
+import functools
 import csv
+import gzip
+import io
+import json
 import os
-import sendgrid
-from sendgrid import SendGridAPIClient
+import re
 from sendgrid.helpers.mail import *
-from google.auth import iam, default
-from google.auth.transport import requests
-from google.oauth2 import service_account
 from dotenv import load_dotenv
+import clients
+import metrics
+from attachments import AttachmentSink, TeeWriter, signed_url
+from contacts import load_contacts
+from delivery import deliver
+from pipeline import BackgroundWriter, Pipeline, current_pipeline, track_job
+from watermarks import load_watermark, save_watermark, watermark_name
+from stats import REPORT_PERCENTILES, STAT_FIELDS, new_report_stats, stats_from_aggregate_row
+import report_queries
+from report_queries import ROUTE_COLUMN
 
 # Load environment variables
 load_dotenv()
 
-def credentials():
-    """Gets credentials to authenticate Google APIs.
- 
+# Number of rows fetched per page and written to the CSV at a time
+CSV_CHUNK_ROWS = int(os.getenv("CSV_CHUNK_ROWS", 10000))
+
+# Size of each resumable upload chunk sent to GCS (must be a multiple of 256 KiB)
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 8 * 1024 * 1024))
+
+# Where the report statistics are computed: "local" accumulates them while
+# writing the CSV, "server" runs a single aggregate query in BigQuery
+STATS_MODE = os.getenv("STATS_MODE", "local")
+
+# "full" attaches the CSV export, "summary" only sends the statistics
+REPORT_MODE = os.getenv("REPORT_MODE", "full")
+
+# Optional comma separated columns to break the statistics down by (server mode)
+STATS_GROUP_BY = [column.strip() for column in os.getenv("STATS_GROUP_BY", "").split(",") if column.strip()]
+
+# How the CSV export is produced: "stream" writes rows from the function,
+# "extract" has BigQuery write sharded CSV straight to the bucket
+EXPORT_MODE = os.getenv("EXPORT_MODE", "stream")
+
+# Compression of extracted shards: "NONE" or "GZIP"
+EXPORT_COMPRESSION = os.getenv("EXPORT_COMPRESSION", "NONE").upper()
+
+# Set to "false" to link the extracted shards instead of composing them
+EXPORT_COMPOSE = os.getenv("EXPORT_COMPOSE", "true").lower() == "true"
+
+# How rows are read back for the streamed export: "rest" pages through the
+# RowIterator, "storage" reads Arrow record batches over the Storage Read API
+READ_API = os.getenv("READ_API", "rest")
+
+# Attachment compression: "raw", "gzip" or "zip"
+ATTACHMENT_MODE = os.getenv("ATTACHMENT_MODE", "gzip")
+
+# Largest attachment, after compression, sent with the email. Larger reports
+# are linked with a signed URL to the GCS copy instead. SendGrid limits the
+# whole message to 30 MB and base64 grows the attachment by a third.
+ATTACHMENT_MAX_BYTES = int(os.getenv("ATTACHMENT_MAX_BYTES", 20 * 1024 * 1024))
+
+# Hours a signed URL to an oversized report stays valid (at most 168)
+SIGNED_URL_HOURS = int(os.getenv("SIGNED_URL_HOURS", 72))
+
+# Recipients per SendGrid request (at most 1000), requests sent at the same
+# time, most requests started per second (0 for no limit) and attempts per batch
+DELIVERY_BATCH_SIZE = int(os.getenv("DELIVERY_BATCH_SIZE", 1000))
+DELIVERY_CONCURRENCY = int(os.getenv("DELIVERY_CONCURRENCY", 4))
+DELIVERY_RATE_PER_SECOND = float(os.getenv("DELIVERY_RATE_PER_SECOND", 0))
+DELIVERY_MAX_ATTEMPTS = int(os.getenv("DELIVERY_MAX_ATTEMPTS", 3))
+
+# Daily rollup table (see export_to_bq/rollups.py) in DATASET_ID. Report
+# windows of at least ROLLUP_MIN_DAYS days read their statistics from it,
+# so their cost depends on the number of days rather than the number of
+# tests. Leave empty to always aggregate the raw table.
+ROLLUP_TABLE_ID = os.getenv("ROLLUP_TABLE_ID", "")
+ROLLUP_MIN_DAYS = int(os.getenv("ROLLUP_MIN_DAYS", 7))
+
+# How the report windows are chosen: "rolling" reports the last n days on
+# every run, "watermark" exports only the tests after the last successfully
+# emailed report, tracked per window in BUCKET_NAME
+WINDOW_MODE = os.getenv("WINDOW_MODE", "rolling")
+
+# Rolling windows end on a multiple of this many minutes (0 to end them at
+# the time of the run), so reports run again within the same interval, or
+# cadences overlapping with another job, send identical queries that
+# BigQuery answers from its result cache
+WINDOW_ALIGN_MINUTES = float(os.getenv("WINDOW_ALIGN_MINUTES", 60))
+
+# Watermark windows select tests by the time they were loaded and end this
+# many minutes before the run, so tests that are still being loaded are
+# left for the next run
+WATERMARK_LAG_MINUTES = float(os.getenv("WATERMARK_LAG_MINUTES", 15))
+
+# Watermark windows only include tests taken at most this many days before
+# the window starts, which bounds the partitions every run scans
+WATERMARK_LATE_DAYS = int(os.getenv("WATERMARK_LATE_DAYS", 7))
+
+# Column and scan bounds of the report queries for the window mode
+WINDOW_FILTER = {"column": report_queries.INGESTED_COLUMN, "late_days": WATERMARK_LATE_DAYS} \
+    if WINDOW_MODE == "watermark" else {}
+
+# Seconds any one stage of the report (a query, the export, an upload or
+# the delivery of one window) may run before the whole report is aborted,
+# kept below the 540 second function timeout set by config/setup.sh, and
+# the number of stages run at the same time; uploads run on threads of their
+# own and are not counted
+STAGE_TIMEOUT_SECONDS = float(os.getenv("STAGE_TIMEOUT_SECONDS", 480))
+PIPELINE_WORKERS = int(os.getenv("PIPELINE_WORKERS", 16))
+
+# GCS can compose at most this many objects in one request
+MAX_COMPOSE_SOURCES = 32
+
+def write_csv(results, csv_files, cutoffs=None):
+    """Writes query results to one or more CSV files one page at a time.
+
+    Statistics for the fields in STAT_FIELDS are accumulated as each page is
+    written so that no more than one page of rows is held in memory.
+
+    With cutoffs, the last column of every row is its ROUTE_COLUMN
+    timestamp. A row is written to csv_files[i] only if it is later than
+    cutoffs[i], and the routing column itself is not written.
+
     Args:
+        results: RowIterator returned by QueryJob.result().
+        csv_files: List of writable text file-like objects.
+        cutoffs: Optional list of timezone-aware datetimes, one per file.
+
+    Returns:
+        List with a dictionary mapping field name to RunningStat per file.
+    """
+    writers = [csv.writer(csv_file) for csv_file in csv_files]
+
+    # Write header row
+    header = [field.name for field in results.schema]
+    if cutoffs is not None:
+        header = header[:-1]
+    for writer in writers:
+        writer.writerow(header)
+
+    # Column positions of the fields we keep statistics for
+    window_stats = [new_report_stats() for csv_file in csv_files]
+    stat_indexes = [(header.index(field), field) for field in STAT_FIELDS if field in header]
+
+    # Write data rows
+    for page in results.pages:
+        rows = [row.values() for row in page]
+        for i, writer in enumerate(writers):
+            if cutoffs is None:
+                window_rows = rows
+            else:
+                window_rows = [row[:-1] for row in rows if row[-1] > cutoffs[i]]
+            writer.writerows(window_rows)
+            for index, field in stat_indexes:
+                stat = window_stats[i][field]
+                for row in window_rows:
+                    stat.add(row[index])
+    return window_stats
+
+def csv_field_array(array):
+    """Formats an Arrow array as CSV fields the way write_csv() writes them.
+
+    Values are rendered as str() renders the values of a RowIterator row
+    and quoted as csv.writer quotes them, so both read paths write the same
+    CSV. Every type uses Arrow's kernels; only floats that repr() writes
+    with an exponent, or Arrow does, are formatted one value at a time.
+
+    Args:
+        array: pyarrow Array of one column.
+
+    Returns:
+        pyarrow string Array without NULLs.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    if pa.types.is_floating(array.type):
+        # Arrow and repr() write the same shortest digits, but Arrow leaves
+        # ".0" off whole numbers and uses exponents at other magnitudes
+        array = pc.cast(array, pa.float64())
+        text = pc.cast(array, pa.string())
+        text = pc.if_else(pc.match_substring(text, "."), text, pc.binary_join_element_wise(text, ".0", ""))
+        magnitude = pc.abs(array)
+        exponent = pc.or_(pc.or_(pc.and_(pc.less(magnitude, 1e-4), pc.not_equal(magnitude, 0)),
+                                 pc.greater_equal(magnitude, 1e16)),
+                          pc.or_(pc.match_substring(text, "e"), pc.invert(pc.is_finite(array))))
+        exponent = pc.fill_null(exponent, False)
+        if pc.any(exponent).as_py():
+            text = pc.replace_with_mask(text, exponent, pa.array(
+                [repr(value) for value in pc.filter(array, exponent).to_pylist()], pa.string()))
+    elif pa.types.is_boolean(array.type):
+        text = pc.if_else(array, "True", "False")
+    elif pa.types.is_timestamp(array.type) or pa.types.is_time(array.type):
+        # str() only writes the microseconds when there are some, and
+        # writes the UTC offset of a TIMESTAMP as +00:00
+        unit = pa.timestamp("us", array.type.tz) if pa.types.is_timestamp(array.type) else pa.time64("us")
+        text = pc.cast(pc.cast(array, unit), pa.string())
+        text = pc.replace_substring_regex(text, r"\.000000(Z?)$", r"\1")
+        text = pc.replace_substring_regex(text, r"Z$", "+00:00")
+    else:
+        text = pc.cast(array, pa.string())
+        if pa.types.is_string(array.type) or pa.types.is_large_string(array.type):
+            quoted = pc.binary_join_element_wise("\"", pc.replace_substring(text, "\"", "\"\""), "\"", "")
+            text = pc.if_else(pc.match_substring_regex(text, '[,"\r\n]'), quoted, text)
+    return pc.fill_null(text, "")
+
+def csv_lines(table):
+    """Formats the rows of an Arrow table as CSV lines.
+
+    Args:
+        table: pyarrow Table.
+
+    Returns:
+        bytes of the rows, each ending in CRLF as csv.writer ends them.
+    """
+    import pyarrow.compute as pc
+
+    if table.num_rows == 0:
+        return b""
+    table = table.combine_chunks()
+    columns = [csv_field_array(column.chunk(0)) for column in table.columns]
+    lines = pc.binary_join_element_wise(pc.binary_join_element_wise(*columns, ","), "", "\r\n")
+    # The joined lines are contiguous in the array's data buffer
+    return lines.buffers()[2].to_pybytes()[:pc.sum(pc.binary_length(lines)).as_py()]
+
+def write_csv_arrow(results, csv_files, bqstorage_client=None, cutoffs=None):
+    """Writes query results to one or more CSV files one Arrow record batch at a time.
+
+    Batches are formatted by csv_lines() and the statistics are computed
+    over whole columns, so little per-row Python work is done; the CSV is
+    the same as write_csv() writes. Rows are routed between files on
+    ROUTE_COLUMN as in write_csv().
+
+    Args:
+        results: RowIterator returned by QueryJob.result().
+        csv_files: List of writable binary file-like objects.
+        bqstorage_client: Optional BigQueryReadClient; rows are read over
+            the Storage Read API when given.
+        cutoffs: Optional list of timezone-aware datetimes, one per file.
+
+    Returns:
+        List with a dictionary mapping field name to RunningStat per file.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    # Write header row
+    header = [field.name for field in results.schema]
+    if cutoffs is not None:
+        header = header[:-1]
+    header_text = io.StringIO()
+    csv.writer(header_text).writerow(header)
+    for csv_file in csv_files:
+        csv_file.write(header_text.getvalue().encode("utf-8"))
+
+    # Write data rows
+    window_stats = [new_report_stats() for csv_file in csv_files]
+    for batch in results.to_arrow_iterable(bqstorage_client=bqstorage_client):
+        table = pa.Table.from_batches([batch])
+        tables = [table] * len(csv_files)
+        if cutoffs is not None:
+            route = table.column(ROUTE_COLUMN)
+            tables = [table.filter(pc.greater(route, pa.scalar(cutoff, type=route.type))).drop([ROUTE_COLUMN])
+                      for cutoff in cutoffs]
+        for csv_file, window_table, stats in zip(csv_files, tables, window_stats):
+            csv_file.write(csv_lines(window_table))
+            for field, stat in stats.items():
+                if field in window_table.schema.names:
+                    stat.add_array(window_table.column(field))
+    return window_stats
+
+def discard_upload(blob_writer):
+    """Cancels a GCS upload so that nothing written to it is saved.
+
+    Closing a BlobWriter finishes the upload, which after a failed export
+    would save a truncated CSV; the resumable upload session is deleted
+    instead.
+
+    Args:
+        blob_writer: BlobWriter returned by Blob.open("wb").
+
+    Returns:
         None
-        
+    """
+    if hasattr(blob_writer, "terminate"):
+        blob_writer.terminate()
+        return
+    # google-cloud-storage releases without BlobWriter.terminate(); closing
+    # the buffer first makes a later close() upload nothing
+    upload_and_transport = blob_writer._upload_and_transport
+    blob_writer._buffer.close()
+    if upload_and_transport:
+        upload, transport = upload_and_transport
+        try:
+            transport.delete(upload.upload_url)
+        except Exception as error:
+            # The session is never finalized either way; it expires in a week
+            print("Could not cancel the upload of {}: {}".format(blob_writer._blob.name, error))
+
+def stream_export(results, bucket, windows, file_names, starts):
+    """Streams the export query into a CSV object and attachment per report window.
+
+    Every window's CSV is written to GCS and compressed into its attachment
+    at the same time, so the rows are read only once however many windows
+    are due. Called from a pipeline stage, the GCS uploads run on stages of
+    their own while the rows are read and compressed, and may still be
+    running when this returns. If the export fails, no CSV is saved: the
+    uploads are cancelled instead of finished.
+
+    Args:
+        results: RowIterator of the export query. When there is more than
+            one window it must select ROUTE_COLUMN last.
+        bucket: Bucket the CSV files are written to.
+        windows: List of (name, days) report windows.
+        file_names: Dictionary mapping window name to CSV file name.
+        starts: Dictionary mapping window name to the timezone-aware time
+            the window starts after.
+
+    Returns:
+        Tuple of dictionaries mapping window name to statistics, to a list
+        with the exported blob, to the AttachmentSink and to the Future of
+        its upload stage (empty outside a pipeline).
+    """
+    cutoffs = None
+    if len(windows) > 1:
+        cutoffs = [starts[name] for name, days in windows]
+
+    export_blobs = {}
+    attachments = {}
+    uploads = {}
+    csv_files = []
+    # (writer, abort) of every upload not yet finished; abort cancels it so
+    # no partial CSV is saved if the export fails
+    open_uploads = []
+    stages = current_pipeline()
+    # The upload and compression times are measured on their own; the rest
+    # of the span is spent reading the rows and formatting the CSV
+    with metrics.span("stream_export", windows=len(windows), read_api=READ_API,
+                      rows=getattr(results, "total_rows", None)) as span:
+        try:
+            for name, days in windows:
+                blob = bucket.blob(file_names[name])
+                export_blobs[name] = [blob]
+                attachments[name] = AttachmentSink(ATTACHMENT_MODE, file_names[name], ATTACHMENT_MAX_BYTES)
+                blob_writer = blob.open("wb", chunk_size=UPLOAD_CHUNK_SIZE, ignore_flush=True, content_type="text/csv")
+                abort = functools.partial(discard_upload, blob_writer)
+                if stages is not None:
+                    # upload_ms is then the time spent waiting for the upload to catch up
+                    try:
+                        blob_writer = BackgroundWriter(stages, "upload", blob_writer, UPLOAD_CHUNK_SIZE,
+                                                       discard=discard_upload)
+                    except BaseException:
+                        abort()
+                        raise
+                    uploads[name] = blob_writer.future
+                    abort = blob_writer.abort
+                blob_file = metrics.TimedWriter(blob_writer, span, "upload")
+                open_uploads.append((blob_file, abort))
+                csv_files.append(TeeWriter(blob_file, metrics.TimedWriter(attachments[name], span, "compress")))
+
+            if READ_API == "storage":
+                bqstorage_client = clients.bigquery_read_client()
+                window_stats = write_csv_arrow(results, csv_files, bqstorage_client, cutoffs)
+            else:
+                text_files = [io.TextIOWrapper(csv_file, encoding="utf-8", newline="") for csv_file in csv_files]
+                window_stats = write_csv(results, text_files, cutoffs)
+                for text_file in text_files:
+                    text_file.flush()
+
+            # Every row was written; only now finish the uploads
+            while open_uploads:
+                blob_file, abort = open_uploads[0]
+                blob_file.close()
+                open_uploads.pop(0)
+        except BaseException:
+            for blob_file, abort in open_uploads:
+                abort()
+            raise
+
+        for attachment in attachments.values():
+            attachment.close()
+        span.set(attachment_bytes=sum(attachment.size for attachment in attachments.values()))
+    stats = {name: window_stats[i] for i, (name, days) in enumerate(windows)}
+    return stats, export_blobs, attachments, uploads
+
+def stream_report(bigquery_client, bucket, dataset_id, table_id, windows, bounds, file_names):
+    """Runs the export query and streams its rows into the report CSVs and attachments.
+
+    The widest window due is queried once; with several windows the rows
+    are routed between them on ROUTE_COLUMN.
+
+    Args:
+        bigquery_client: BigQuery client used to run the query.
+        bucket: Bucket the CSV files are written to.
+        dataset_id: BigQuery dataset holding the table.
+        table_id: BigQuery table to export.
+        windows: List of (name, days) report windows.
+        bounds: Dictionary mapping window name to its (start, end) datetimes.
+        file_names: Dictionary mapping window name to CSV file name.
+
+    Returns:
+        Tuple of dictionaries keyed by window name, as from stream_export().
+    """
+    # Query the data you want to export
+    # Below is the query that will export data for the widest window due
+    widest_bounds = (min(start for start, end in bounds.values()), max(end for start, end in bounds.values()))
+    query, parameters = report_queries.export_query(dataset_id, table_id, widest_bounds, route=len(windows) > 1,
+                                                    **WINDOW_FILTER)
+    with metrics.span("export_query") as span:
+        query_job = bigquery_client.query(query, job_config=bigquery.QueryJobConfig(query_parameters=parameters))
+        track_job(query_job)
+        results = query_job.result(page_size=CSV_CHUNK_ROWS)
+        span.record_job(query_job)
+    return stream_export(results, bucket, windows, file_names, {name: start for name, (start, end) in bounds.items()})
+
+def extract_report(bigquery_client, gcs, source_table_id, export_table_id, windows, bounds, bucket_name, file_names):
+    """Exports the report windows with extract jobs and builds their attachments.
+
+    Args:
+        bigquery_client: BigQuery client used to run the jobs.
+        gcs: Storage client used for the exported objects.
+        source_table_id: "dataset.table" to export from.
+        export_table_id: Fully qualified id prefix for the export tables.
+        windows: List of (name, days) report windows.
+        bounds: Dictionary mapping window name to its (start, end) datetimes.
+        bucket_name: Bucket the CSV files are written to.
+        file_names: Dictionary mapping window name to CSV file name.
+
     Returns:
-        Credentials to authenticate the API.
+        Tuple of dictionaries keyed by window name: statistics (always
+        empty, they come from the server), exported blobs, attachments for
+        the windows exported to a single object, and uploads (always empty).
     """
-    # Get Application Default Credentials if running in Cloud Functions
-    if os.getenv("IS_LOCAL") is None:
-        credentials, project = default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
-    # To use this file locally set IS_LOCAL=1 and populate env var GOOGLE_APPLICATION_CREDENTIALS 
-    # with path to service account json key file
+    with metrics.span("extract_export", windows=len(windows)):
+        export_blobs = extract_windows(bigquery_client, gcs, source_table_id, export_table_id,
+                                       windows, bucket_name, file_names, bounds)
+    attachments = {}
+    with metrics.span("attachments") as span:
+        for name, blobs in export_blobs.items():
+            if len(blobs) == 1:
+                attachments[name] = attachment_from_blob(blobs[0])
+        span.set(attachment_bytes=sum(attachment.size for attachment in attachments.values()))
+    return {}, export_blobs, attachments, {}
+
+def fetch_contacts(gcs, bucket_name, file_name):
+    """Loads the contacts, recording their number on the current span.
+
+    Args:
+        gcs: Storage client.
+        bucket_name: Bucket holding the contacts file.
+        file_name: Name of the contacts file.
+
+    Returns:
+        List of recipient addresses.
+    """
+    email_list = load_contacts(gcs, bucket_name, file_name)
+    metrics.current_span().set(contacts=len(email_list))
+    return email_list
+
+def attachment_from_blob(blob):
+    """Builds the email attachment from an exported blob.
+
+    The blob is read in chunks and compressed per ATTACHMENT_MODE unless it
+    is already gzip-compressed. Reading stops once the attachment passes
+    ATTACHMENT_MAX_BYTES.
+
+    Args:
+        blob: Exported CSV blob.
+
+    Returns:
+        Closed AttachmentSink.
+    """
+    blob.reload()
+    if blob.content_type == "application/gzip":
+        attachment = AttachmentSink("raw", blob.name, ATTACHMENT_MAX_BYTES)
+        attachment.file_type = blob.content_type
+    else:
+        attachment = AttachmentSink(ATTACHMENT_MODE, blob.name, ATTACHMENT_MAX_BYTES)
+    with blob.open("rb", chunk_size=UPLOAD_CHUNK_SIZE) as blob_file:
+        chunk = blob_file.read(UPLOAD_CHUNK_SIZE)
+        while chunk and not attachment.overflowed:
+            attachment.write(chunk)
+            chunk = blob_file.read(UPLOAD_CHUNK_SIZE)
+    attachment.close()
+    return attachment
+
+def format_stat(value):
+    """Formats a statistic for the email table."""
+    return "No data" if value is None else round(value, 3)
+
+def format_share(share):
+    """Formats the share of tests below a threshold for the email table."""
+    return "-" if share is None else "{:.1f}%".format(share * 100)
+
+def stats_table_html(stats):
+    """Renders the statistics table for the email body.
+
+    Shows MAX/MIN/AVG, the REPORT_PERCENTILES and the share of tests below
+    the 25/3 Mbps standard for every field.
+
+    Args:
+        stats: Dictionary mapping field name to RunningStat.
+
+    Returns:
+        HTML table as a string.
+    """
+    table = '<table cellspacing="2" cellpadding="10" bgcolor="#000000">'\
+                '<tr bgcolor="cccccc">'\
+                    '<th valign="center" align="center">Field</th>'\
+                    '<th valign="center" align="center">MAX</th>'\
+                    '<th valign="center" align="center">MIN</th>'\
+                    '<th valign="center" align="center">AVG</th>'\
+                + ''.join(f'<th valign="center" align="center">P{percentile}</th>' for percentile in REPORT_PERCENTILES) +\
+                    '<th valign="center" align="center">Below 25/3 Mbps</th>'\
+                '</tr>'
+    for i, (field, label) in enumerate(STAT_FIELDS.items()):
+        stat = stats[field]
+        has_data = stat.count > 0
+        table += f'<tr bgcolor="{"ffffff" if i % 2 == 0 else "cccccc"}">'\
+                    f'<td valign="center">{label}</td>'\
+                    f'<td valign="center" align="center">{format_stat(stat.maximum if has_data else None)}</td>'\
+                    f'<td valign="center" align="center">{format_stat(stat.minimum if has_data else None)}</td>'\
+                    f'<td valign="center" align="center">{format_stat(stat.mean)}</td>'\
+                 + ''.join(f'<td valign="center" align="center">{format_stat(stat.percentile(percentile))}</td>'
+                           for percentile in REPORT_PERCENTILES) +\
+                    f'<td valign="center" align="center">{format_share(stat.below_share)}</td>'\
+                 '</tr>'
+    return table + '</table>'
+
+def materialize_query(bigquery_client, query, destination_table_id, parameters=()):
+    """Writes the results of a query to a table which expires after a day.
+
+    Args:
+        bigquery_client: BigQuery client used to run the query.
+        query: Query to run.
+        destination_table_id: Fully qualified id of the table to write.
+        parameters: Query parameters of the query.
+
+    Returns:
+        The destination bigquery.Table.
+    """
+    job_config = bigquery.QueryJobConfig(
+        destination=destination_table_id,
+        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+        query_parameters=list(parameters),
+    )
+    query_job = bigquery_client.query(query, job_config=job_config)
+    track_job(query_job)
+    query_job.result()
+    metrics.record_job(query_job)
+    table = bigquery_client.get_table(destination_table_id)
+    table.expires = dt.datetime.now(dt.timezone.utc) + dt.timedelta(days=1)
+    return bigquery_client.update_table(table, ["expires"])
+
+def extract_export(bigquery_client, gcs, table, bucket_name, destination_file_name):
+    """Exports a table to GCS with a native BigQuery extract job.
+
+    The table is extracted as headerless CSV shards. Unless EXPORT_COMPOSE
+    is disabled the shards are composed behind a header object into a single
+    object named destination_file_name. Concatenated gzip members form a
+    valid gzip file, so this also works for GZIP compression.
+
+    Args:
+        bigquery_client: BigQuery client used to run the extract job.
+        gcs: Storage client used to compose the shards.
+        table: bigquery.Table to export, e.g. from materialize_query().
+        bucket_name: Bucket the CSV is written to.
+        destination_file_name: Name of the composed CSV object.
+
+    Returns:
+        List of the exported blobs; a single blob if the shards were composed.
+    """
+    # Extract the table as sharded CSV
+    shard_prefix = destination_file_name + ".shards/"
+    compressed = EXPORT_COMPRESSION == "GZIP"
+    extract_config = bigquery.ExtractJobConfig(
+        destination_format=bigquery.DestinationFormat.CSV,
+        compression=bigquery.Compression.GZIP if compressed else bigquery.Compression.NONE,
+        print_header=False,
+    )
+    extract_job = bigquery_client.extract_table(
+        table,
+        "gs://" + bucket_name + "/" + shard_prefix + "shard-*.csv" + (".gz" if compressed else ""),
+        job_config=extract_config,
+    )
+    track_job(extract_job)
+    extract_job.result()
+    metrics.record_job(extract_job)
+
+    bucket = gcs.bucket(bucket_name)
+    shards = sorted(gcs.list_blobs(bucket_name, prefix=shard_prefix), key=lambda blob: blob.name)
+    if not EXPORT_COMPOSE:
+        return shards
+
+    # Header row, compressed the same way as the shards
+    header = (",".join(field.name for field in table.schema) + "\r\n").encode("utf-8")
+    if compressed:
+        header = gzip.compress(header)
+    header_blob = bucket.blob(shard_prefix + "header")
+    header_blob.upload_from_string(header)
+
+    # Compose at most MAX_COMPOSE_SOURCES objects at a time, folding the
+    # running result into each following request
+    composed = bucket.blob(destination_file_name)
+    composed.content_type = "application/gzip" if compressed else "text/csv"
+    sources = [header_blob] + shards
+    composed.compose(sources[:MAX_COMPOSE_SOURCES])
+    for start in range(MAX_COMPOSE_SOURCES, len(sources), MAX_COMPOSE_SOURCES - 1):
+        composed.compose([composed] + sources[start:start + MAX_COMPOSE_SOURCES - 1])
+
+    for blob in sources:
+        blob.delete()
+    return [composed]
+
+def extract_windows(bigquery_client, gcs, source_table_id, export_table_id, windows, bucket_name, file_names,
+                    bounds):
+    """Exports every report window with extract jobs from a single scan.
+
+    With one window its export query is extracted directly. With several,
+    the widest window is written to a table once, with ROUTE_COLUMN, and
+    each window is cut from that table, so the source table is only
+    scanned once.
+
+    Args:
+        bigquery_client: BigQuery client used to run the jobs.
+        gcs: Storage client used to compose the shards.
+        source_table_id: "dataset.table" to export from.
+        export_table_id: Fully qualified id prefix for the export tables.
+        windows: List of (name, days) report windows.
+        bucket_name: Bucket the CSV files are written to.
+        file_names: Dictionary mapping window name to CSV file name.
+        bounds: Dictionary mapping window name to its (start, end) datetimes.
+
+    Returns:
+        Dictionary mapping window name to the list of exported blobs.
+    """
+    dataset_id, table_id = source_table_id.split(".")
+    if len(windows) == 1:
+        name, days = windows[0]
+        query, parameters = report_queries.export_query(dataset_id, table_id, bounds[name], **WINDOW_FILTER)
+        table = materialize_query(bigquery_client, query, export_table_id, parameters)
+        return {name: extract_export(bigquery_client, gcs, table, bucket_name, file_names[name])}
+
+    widest_bounds = (min(start for start, end in bounds.values()), max(end for start, end in bounds.values()))
+    query, parameters = report_queries.export_query(dataset_id, table_id, widest_bounds, route=True, **WINDOW_FILTER)
+    materialize_query(bigquery_client, query, export_table_id, parameters)
+    export_blobs = {}
+    for name, days in windows:
+        query, parameters = report_queries.window_query(export_table_id, bounds[name][0])
+        table = materialize_query(bigquery_client, query, export_table_id + "_" + name.replace("-", "_"), parameters)
+        export_blobs[name] = extract_export(bigquery_client, gcs, table, bucket_name, file_names[name])
+    return export_blobs
+
+def query_aggregate_stats(bigquery_client, dataset_id, table_id, windows, bounds, group_by=(), rollup_table_id=None):
+    """Computes the report statistics in BigQuery with one aggregate query.
+
+    Args:
+        bigquery_client: BigQuery client used to run the query.
+        dataset_id: BigQuery dataset holding the table.
+        table_id: BigQuery table to aggregate.
+        windows: List of (name, days) report windows.
+        bounds: Dictionary mapping window name to its (start, end) datetimes.
+        group_by: Columns to break the statistics down by.
+        rollup_table_id: Optionally the daily rollup of table_id, to read
+            the days each window covers completely from.
+
+    Returns:
+        Tuple of two dictionaries keyed by window name: the overall
+        statistics, and a dictionary mapping each group_by column to a
+        dictionary of value -> statistics.
+    """
+    if rollup_table_id:
+        query, parameters = report_queries.rollup_aggregate_query(dataset_id, rollup_table_id, table_id, windows,
+                                                                  bounds, group_by)
     else:
-        credentials = service_account.Credentials.from_service_account_file(
-            os.getenv("GOOGLE_APPLICATION_CREDENTIALS"), scopes=["https://www.googleapis.com/auth/cloud-platform"],
+        query, parameters = report_queries.aggregate_query(dataset_id, table_id, windows, bounds, group_by,
+                                                           **WINDOW_FILTER)
+    stats = {name: new_report_stats() for name, days in windows}
+    breakdowns = {name: {column: {} for column in group_by} for name, days in windows}
+    with metrics.span("stats_query", windows=len(windows), rollup=bool(rollup_table_id)) as span:
+        query_job = bigquery_client.query(query, job_config=bigquery.QueryJobConfig(query_parameters=parameters))
+        track_job(query_job)
+        for row in query_job.result():
+            if row["GroupField"] is None:
+                stats[row["Cadence"]] = stats_from_aggregate_row(row)
+            else:
+                breakdowns[row["Cadence"]][row["GroupField"]][row["GroupValue"]] = stats_from_aggregate_row(row)
+        span.record_job(query_job)
+    return stats, breakdowns
+
+def breakdowns_html(breakdowns):
+    """Renders a statistics table for every value of every breakdown column.
+
+    Args:
+        breakdowns: Dictionary mapping column to a dictionary of
+            value -> statistics, as returned by query_aggregate_stats().
+
+    Returns:
+        HTML as a string.
+    """
+    html = ''
+    for column, groups in breakdowns.items():
+        html += f'<h2>By {column}</h2>'
+        for value in sorted(groups, key=lambda value: (value is None, value)):
+            html += f'<h3>{"Unknown" if value is None else value}</h3>' + stats_table_html(groups[value])
+    return html
+
+def parse_windows(cloud_event, query_frequency):
+    """Gets the report windows requested by the Pub/Sub message.
+
+    The message body may be JSON such as {"cadences": ["daily", "weekly"]}
+    or text naming the cadences, e.g. "Sent Weekly Email". Messages naming
+    no cadence fall back to a single window of QUERY_FREQUENCY days.
+
+    Args:
+        cloud_event: CloudEvent wrapping the Pub/Sub message.
+        query_frequency: QUERY_FREQUENCY setting in days.
+
+    Returns:
+        List of (name, days) report windows.
+    """
+    message = (cloud_event.data or {}).get("message", {})
+    body = base64.b64decode(message.get("data", "")).decode("utf-8", "replace")
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        payload = None
+    if isinstance(payload, dict):
+        requested = payload.get("cadences") or [payload.get("cadence")]
+        names = [str(name).lower() for name in requested if name]
+    else:
+        names = re.findall(r"[a-z]+", body.lower())
+
+    windows = [(name, days) for name, days in report_queries.WINDOW_DAYS.items() if name in names]
+    if windows:
+        return windows
+
+    days = int(query_frequency or 1)
+    name = next((name for name, cadence_days in report_queries.WINDOW_DAYS.items() if cadence_days == days),
+                "{}-day".format(days))
+    return [(name, days)]
+
+def report_email_html(name, start, end, stats, breakdowns, export_blobs, attachment, bucket_name):
+    """Renders the body of the report email for one window.
+
+    Args:
+        name: Window name, e.g. "daily".
+        start: Time the window starts at.
+        end: Time the window ends at.
+        stats: Dictionary mapping field name to RunningStat.
+        breakdowns: Breakdown statistics as from query_aggregate_stats().
+        export_blobs: List of exported CSV blobs.
+        attachment: AttachmentSink, or None if nothing is attached.
+        bucket_name: Bucket holding the exported CSV.
+
+    Returns:
+        HTML as a string.
+    """
+    email_date_now = end.strftime("%A %B %d, %Y")
+    email_date_prev = start.strftime("%A %B %d, %Y")
+    email_body = f'<h1><em>{name.capitalize()} Report: </em>Device Broadband Data</h1><br>'\
+                 f'<strong>{email_date_prev} to {email_date_now}</strong><br>'\
+                 + stats_table_html(stats) + breakdowns_html(breakdowns)
+
+    # Link the export when it is split across several shards
+    if len(export_blobs) > 1:
+        email_body += '<h2>Export files</h2><ul>'
+        for export_blob in export_blobs:
+            email_body += f'<li><a href="https://storage.cloud.google.com/{bucket_name}/{export_blob.name}">{export_blob.name}</a></li>'
+        email_body += '</ul>'
+
+    # Link the report instead of attaching it when it is too large to send
+    if attachment is not None and attachment.overflowed:
+        url = signed_url(export_blobs[0], SIGNED_URL_HOURS)
+        email_body += f'<p>The report is too large to attach. <a href="{url}">Download the CSV export</a> '\
+                      f'(link expires in {SIGNED_URL_HOURS} hours).</p>'
+    return email_body
+
+def send_report(sg, sender_email, email_list, subject, email_body, attachment):
+    """Sends one report email to every contact.
+
+    Args:
+        sg: SendGridAPIClient.
+        sender_email: Address the email is sent from.
+        email_list: List of recipient addresses.
+        subject: Subject of the email.
+        email_body: HTML body of the email.
+        attachment: AttachmentSink to attach, or None.
+
+    Returns:
+        List of DeliveryResult of the requests that failed. Raises if
+        every request failed.
+    """
+    # Encode the attachment once; every batch reuses it
+    attachedFile = None
+    if attachment is not None and not attachment.overflowed:
+        attachedFile = Attachment(
+            FileContent(attachment.base64_content()),
+            FileName(attachment.file_name),
+            FileType(attachment.file_type),
+            Disposition('attachment')
+        )
+
+    def build_message():
+        # Create the email message; recipients are added per batch
+        message = Mail(
+            from_email=sender_email,
+            subject=subject,
+            html_content=email_body
         )
-    return credentials
+        if attachedFile is not None:
+            message.attachment = attachedFile
+        return message
+
+    # send email in concurrent batches, each recipient in its own
+    # personalization so nobody sees the other addresses
+    with metrics.span("send_report", recipients=len(email_list)) as span:
+        results = deliver(sg, build_message, email_list, DELIVERY_BATCH_SIZE, DELIVERY_CONCURRENCY,
+                          DELIVERY_RATE_PER_SECOND, DELIVERY_MAX_ATTEMPTS)
+        failed = [result for result in results if not result.ok]
+        span.set(requests=len(results), retries=sum(result.attempts - 1 for result in results),
+                 failed_recipients=sum(len(result.recipients) for result in failed),
+                 attachment_bytes=attachment.size if attachedFile is not None else 0)
+    print("Sent '{}' to {} of {} recipients in {} requests".format(
+        subject, len(email_list) - sum(len(result.recipients) for result in failed), len(email_list), len(results)))
+    for result in failed:
+        print("Failed to send to {}: {}".format(", ".join(result.recipients), result.error))
+    if failed and len(failed) == len(results):
+        raise RuntimeError("Failed to send '{}' to any recipient".format(subject))
+    return failed
 
 # Triggered from a message on a Cloud Pub/Sub topic.
 @functions_framework.cloud_event
+@metrics.traced("send_csv_email")
 def send_csv_email(cloud_event):
     # Get SendGrid API key
     sendgrid_api_key = os.getenv("SENDGRID_API_KEY")
@@ -67,117 +864,124 @@ def send_csv_email(cloud_event):
     # Set the email address you want to send the email from
     sender_email = os.getenv("SENDER_EMAIL")
 
+    # Get the report windows this message asks for; several cadences due
+    # at once are served from one scan of the widest window
+    windows = parse_windows(cloud_event, query_frequency)
+    metrics.current_span().set(windows=[name for name, days in windows], window_mode=WINDOW_MODE,
+                               report_mode=REPORT_MODE, export_mode=EXPORT_MODE, stats_mode=STATS_MODE)
+
     # Get the current time
     now = dt.datetime.now()
+    now_utc = dt.datetime.now(dt.timezone.utc)
 
     # Format the time into a string
     timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
-    destination_file_name = timestamp + ".bq_export" + ".csv"
+    file_names = {name: timestamp + "." + name + ".bq_export" + ".csv" for name, days in windows}
 
-    # Initialize a client for BigQuery
-    bigquery_client = bigquery.Client(credentials=credentials())
-    
-    # Query the data you want to export
-    # Below is the query that will export data a a given time interval
-    query = "SELECT TestStartTime,ClientIP,ClientLat,ClientLon,DownloadValue,DownloadUnit,UploadValue,UploadUnit,Ping,PingUnit,ServerLatency,ServerLatencyUnit,Isp,IspDownloadAvg,IspUploadAvg FROM `" + dataset_id + "." + table_id + "` WHERE Timestamp > TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL " + str(query_frequency) + " DAY)"
-    query_job = bigquery_client.query(query)
-    results = query_job.result()
+    # Get the instance-wide clients for BigQuery and GCS
+    bigquery_client = clients.bigquery_client()
+    gcs = clients.storage_client()
 
-    # Write the results to a CSV file
-    csv_file = io.StringIO()
-    writer = csv.writer(csv_file)
+    # Run the stages of the report that do not depend on each other at the
+    # same time: the contacts download, the statistics queries and the
+    # export all start straight away and are only waited for when their
+    # result is needed. A stage failing or running for longer than
+    # STAGE_TIMEOUT_SECONDS aborts the others.
+    with Pipeline(STAGE_TIMEOUT_SECONDS, PIPELINE_WORKERS) as stages:
+        # Get the list of contacts, reusing the parsed list from a previous
+        # invocation if contacts.csv has not changed since
+        contacts_stage = stages.submit("load_contacts", fetch_contacts, gcs, contacts_bucket, contacts_file_name)
 
-    # Write header row
-    header = [field.name for field in results.schema]
-    writer.writerow(header)
-    
-    # Statistics
-    num_records = 0
-    downloads = list()
-    uploads = list()
-    pings = list()
+        # Get the start and end of every window, which every query selects
+        # through its parameters. Rolling windows are the n days up to the last
+        # multiple of WINDOW_ALIGN_MINUTES; watermark windows start after the
+        # load time of the last test already reported.
+        aligned_end = report_queries.align_time(now_utc, WINDOW_ALIGN_MINUTES)
+        bounds = {name: (aligned_end - dt.timedelta(days=days), aligned_end) for name, days in windows}
+        watermarks = {}
+        if WINDOW_MODE == "watermark":
+            end = now_utc - dt.timedelta(minutes=WATERMARK_LAG_MINUTES)
+            with metrics.span("load_watermarks"):
+                for name, days in windows:
+                    watermarks[name] = load_watermark(gcs.bucket(bucket_name), watermark_name(dataset_id, table_id, name))
+                    start = watermarks[name].value or end - dt.timedelta(days=days)
+                    # Never move a watermark backwards, e.g. after WATERMARK_LAG_MINUTES grows
+                    bounds[name] = (start, max(start, end))
 
-    # Write data rows
-    for row in results:
-        writer.writerow(list(row.values()))
-        num_records += 1
-        downloads.append(row["DownloadValue"])
-        uploads.append(row["UploadValue"])
-        pings.append(row["Ping"])
-
-    # Upload the CSV file with the query to a bucket in GCS
-    gcs = storage.Client(credentials=credentials())
-    bucket = gcs.bucket(bucket_name)
-    blob = bucket.blob(destination_file_name)
-    blob.upload_from_string(csv_file.getvalue(), content_type='text/csv')
-
-    # Get the contacts.csv file from the bucket
-    bucket = gcs.bucket(contacts_bucket)
-    blob = bucket.blob(contacts_file_name)
-    csv_data = blob.download_as_string()
-
-    # Parse the CSV data and extract email addresses
-    email_list = []
-    csv_lines = csv_data.decode().splitlines()
-    csv_reader = csv.reader(csv_lines)
-    next(csv_reader)
-    for row in csv_reader:
-        email_list.append(row[0])
-
-    # Create the body of the email
-    email_date_now = now.strftime("%A %B %d, %Y")
-    email_date_prev = (now - dt.timedelta(days=1)).strftime("%A %B %d, %Y")
-    email_body = '<h1><em>Daily Report: </em>Device Broadband Data</h1><br>'\
-                f'<strong>{email_date_prev} to {email_date_now}</strong><br>'\
-                 '<table cellspacing="2" cellpadding="10" bgcolor="#000000">'\
-                    '<tr bgcolor="cccccc">'\
-                         '<th valign="center" align="center">Field</th>'\
-                         '<th valign="center" align="center">MAX</th>'\
-                         '<th valign="center" align="center">MIN</th>'\
-                         '<th valign="center" align="center">AVG</th>'\
-                    '</tr>'\
-                    '<tr bgcolor="ffffff">'\
-                         '<td valign="center">Download Value (bps)</td>'\
-                        f'<td valign="center" align="center">{"No data" if len(downloads) == 0 else round(max(downloads), 3)}</td>'\
-                        f'<td valign="center" align="center">{"No data" if len(downloads) == 0 else round(min(downloads), 3)}</td>'\
-                        f'<td valign="center" align="center">{"No data" if len(downloads) == 0 else round(sum(downloads)/len(downloads), 3)}</td>'\
-                    '</tr>'\
-                    '<tr bgcolor="cccccc">'\
-                         '<td valign="center">Upload Value (bps)</td>'\
-                        f'<td valign="center" align="center">{"No data" if len(uploads) == 0 else round(max(uploads), 3)}</td>'\
-                        f'<td valign="center" align="center">{"No data" if len(uploads) == 0 else round(min(uploads), 3)}</td>'\
-                        f'<td valign="center" align="center">{"No data" if len(uploads) == 0 else round(sum(uploads)/len(uploads), 3)}</td>'\
-                    '</tr>'\
-                    '<tr bgcolor="ffffff">'\
-                         '<td valign="center">Ping Time (ms)</td>'\
-                        f'<td valign="center" align="center">{"No data" if len(pings) == 0 else round(max(pings), 3)}</td>'\
-                        f'<td valign="center" align="center">{"No data" if len(pings) == 0 else round(min(pings), 3)}</td>'\
-                        f'<td valign="center" align="center">{"No data" if len(pings) == 0 else round(sum(pings)/len(pings), 3)}</td>'\
-                    '</tr>'\
-                '</table>'
-
-    # Create the email message
-    message = Mail(
-        from_email=sender_email,
-        to_emails=email_list,
-        subject='Daily Report: Device Broadband Data',
-        html_content=email_body
-    )
+        # Compute the statistics in BigQuery if requested, so the email does not
+        # depend on reading every row back. Summary reports never read the rows.
+        server_stats = STATS_MODE == "server" or REPORT_MODE == "summary" or EXPORT_MODE == "extract"
+        stats_stages = []
 
-    # Encode the contents of the csv file as Base64
-    base64_encoded = base64.b64encode(csv_file.getvalue().encode("utf-8")).decode("utf-8")
+        # Long windows always read their statistics from the daily rollup
+        # (the rollup holds whole days, so watermark windows never use it)
+        rollup_windows = [(name, days) for name, days in windows
+                          if ROLLUP_TABLE_ID and days >= ROLLUP_MIN_DAYS and WINDOW_MODE != "watermark"]
+        if rollup_windows:
+            stats_stages.append(stages.submit(
+                "rollup_stats", query_aggregate_stats, bigquery_client, dataset_id, table_id, rollup_windows,
+                bounds, STATS_GROUP_BY, rollup_table_id=ROLLUP_TABLE_ID))
+        raw_windows = [window for window in windows if window not in rollup_windows]
+        if server_stats and raw_windows:
+            stats_stages.append(stages.submit(
+                "raw_stats", query_aggregate_stats, bigquery_client, dataset_id, table_id, raw_windows,
+                bounds, STATS_GROUP_BY))
 
-    # create email attachment and add it to the email message
-    attachedFile = Attachment(
-        FileContent(base64_encoded),
-        FileName(destination_file_name),
-        FileType('text/csv'),
-        Disposition('attachment')
-    )
-    message.attachment = attachedFile
+        export_stage = None
+        if REPORT_MODE != "summary" and EXPORT_MODE == "extract":
+            # Let BigQuery write the CSV to the bucket; the function never sees the rows
+            if EXPORT_COMPRESSION == "GZIP":
+                file_names = {name: file_name + ".gz" for name, file_name in file_names.items()}
+            export_table_id = project_id + "." + dataset_id + "." + table_id + "_export_" + now.strftime("%Y%m%d%H%M%S")
+            export_stage = stages.submit("export", extract_report, bigquery_client, gcs, dataset_id + "." + table_id,
+                                         export_table_id, windows, bounds, bucket_name, file_names)
+        elif REPORT_MODE != "summary":
+            # Stream the export query into a CSV file in the bucket in GCS and
+            # into a compressed attachment per window
+            export_stage = stages.submit("export", stream_report, bigquery_client, gcs.bucket(bucket_name), dataset_id,
+                                         table_id, windows, bounds, file_names)
+
+        # Collect the statistics and the export as they finish
+        stats = {}
+        breakdowns = {name: {} for name, days in windows}
+        for stage in stats_stages:
+            stage_stats, stage_breakdowns = stages.result(stage)
+            stats.update(stage_stats)
+            breakdowns.update(stage_breakdowns)
+        export_blobs = {name: [] for name, days in windows}
+        attachments = {}
+        uploads = {}
+        if export_stage is not None:
+            local_stats, export_blobs, attachments, uploads = stages.result(export_stage)
+            for name, window_stats in local_stats.items():
+                stats.setdefault(name, window_stats)
+
+        # Render every email while the CSV uploads are finishing
+        email_bodies = {}
+        with metrics.span("render_emails"):
+            for name, days in windows:
+                start, end = bounds[name]
+                email_bodies[name] = report_email_html(name, start, end, stats[name], breakdowns[name],
+                                                       export_blobs[name], attachments.get(name), bucket_name)
+
+        # The emails link the uploaded CSV, so wait for every upload first
+        email_list = stages.result(contacts_stage)
+        for upload in uploads.values():
+            stages.result(upload)
 
+        # Send one report per window, one window at a time so DELIVERY_RATE_PER_SECOND holds
+        sg = clients.sendgrid_client(sendgrid_api_key)
+        for name, days in windows:
+            start, end = bounds[name]
+            subject = f'{name.capitalize()} Report: Device Broadband Data'
+            failed = stages.result(stages.submit("send_" + name.replace("-", "_"), send_report, sg, sender_email,
+                                                 email_list, subject, email_bodies[name], attachments.get(name)))
 
-    # send email
-    sg = SendGridAPIClient(sendgrid_api_key)
-    response = sg.send(message)
-    print(response.status_code, response.body, response.headers)
\ No newline at end of file
+            # The window has been uploaded and emailed to everyone; the next
+            # run starts after it. Otherwise the next run reports it again.
+            if name in watermarks and end > start:
+                if failed:
+                    print("Not advancing the {} watermark: the report was not sent to every recipient".format(name))
+                    continue
+                with metrics.span("save_watermark", window=name):
+                    save_watermark(watermarks[name], end)
@@ -0,0 +1,355 @@
+import io
+import queue
+import threading
+import time
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import metrics
+
+_local = threading.local()
+
+# Seconds between checks of the stage deadlines while waiting on a stage
+POLL_SECONDS = 0.5
+
+
+class PipelineAborted(Exception):
+    """Raised in the stages still running after another stage failed or timed out."""
+
+
+class StageTimeoutError(Exception):
+    """Raised when a stage runs for longer than the pipeline's stage timeout.
+
+    Args:
+        stage: Name of the stage.
+        timeout: Stage timeout in seconds.
+    """
+
+    def __init__(self, stage, timeout):
+        super().__init__("Stage {} did not finish within {:g} seconds".format(stage, timeout))
+        self.stage = stage
+        self.timeout = timeout
+
+
+class _Stage:
+    def __init__(self, name):
+        self.name = name
+        self.started = None
+
+
+class Pipeline:
+    """Runs the independent stages of a report at the same time.
+
+    Every stage runs on a worker thread, or with start() on a thread of its
+    own, in its own metrics span, nested under the span that created the
+    pipeline. Waiting on a stage also
+    watches every other stage: when one fails or runs for longer than
+    timeout seconds, the pipeline is aborted. Stages not yet started are
+    cancelled, BigQuery jobs registered with track_job() are cancelled and
+    running stages raise PipelineAborted at their next check().
+
+    Args:
+        timeout: Seconds a stage may run; 0 for no limit.
+        max_workers: Stages submitted with submit() running at the same time.
+    """
+
+    def __init__(self, timeout=0, max_workers=16):
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="report-stage")
+        self._parent = metrics.current_span()
+        self._stages = {}
+        self._jobs = []
+        self._threads = []
+        self._lock = threading.Lock()
+        self._aborted = threading.Event()
+        self._error = None
+
+    @property
+    def aborted(self):
+        return self._aborted.is_set()
+
+    def submit(self, name, function, *args, **kwargs):
+        """Starts a stage.
+
+        Args:
+            name: Stage name, used for its span and in errors.
+            function: Callable running the stage.
+            *args: Positional arguments of function.
+            **kwargs: Keyword arguments of function.
+
+        Returns:
+            concurrent.futures.Future of the stage's result.
+        """
+        self.check()
+        stage = _Stage(name)
+        future = self._executor.submit(self._run, stage, function, args, kwargs)
+        with self._lock:
+            self._stages[future] = stage
+        return future
+
+    def start(self, name, function, *args, **kwargs):
+        """Starts a stage on a thread of its own instead of a worker.
+
+        Use it for stages that wait on other stages, such as the drain of a
+        BackgroundWriter. On a worker, such a stage may be queued behind the
+        very stages that wait for it, and with every worker taken the
+        pipeline deadlocks. The stage is watched and aborted like any other.
+
+        Args:
+            name: Stage name, used for its span and in errors.
+            function: Callable running the stage.
+            *args: Positional arguments of function.
+            **kwargs: Keyword arguments of function.
+
+        Returns:
+            concurrent.futures.Future of the stage's result.
+        """
+        self.check()
+        stage = _Stage(name)
+        future = Future()
+
+        def run():
+            # The stage may have been cancelled by an abort before it ran
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                result = self._run(stage, function, args, kwargs)
+            except BaseException as error:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+        thread = threading.Thread(target=run, name="report-stage-" + name, daemon=True)
+        with self._lock:
+            self._stages[future] = stage
+            self._threads.append(thread)
+        thread.start()
+        return future
+
+    def result(self, future):
+        """Waits for a stage and returns its result.
+
+        Args:
+            future: Future returned by submit().
+
+        Returns:
+            The stage's result. Raises the stage's exception, or
+            StageTimeoutError, after aborting the pipeline.
+        """
+        while True:
+            self._watch()
+            try:
+                return future.result(timeout=POLL_SECONDS)
+            except FutureTimeoutError:
+                continue
+            except CancelledError:
+                raise self._error or PipelineAborted("Stage {} was cancelled".format(self._stages[future].name))
+            except BaseException as error:
+                self.abort(error)
+                raise
+
+    def check(self):
+        """Raises PipelineAborted if the pipeline has been aborted; stages call it between steps."""
+        if self._aborted.is_set():
+            raise PipelineAborted("Report pipeline aborted: {}".format(self._error))
+
+    def track_job(self, job):
+        """Registers a running BigQuery job to cancel if the pipeline is aborted."""
+        with self._lock:
+            self._jobs.append(job)
+        if self._aborted.is_set():
+            self._cancel_jobs()
+
+    def abort(self, error):
+        """Aborts the pipeline, cancelling the stages not yet finished.
+
+        Args:
+            error: Exception that caused the abort.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            if self._aborted.is_set():
+                return
+            self._error = error
+            self._aborted.set()
+            futures = list(self._stages)
+        for future in futures:
+            future.cancel()
+        self._cancel_jobs()
+        print("Aborted the report pipeline: {}".format(error))
+
+    def close(self):
+        """Waits for the running stages unless the pipeline was aborted, then stops the workers."""
+        self._executor.shutdown(wait=not self._aborted.is_set(), cancel_futures=True)
+        if not self._aborted.is_set():
+            with self._lock:
+                threads = list(self._threads)
+            for thread in threads:
+                thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_value is not None:
+            self.abort(exc_value)
+        self.close()
+
+    def _run(self, stage, function, args, kwargs):
+        stage.started = time.monotonic()
+        _local.pipeline = self
+        try:
+            self.check()
+            with metrics.span(stage.name, parent=self._parent):
+                return function(*args, **kwargs)
+        finally:
+            _local.pipeline = None
+
+    def _watch(self):
+        # Abort when any stage failed or overran, whichever stage is waited on
+        now = time.monotonic()
+        with self._lock:
+            stages = list(self._stages.items())
+        for future, stage in stages:
+            if future.done() and not future.cancelled() and future.exception() is not None:
+                error = future.exception()
+                self.abort(error)
+                raise error
+            if self.timeout and not future.done() and stage.started is not None \
+                    and now - stage.started > self.timeout:
+                error = StageTimeoutError(stage.name, self.timeout)
+                self.abort(error)
+                raise error
+        self.check()
+
+    def _cancel_jobs(self):
+        with self._lock:
+            jobs, self._jobs = self._jobs, []
+        for job in jobs:
+            try:
+                job.cancel()
+            except Exception as error:
+                print("Could not cancel job {}: {}".format(getattr(job, "job_id", None), error))
+
+
+def current_pipeline():
+    """Gets the pipeline running the current thread's stage, or None."""
+    return getattr(_local, "pipeline", None)
+
+
+def track_job(job):
+    """Registers a running BigQuery job with the current stage's pipeline, if any."""
+    pipeline = current_pipeline()
+    if pipeline is not None:
+        pipeline.track_job(job)
+
+
+class BackgroundWriter(io.RawIOBase):
+    """Binary sink handing what is written to another sink on a pipeline stage.
+
+    Writes are gathered into chunks of chunk_size bytes and queued; the
+    stage, started with Pipeline.start() so it never waits for a worker
+    held by the writer, writes them to the sink and closes it, so e.g. a GCS upload runs
+    while the next rows are read and compressed. At most max_chunks chunks
+    wait in the queue, which bounds memory and slows the writer down to
+    the speed of the upload. close() does not wait for the upload; wait on
+    the stage's future instead.
+
+    The sink is only closed once close() has queued everything. When the
+    writer is aborted with abort(), or the stage fails or the pipeline is
+    aborted, the sink is handed to discard instead, so e.g. a partial GCS
+    upload is cancelled rather than saved.
+
+    Args:
+        pipeline: Pipeline to run the stage on.
+        name: Stage name.
+        sink: Writable binary file-like object.
+        chunk_size: Bytes per queued chunk.
+        max_chunks: Most chunks waiting to be written.
+        discard: Callable given the sink when it is not to be closed; None
+            to leave it as it is.
+    """
+
+    def __init__(self, pipeline, name, sink, chunk_size, max_chunks=2, discard=None):
+        self._pipeline = pipeline
+        self._sink = sink
+        self._chunk_size = chunk_size
+        self._discard = discard
+        self._buffer = bytearray()
+        self._queue = queue.Queue(maxsize=max(1, max_chunks))
+        self._aborted = threading.Event()
+        self.future = pipeline.start(name, self._drain)
+        # A stage cancelled by an abort before it ran never sees the sink
+        self.future.add_done_callback(lambda future: future.cancelled() and self._discard_sink())
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) >= self._chunk_size:
+            self._put(bytes(self._buffer))
+            self._buffer = bytearray()
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            if self._buffer:
+                self._put(bytes(self._buffer))
+                self._buffer = bytearray()
+            self._put(None)
+        super().close()
+
+    def abort(self):
+        """Stops the stage without closing the sink and waits for it to stop.
+
+        What was written but not yet handed to the sink is dropped, and the
+        sink is given to discard. Closing the writer afterwards does nothing.
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+        self._aborted.set()
+        self._buffer = bytearray()
+        super().close()
+        wait([self.future])
+
+    def _put(self, chunk):
+        # Wait for room in the queue, giving up if the upload stage failed
+        while True:
+            self._pipeline.check()
+            if self.future.done() and self.future.exception() is not None:
+                raise self.future.exception()
+            try:
+                self._queue.put(chunk, timeout=POLL_SECONDS)
+                return
+            except queue.Full:
+                continue
+
+    def _drain(self):
+        span = metrics.current_span()
+        try:
+            while not self._aborted.is_set():
+                try:
+                    chunk = self._queue.get(timeout=POLL_SECONDS)
+                except queue.Empty:
+                    self._pipeline.check()
+                    continue
+                if chunk is None:
+                    self._sink.close()
+                    return
+                self._pipeline.check()
+                self._sink.write(chunk)
+                span.add("bytes", len(chunk))
+        except BaseException:
+            self._discard_sink()
+            raise
+        self._discard_sink()
+
+    def _discard_sink(self):
+        if self._discard is not None:
+            self._discard(self._sink)
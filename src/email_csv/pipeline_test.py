@@ -0,0 +1,64 @@
+import pytest
+
+from pipeline import BackgroundWriter, Pipeline
+
+
+class FakeSink:
+    """Sink recording what reaches it and whether it was closed or discarded."""
+
+    def __init__(self):
+        self.data = b""
+        self.closed = False
+        self.discarded = False
+
+    def write(self, data):
+        self.data += data
+        return len(data)
+
+    def close(self):
+        self.closed = True
+
+
+def discard(sink):
+    sink.discarded = True
+
+
+def test_close_writes_everything_and_closes_the_sink():
+    sink = FakeSink()
+    with Pipeline() as stages:
+        writer = BackgroundWriter(stages, "upload", sink, chunk_size=4, discard=discard)
+        writer.write(b"abcdef")
+        writer.write(b"gh")
+        writer.close()
+        stages.result(writer.future)
+
+    assert sink.data == b"abcdefgh"
+    assert sink.closed
+    assert not sink.discarded
+
+
+def test_abort_discards_the_sink_without_closing_it():
+    sink = FakeSink()
+    with Pipeline() as stages:
+        writer = BackgroundWriter(stages, "upload", sink, chunk_size=4, discard=discard)
+        writer.write(b"abcdef")
+        writer.abort()
+        # Closing after an abort must not finish the sink
+        writer.close()
+        assert writer.future.done()
+
+    assert sink.discarded
+    assert not sink.closed
+
+
+def test_failed_pipeline_discards_the_sink():
+    sink = FakeSink()
+    with pytest.raises(ValueError):
+        with Pipeline() as stages:
+            writer = BackgroundWriter(stages, "upload", sink, chunk_size=4, discard=discard)
+            writer.write(b"abcdef")
+            raise ValueError("export failed")
+    writer.future.exception()
+
+    assert sink.discarded
+    assert not sink.closed
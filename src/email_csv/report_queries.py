@@ -0,0 +1,267 @@
+import datetime as dt
+import re
+from google.cloud import bigquery
+from query_builder import EXPORT_COLUMNS, WINDOW_DAYS, table_reference
+from stats import REPORT_PERCENTILES, STAT_FIELDS, STAT_THRESHOLDS
+
+# Columns the aggregate statistics may be broken down by
+GROUP_BY_COLUMNS = ["Isp", "MurakamiLocation"]
+
+# Extra column carrying each row's Timestamp when one export query serves
+# several report windows; rows are routed on it and it is not exported
+ROUTE_COLUMN = "ReportTimestamp"
+
+# Column BigQuery fills with the time each test was loaded. Watermark
+# windows select tests by it, so tests uploaded late are still reported.
+INGESTED_COLUMN = "IngestedAt"
+
+# Accuracy of the quantile sketches built for the partial days of rollup
+# windows, as export_to_bq/rollups.py builds the rollup's
+KLL_PRECISION = 1000
+
+
+def align_time(value, minutes):
+    """Rounds a timezone-aware datetime down to a multiple of `minutes` since the epoch.
+
+    Reports run within the same interval then query the same window, so
+    BigQuery can answer repeated queries from its result cache.
+
+    Args:
+        value: Timezone-aware datetime.
+        minutes: Interval to align to; 0 leaves the value unchanged.
+
+    Returns:
+        UTC datetime.
+    """
+    seconds = int(minutes * 60)
+    if seconds <= 0:
+        return value.astimezone(dt.timezone.utc)
+    return dt.datetime.fromtimestamp(int(value.timestamp()) // seconds * seconds, dt.timezone.utc)
+
+def timestamp_parameter(name, value):
+    """Builds a named TIMESTAMP query parameter from a timezone-aware datetime."""
+    return bigquery.ScalarQueryParameter(name, "TIMESTAMP", value.astimezone(dt.timezone.utc))
+
+def range_filter(start="start", end="end", column="Timestamp", late_days=None):
+    """Builds the condition selecting tests after @start, up to and including @end.
+
+    Args:
+        start: Name of the TIMESTAMP parameter rows must be after.
+        end: Name of the TIMESTAMP parameter rows must be at or before.
+        column: Timestamp column to filter on.
+        late_days: Optionally also only select tests taken at most this
+            many days before @start, so that filtering on another column
+            than Timestamp still only scans the recent partitions.
+
+    Returns:
+        Condition as a string.
+    """
+    condition = "{0} > @{1} AND {0} <= @{2}".format(column, start, end)
+    if late_days is not None:
+        condition += " AND Timestamp > TIMESTAMP_SUB(@{}, INTERVAL {} DAY)".format(start, int(late_days))
+    return condition
+
+def export_query(dataset_id, table_id, bounds, route=False, column="Timestamp", late_days=None):
+    """Builds the query returning every test row in the reporting window.
+
+    Args:
+        dataset_id: BigQuery dataset holding the table.
+        table_id: BigQuery table to export.
+        bounds: (start, end) datetimes of the reporting window.
+        route: Also select column as ROUTE_COLUMN, last, so the rows can
+            be split between several narrower windows.
+        column: Timestamp column the window applies to, e.g. INGESTED_COLUMN.
+        late_days: Passed to range_filter().
+
+    Returns:
+        Tuple of the query string and its list of query parameters.
+    """
+    columns = EXPORT_COLUMNS + ([column + " AS " + ROUTE_COLUMN] if route else [])
+    query = "SELECT " + ",".join(columns) + " FROM " + table_reference(dataset_id, table_id) +\
+        " WHERE " + range_filter(column=column, late_days=late_days)
+    return query, [timestamp_parameter("start", bounds[0]), timestamp_parameter("end", bounds[1])]
+
+def window_query(base_table_id, start):
+    """Builds the query cutting one report window out of a routed export table.
+
+    Args:
+        base_table_id: Fully qualified id of a table written from
+            export_query(..., route=True).
+        start: Datetime the window starts after.
+
+    Returns:
+        Tuple of the query string and its list of query parameters.
+    """
+    query = "SELECT * EXCEPT(" + ROUTE_COLUMN + ") FROM " + table_reference(base_table_id) +\
+        " WHERE " + ROUTE_COLUMN + " > @start"
+    return query, [timestamp_parameter("start", start)]
+
+def _window_structs(windows):
+    """Builds the list of report window structs, one per (name, fields) pair."""
+    # Window names are cadence names or "<n>-day"
+    for name, fields in windows:
+        if not re.fullmatch(r"[\w-]+", name):
+            raise ValueError("Invalid report window name {}".format(name))
+    return ", ".join("STRUCT('{}' AS Name, {})".format(name, fields) for name, fields in windows)
+
+def _windowed_aggregate_query(source, windows, group_by, aggregates, scan_filter, in_window):
+    """Builds a GROUPING SETS query aggregating several report windows at once.
+
+    Args:
+        source: Backquoted table, or aliased subquery, to read.
+        windows: List of (name, fields) pairs, where fields are the
+            "<expression> AS <name>" struct fields describing the window.
+        group_by: Columns from GROUP_BY_COLUMNS to break the statistics down by.
+        aggregates: List of "<expression> AS <name>" select items.
+        scan_filter: Condition selecting the rows of every window, to prune
+            the scan.
+        in_window: Condition selecting the rows in report_window.
+
+    Returns:
+        Query string.
+    """
+    for column in group_by:
+        if column not in GROUP_BY_COLUMNS:
+            raise ValueError("Cannot group report statistics by {}".format(column))
+
+    # Name of the grouping column (NULL on the overall row) and its value
+    group_field = "CAST(NULL AS STRING)"
+    group_value = "CAST(NULL AS STRING)"
+    for column in reversed(group_by):
+        group_field = "IF(GROUPING({0}) = 0, '{0}', {1})".format(column, group_field)
+        group_value = "IF(GROUPING({0}) = 0, CAST({0} AS STRING), {1})".format(column, group_value)
+
+    grouping_sets = ", ".join(["(Cadence)"] + ["(Cadence, {})".format(column) for column in group_by])
+    return "SELECT report_window.Name AS Cadence, " + group_field + " AS GroupField, " + group_value + " AS GroupValue, " +\
+        ", ".join(aggregates) +\
+        " FROM " + source + " CROSS JOIN UNNEST([" + _window_structs(windows) + "]) AS report_window" +\
+        " WHERE " + scan_filter + " AND " + in_window +\
+        " GROUP BY GROUPING SETS (" + grouping_sets + ")"
+
+def aggregate_query(dataset_id, table_id, windows, bounds, group_by=(), column="Timestamp", late_days=None):
+    """Builds a single aggregate query for the report statistics.
+
+    The table is scanned once for the widest window and every row is
+    counted towards each window it falls in. For each window one row is
+    returned for the whole window plus one row for each value of every
+    column in group_by. Cadence names the window; GroupField and GroupValue
+    are NULL on the overall row.
+
+    Args:
+        dataset_id: BigQuery dataset holding the table.
+        table_id: BigQuery table to aggregate.
+        windows: List of (name, days) report windows.
+        bounds: Dictionary mapping window name to its (start, end) datetimes.
+        group_by: Columns from GROUP_BY_COLUMNS to break the statistics down by.
+        column: Timestamp column the windows apply to, e.g. INGESTED_COLUMN.
+        late_days: Passed to range_filter().
+
+    Returns:
+        Tuple of the query string and its list of query parameters.
+    """
+    aggregates = []
+    for field in STAT_FIELDS:
+        aggregates += [
+            "COUNT({0}) AS {0}_count".format(field),
+            "SUM({0}) AS {0}_sum".format(field),
+            "MIN({0}) AS {0}_min".format(field),
+            "MAX({0}) AS {0}_max".format(field),
+        ]
+        # BigQuery's approximate quantiles have about 1% error
+        for percentile in REPORT_PERCENTILES:
+            aggregates.append("APPROX_QUANTILES({0}, 100)[OFFSET({1})] AS {0}_p{1}".format(field, percentile))
+        if field in STAT_THRESHOLDS:
+            aggregates.append("COUNTIF({0} < {1}) AS {0}_below".format(field, STAT_THRESHOLDS[field]))
+    source = table_reference(dataset_id, table_id)
+
+    # Window i runs from @start_i to @end_i; the scan covers all of them
+    struct_windows = [(name, "@start_{0} AS StartTime, @end_{0} AS EndTime".format(i))
+                      for i, (name, days) in enumerate(windows)]
+    parameters = [timestamp_parameter("scan_start", min(bounds[name][0] for name, days in windows)),
+                  timestamp_parameter("scan_end", max(bounds[name][1] for name, days in windows))]
+    for i, (name, days) in enumerate(windows):
+        parameters += [timestamp_parameter("start_{}".format(i), bounds[name][0]),
+                       timestamp_parameter("end_{}".format(i), bounds[name][1])]
+    query = _windowed_aggregate_query(source, struct_windows, group_by, aggregates,
+                                      range_filter("scan_start", "scan_end", column, late_days),
+                                      "{0} > report_window.StartTime AND {0} <= report_window.EndTime".format(column))
+    return query, parameters
+
+def rollup_aggregate_query(dataset_id, rollup_table_id, table_id, windows, bounds, group_by=()):
+    """Builds the aggregate query for the report statistics from the daily rollup.
+
+    Returns the same rows as aggregate_query() for the same windows, with
+    the percentiles merged from quantile sketches. The days a window covers
+    completely are read from the rollup, one row per day and group instead
+    of every test. The partial days it starts and ends on are aggregated
+    from the tests in the window, so the statistics cover exactly the
+    tests in the exported CSV.
+
+    Args:
+        dataset_id: BigQuery dataset holding both tables.
+        rollup_table_id: Rollup table written by export_to_bq/rollups.py.
+        table_id: BigQuery table of the tests the rollup is built from.
+        windows: List of (name, days) report windows.
+        bounds: Dictionary mapping window name to its (start, end) datetimes.
+        group_by: Columns from GROUP_BY_COLUMNS to break the statistics down by.
+
+    Returns:
+        Tuple of the query string and its list of query parameters.
+    """
+    day_aggregates = []
+    aggregates = []
+    for field in STAT_FIELDS:
+        day_aggregates += [
+            "COUNT({0}) AS {0}_count".format(field),
+            "SUM({0}) AS {0}_sum".format(field),
+            "MIN({0}) AS {0}_min".format(field),
+            "MAX({0}) AS {0}_max".format(field),
+            "KLL_QUANTILES.INIT_FLOAT64({0}, {1}) AS {0}_sketch".format(field, KLL_PRECISION),
+        ]
+        aggregates += [
+            "SUM({0}_count) AS {0}_count".format(field),
+            "SUM({0}_sum) AS {0}_sum".format(field),
+            "MIN({0}_min) AS {0}_min".format(field),
+            "MAX({0}_max) AS {0}_max".format(field),
+        ]
+        for percentile in REPORT_PERCENTILES:
+            aggregates.append("KLL_QUANTILES.MERGE_POINT_FLOAT64({0}_sketch, {1}) AS {0}_p{2}".format(
+                field, percentile / 100, percentile))
+        if field in STAT_THRESHOLDS:
+            day_aggregates.append("COUNTIF({0} < {1}) AS {0}_below".format(field, STAT_THRESHOLDS[field]))
+            aggregates.append("SUM({0}_below) AS {0}_below".format(field))
+    columns = ", ".join(GROUP_BY_COLUMNS + [aggregate.rsplit(" AS ", 1)[1] for aggregate in day_aggregates])
+
+    # Window i runs from @start_i to @end_i, as in aggregate_query()
+    struct_windows = [(name, "@start_{0} AS StartTime, @end_{0} AS EndTime".format(i))
+                      for i, (name, days) in enumerate(windows)]
+    parameters = [timestamp_parameter("scan_start", min(bounds[name][0] for name, days in windows)),
+                  timestamp_parameter("scan_end", max(bounds[name][1] for name, days in windows))]
+    for i, (name, days) in enumerate(windows):
+        parameters += [timestamp_parameter("start_{}".format(i), bounds[name][0]),
+                       timestamp_parameter("end_{}".format(i), bounds[name][1])]
+
+    # Only the partitions of the days windows start or end on are scanned
+    edge_days = sorted({bound.astimezone(dt.timezone.utc).date() for name, days in windows for bound in bounds[name]})
+    edge_filter = " OR ".join("(Timestamp >= @edge_{0} AND Timestamp < TIMESTAMP_ADD(@edge_{0}, INTERVAL 1 DAY))".format(i)
+                              for i in range(len(edge_days)))
+    parameters += [timestamp_parameter("edge_{}".format(i), dt.datetime.combine(day, dt.time(), dt.timezone.utc))
+                   for i, day in enumerate(edge_days)]
+
+    # Whole days come from the rollup and belong to every window covering
+    # them; partial days are aggregated per window, which EdgeWindow names
+    source = "(SELECT Day, CAST(NULL AS STRING) AS EdgeWindow, " + columns +\
+        " FROM " + table_reference(dataset_id, rollup_table_id) +\
+        " WHERE Day > DATE(@scan_start) AND Day < DATE(@scan_end)" +\
+        " UNION ALL SELECT DATE(Timestamp) AS Day, edge_window.Name AS EdgeWindow, " +\
+        ", ".join(GROUP_BY_COLUMNS + day_aggregates) +\
+        " FROM " + table_reference(dataset_id, table_id) +\
+        " CROSS JOIN UNNEST([" + _window_structs(struct_windows) + "]) AS edge_window" +\
+        " WHERE (" + edge_filter + ") AND Timestamp > edge_window.StartTime AND Timestamp <= edge_window.EndTime" +\
+        " AND DATE(Timestamp) IN (DATE(edge_window.StartTime), DATE(edge_window.EndTime))" +\
+        " GROUP BY " + ", ".join(["Day", "EdgeWindow"] + GROUP_BY_COLUMNS) + ") AS days"
+    query = _windowed_aggregate_query(source, struct_windows, group_by, aggregates,
+                                      "Day >= DATE(@scan_start) AND Day <= DATE(@scan_end)",
+                                      "IF(EdgeWindow IS NULL, Day > DATE(report_window.StartTime) AND " +
+                                      "Day < DATE(report_window.EndTime), EdgeWindow = report_window.Name)")
+    return query, parameters
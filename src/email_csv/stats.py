@@ -0,0 +1,281 @@
+import math
+
+# Fields summarised in the email statistics table, with their display labels
+STAT_FIELDS = {
+    "DownloadValue": "Download Value (bps)",
+    "UploadValue": "Upload Value (bps)",
+    "Ping": "Ping Time (ms)",
+}
+
+# Speeds below the FCC 25/3 Mbps broadband standard, in the fields' bps
+STAT_THRESHOLDS = {
+    "DownloadValue": 25000000,
+    "UploadValue": 3000000,
+}
+
+# Percentiles shown in the email statistics table
+REPORT_PERCENTILES = [50, 90, 95]
+
+# Relative error of the percentiles estimated by QuantileSketch
+SKETCH_RELATIVE_ACCURACY = 0.01
+
+
+class QuantileSketch:
+    """Mergeable log-bucketed histogram for estimating percentiles.
+
+    Positive values are counted in buckets whose bounds grow by a constant
+    factor, so every percentile is estimated within SKETCH_RELATIVE_ACCURACY
+    of the true value (as in DDSketch). The number of buckets depends only
+    on the range of the values, not on how many are added: about 1,600
+    cover 1 bps to 100 Gbps. Zero and negative values share one bucket.
+    Sketches with the same accuracy merge by adding bucket counts.
+    """
+    __slots__ = ("log_gamma", "buckets", "zero_count", "count")
+
+    def __init__(self, relative_accuracy=SKETCH_RELATIVE_ACCURACY):
+        self.log_gamma = math.log((1 + relative_accuracy) / (1 - relative_accuracy))
+        self.buckets = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value):
+        """Adds a single value to the sketch.
+
+        Args:
+            value: Number to add, or None.
+
+        Returns:
+            None
+        """
+        if value is None:
+            return
+        self.count += 1
+        if value <= 0:
+            self.zero_count += 1
+            return
+        key = math.ceil(math.log(value) / self.log_gamma)
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+
+    def add_array(self, array):
+        """Adds a column of values held in an Arrow array.
+
+        Bucket keys are computed and counted with numpy rather than one
+        value at a time. NULL values are skipped.
+
+        Args:
+            array: pyarrow Array or ChunkedArray of numbers.
+
+        Returns:
+            None
+        """
+        import numpy as np
+        import pyarrow.compute as pc
+
+        values = pc.drop_null(array).to_numpy().astype(np.float64)
+        if not len(values):
+            return
+        positive = values[values > 0]
+        self.count += len(values)
+        self.zero_count += len(values) - len(positive)
+        keys, counts = np.unique(np.ceil(np.log(positive) / self.log_gamma).astype(np.int64), return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            self.buckets[key] = self.buckets.get(key, 0) + count
+
+    def merge(self, other):
+        """Combines another sketch with the same accuracy into this one.
+
+        Args:
+            other: QuantileSketch to merge.
+
+        Returns:
+            This QuantileSketch.
+        """
+        if other.log_gamma != self.log_gamma:
+            raise ValueError("Cannot merge sketches with different accuracy")
+        self.count += other.count
+        self.zero_count += other.zero_count
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        return self
+
+    def quantile(self, q):
+        """Estimates the value at quantile q.
+
+        Args:
+            q: Quantile between 0 and 1, e.g. 0.9 for the 90th percentile.
+
+        Returns:
+            Estimated value, or None if the sketch is empty.
+        """
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if rank < seen:
+                # Midpoint of the bucket (gamma^(key-1), gamma^key] in relative terms
+                return 2 * math.exp(key * self.log_gamma) / (1 + math.exp(self.log_gamma))
+        return 2 * math.exp(max(self.buckets) * self.log_gamma) / (1 + math.exp(self.log_gamma))
+
+
+class RunningStat:
+    """Constant-memory accumulator for the statistics of one field.
+
+    Keeps the count, min, max and mean, a QuantileSketch for percentiles
+    and the number of values below an optional threshold. Values are folded
+    in as they are read so the report never has to keep the column in
+    memory. NULL values are skipped.
+
+    Args:
+        threshold: Optional value to count the values below, e.g. a speed
+            standard from STAT_THRESHOLDS.
+    """
+    __slots__ = ("count", "total", "minimum", "maximum", "quantiles", "sketch", "threshold", "below")
+
+    def __init__(self, threshold=None):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+        # Percentile -> value, when computed by BigQuery instead of the sketch
+        self.quantiles = {}
+        self.sketch = QuantileSketch()
+        self.threshold = threshold
+        self.below = 0
+
+    def add(self, value):
+        """Adds a single value to the statistic.
+
+        Args:
+            value: Number to add, or None.
+
+        Returns:
+            None
+        """
+        if value is None:
+            return
+        self.count += 1
+        self.total += value
+        if value < self.minimum:
+            self.minimum = value
+        if value > self.maximum:
+            self.maximum = value
+        self.sketch.add(value)
+        if self.threshold is not None and value < self.threshold:
+            self.below += 1
+
+    def add_array(self, array):
+        """Adds a column of values held in an Arrow array.
+
+        The count, sum, min and max are computed by Arrow's vectorised
+        kernels rather than one value at a time. NULL values are skipped.
+
+        Args:
+            array: pyarrow Array or ChunkedArray of numbers.
+
+        Returns:
+            None
+        """
+        import pyarrow.compute as pc
+
+        count = pc.count(array).as_py()
+        if not count:
+            return
+        min_max = pc.min_max(array)
+        self.count += count
+        self.total += pc.sum(array).as_py()
+        self.minimum = min(self.minimum, min_max["min"].as_py())
+        self.maximum = max(self.maximum, min_max["max"].as_py())
+        self.sketch.add_array(array)
+        if self.threshold is not None:
+            self.below += pc.sum(pc.less(array, self.threshold)).as_py() or 0
+
+    def merge(self, other):
+        """Combines another RunningStat into this one.
+
+        Args:
+            other: RunningStat to merge.
+
+        Returns:
+            This RunningStat.
+        """
+        self.count += other.count
+        self.total += other.total
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        self.sketch.merge(other.sketch)
+        self.below += other.below
+        # Percentiles computed by BigQuery for the parts do not give the
+        # percentiles of the whole; the merged sketch does
+        self.quantiles = {}
+        return self
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def percentile(self, percentile):
+        """Gets a percentile, from BigQuery if it computed it, else from the sketch.
+
+        Args:
+            percentile: Percentile between 0 and 100.
+
+        Returns:
+            Value of the percentile, or None if there is no data.
+        """
+        if percentile in self.quantiles:
+            return self.quantiles[percentile]
+        value = self.sketch.quantile(percentile / 100)
+        if value is None:
+            return None
+        # The exact min and max bound the estimate
+        return min(max(value, self.minimum), self.maximum)
+
+    @property
+    def below_share(self):
+        """Share of the values below the threshold, or None without one."""
+        if self.threshold is None or not self.count:
+            return None
+        return self.below / self.count
+
+
+def new_report_stats():
+    """Creates an empty accumulator for every field in STAT_FIELDS.
+
+    Args:
+        None
+
+    Returns:
+        Dictionary mapping field name to RunningStat.
+    """
+    return {field: RunningStat(STAT_THRESHOLDS.get(field)) for field in STAT_FIELDS}
+
+
+def stats_from_aggregate_row(row):
+    """Builds report statistics from a row of the aggregate query.
+
+    Args:
+        row: Row with <field>_count, _sum, _min and _max columns for every
+            field in STAT_FIELDS, and optionally <field>_p<percentile>
+            percentiles and <field>_below threshold counts.
+
+    Returns:
+        Dictionary mapping field name to RunningStat.
+    """
+    stats = new_report_stats()
+    columns = set(row.keys())
+    for field, stat in stats.items():
+        stat.count = row[field + "_count"]
+        if stat.count:
+            stat.total = row[field + "_sum"]
+            stat.minimum = row[field + "_min"]
+            stat.maximum = row[field + "_max"]
+            if field + "_below" in columns:
+                stat.below = row[field + "_below"] or 0
+            for column in columns:
+                if column.startswith(field + "_p") and column[len(field) + 2:].isdigit():
+                    stat.quantiles[int(column[len(field) + 2:])] = row[column]
+    return stats
@@ -0,0 +1,50 @@
+import random
+
+import pyarrow as pa
+
+from stats import SKETCH_RELATIVE_ACCURACY, QuantileSketch
+
+
+def exact_quantile(values, q):
+    return sorted(values)[int(q * (len(values) - 1))]
+
+
+def test_sketch_accuracy():
+    rng = random.Random(1)
+    values = [rng.lognormvariate(17, 1) for _ in range(20000)]
+    sketch = QuantileSketch()
+    for value in values:
+        sketch.add(value)
+    for q in (0.01, 0.5, 0.9, 0.95, 0.99):
+        exact = exact_quantile(values, q)
+        assert abs(sketch.quantile(q) - exact) <= SKETCH_RELATIVE_ACCURACY * exact
+
+
+def test_sketch_merge_matches_single_sketch():
+    rng = random.Random(2)
+    values = [rng.uniform(1, 1e9) for _ in range(5000)] + [0.0, -1.0, None]
+    whole = QuantileSketch()
+    for value in values:
+        whole.add(value)
+    left, right = QuantileSketch(), QuantileSketch()
+    for value in values[:1234]:
+        left.add(value)
+    right.add_array(pa.array(values[1234:]))
+    merged = left.merge(right)
+    assert merged.count == whole.count == len(values) - 1
+    assert merged.zero_count == whole.zero_count == 2
+    assert merged.buckets == whole.buckets
+    assert merged.quantile(0.5) == whole.quantile(0.5)
+
+
+def test_sketch_edges():
+    sketch = QuantileSketch()
+    assert sketch.quantile(0.5) is None
+    sketch.add(0)
+    assert sketch.quantile(0.5) == 0.0
+    try:
+        sketch.merge(QuantileSketch(relative_accuracy=0.05))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("sketches with different accuracy were merged")
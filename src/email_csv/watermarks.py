@@ -0,0 +1,78 @@
+import datetime as dt
+import json
+from google.api_core.exceptions import PreconditionFailed
+
+# Prefix of the watermark objects in BUCKET_NAME
+WATERMARK_PREFIX = "_watermarks/"
+
+
+class Watermark:
+    """High-water mark of the tests already exported for one report window.
+
+    Args:
+        blob: Blob the watermark is stored in.
+        value: Timezone-aware datetime of the last exported test, or None
+            if nothing has been exported yet.
+        generation: Generation of the blob that was read, 0 if it did not
+            exist. Saving only succeeds if the blob is still at it.
+    """
+
+    def __init__(self, blob, value, generation):
+        self.blob = blob
+        self.value = value
+        self.generation = generation
+
+
+def watermark_name(dataset_id, table_id, window_name):
+    """Builds the name of the object holding a report window's watermark.
+
+    Args:
+        dataset_id: BigQuery dataset holding the table.
+        table_id: BigQuery table being exported.
+        window_name: Report window name, e.g. "daily".
+
+    Returns:
+        Object name as a string.
+    """
+    return WATERMARK_PREFIX + dataset_id + "." + table_id + "." + window_name + ".json"
+
+
+def load_watermark(bucket, name):
+    """Reads a report window's watermark from GCS.
+
+    Args:
+        bucket: Bucket holding the watermark.
+        name: Object name from watermark_name().
+
+    Returns:
+        Watermark; its value is None if none has been saved yet.
+    """
+    blob = bucket.get_blob(name)
+    if blob is None:
+        return Watermark(bucket.blob(name), None, 0)
+    record = json.loads(blob.download_as_bytes(if_generation_match=blob.generation))
+    return Watermark(blob, dt.datetime.fromisoformat(record["watermark"]), blob.generation)
+
+
+def save_watermark(watermark, value):
+    """Advances a watermark once its window has been exported and emailed.
+
+    The write is conditional on the generation that was read, so two
+    overlapping runs of the same report cannot both advance it.
+
+    Args:
+        watermark: Watermark returned by load_watermark().
+        value: Timezone-aware datetime of the end of the exported window.
+
+    Returns:
+        None
+    """
+    record = {"watermark": value.isoformat(), "updated": dt.datetime.now(dt.timezone.utc).isoformat()}
+    try:
+        watermark.blob.upload_from_string(json.dumps(record), content_type="application/json",
+                                          if_generation_match=watermark.generation)
+    except PreconditionFailed:
+        raise RuntimeError("Watermark {} was advanced by another run; this run's rows may have been sent twice".format(
+            watermark.blob.name))
+    watermark.value = value
+    watermark.generation = watermark.blob.generation
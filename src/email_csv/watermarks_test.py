@@ -0,0 +1,69 @@
+import datetime as dt
+
+import pytest
+from google.api_core.exceptions import PreconditionFailed
+
+from watermarks import load_watermark, save_watermark
+
+
+class FakeBlob:
+    """Blob whose writes honour if_generation_match like GCS."""
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.generation = None
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None):
+        current = self.bucket.objects.get(self.name)
+        if if_generation_match is not None and if_generation_match != (current[1] if current else 0):
+            raise PreconditionFailed("generation mismatch")
+        self.bucket.generation += 1
+        self.generation = self.bucket.generation
+        self.bucket.objects[self.name] = (data, self.generation)
+
+    def download_as_bytes(self, if_generation_match=None):
+        data, generation = self.bucket.objects[self.name]
+        if if_generation_match is not None and if_generation_match != generation:
+            raise PreconditionFailed("generation mismatch")
+        return data.encode("utf-8")
+
+
+class FakeBucket:
+    def __init__(self):
+        self.objects = {}
+        self.generation = 0
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def get_blob(self, name):
+        if name not in self.objects:
+            return None
+        blob = FakeBlob(self, name)
+        blob.generation = self.objects[name][1]
+        return blob
+
+
+def test_save_and_load():
+    bucket = FakeBucket()
+    watermark = load_watermark(bucket, "w.json")
+    assert watermark.value is None and watermark.generation == 0
+    end = dt.datetime(2024, 1, 2, 3, tzinfo=dt.timezone.utc)
+    save_watermark(watermark, end)
+    assert load_watermark(bucket, "w.json").value == end
+    # The watermark can be advanced again from the generation it saved
+    save_watermark(watermark, end + dt.timedelta(days=1))
+    assert load_watermark(bucket, "w.json").value == end + dt.timedelta(days=1)
+
+
+def test_concurrent_save_is_refused():
+    bucket = FakeBucket()
+    first = load_watermark(bucket, "w.json")
+    second = load_watermark(bucket, "w.json")
+    end = dt.datetime(2024, 1, 2, tzinfo=dt.timezone.utc)
+    save_watermark(first, end)
+    with pytest.raises(RuntimeError):
+        save_watermark(second, end + dt.timedelta(hours=1))
+    assert second.value is None
+    assert load_watermark(bucket, "w.json").value == end
@@ -1,6 +1,12 @@
+import json
+import os
+import threading
+import time
+from google.api_core.exceptions import Conflict, NotFound
 from google.cloud import bigquery
+from query_builder import DOWN_UPLOAD_COLUMNS, REPORT_COLUMNS, WINDOW_DAYS, select_query, time_window, window_parameters
+from query_cache import QueryCache
 
-client = bigquery.Client()
 # Project
 project_id = "cs467-capstone-dummy-data"
 # Dataset (Database)
@@ -9,11 +15,112 @@ dataset_id = "DeviceBroadbandData"
     # NDT-7
 ndt7_table_id = '.'.join([project_id, dataset_id, "NDT-7"])
 ndt7_table_query_id = '`' + ndt7_table_id + '`'
-ndt7_table = client.get_table(ndt7_table_id)
     # Multistream Table
 multistream_table_id = '.'.join([project_id, dataset_id, "Multistream"])
 multistream_table_query_id = '`' + multistream_table_id + '`'
-multistream_table = client.get_table(multistream_table_id)
+    # Daily rollup of the Multistream Table, see rollups.py
+rollup_table_id = '.'.join([project_id, dataset_id, "MultistreamDaily"])
+
+"""#### Lazy Client and Table Metadata ########################################"""
+# Nothing is fetched at import time. The client is created on first use and
+# table schemas are cached for the life of the process, so only a cold start
+# that misses the seed file pays for a get_table call.
+
+# Seconds a cached schema is trusted before it is fetched again
+SCHEMA_TTL_SECONDS = float(os.getenv("SCHEMA_TTL_SECONDS", 3600))
+# Schemas written by `DDL.py --dump-schemas`, keyed by table name
+SCHEMA_SEED_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schemas.json")
+
+_client = None
+_schema_cache = {}      # table_id -> (schema, expires_at)
+_lock = threading.Lock()
+
+def get_client() -> bigquery.Client:
+    """
+    get_client() returns the process-wide BigQuery client, creating it on
+    first use.
+
+    return: bigquery.Client
+    """
+    global _client
+    with _lock:
+        if _client is None:
+            _client = bigquery.Client()
+        return _client
+
+def seed_schema_cache(path: str = SCHEMA_SEED_FILE) -> None:
+    """
+    seed_schema_cache() fills the schema cache from a JSON file mapping table
+    name to a list of schema fields, as written by `DDL.py --dump-schemas`.
+    Missing files are ignored.
+
+    path: path of the schema seed file
+    return: None
+    """
+    if not os.path.exists(path):
+        return
+    with open(path) as seed_file:
+        seeds = json.load(seed_file)
+    expires_at = time.monotonic() + SCHEMA_TTL_SECONDS
+    with _lock:
+        for table_name, fields in seeds.items():
+            table_id = '.'.join([project_id, dataset_id, table_name])
+            schema = [bigquery.SchemaField.from_api_repr(field) for field in fields]
+            _schema_cache[table_id] = (schema, expires_at)
+
+def get_schema(table_id: str) -> list:
+    """
+    get_schema() returns the schema of a table from the process-wide cache,
+    fetching it with get_table only when missing or older than
+    SCHEMA_TTL_SECONDS.
+
+    table_id: 'project_id.dataset_id.table_name'
+    return: list of bigquery.SchemaField
+    """
+    with _lock:
+        cached = _schema_cache.get(table_id)
+    if cached is not None and cached[1] > time.monotonic():
+        return cached[0]
+    schema = get_client().get_table(table_id).schema
+    with _lock:
+        _schema_cache[table_id] = (schema, time.monotonic() + SCHEMA_TTL_SECONDS)
+    return schema
+
+def get_table(table_id: str) -> bigquery.Table:
+    """
+    get_table() returns a table handle carrying the cached schema. Only the
+    schema is populated; use get_client().get_table() for full metadata.
+
+    table_id: 'project_id.dataset_id.table_name'
+    return: bigquery.Table
+    """
+    return bigquery.Table(table_id, schema=get_schema(table_id))
+
+def __getattr__(name):
+    # Keep DML.client, DML.ndt7_table and DML.multistream_table working
+    # without creating them at import time
+    if name == "client":
+        return get_client()
+    if name == "ndt7_table":
+        return get_table(ndt7_table_id)
+    if name == "multistream_table":
+        return get_table(multistream_table_id)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+seed_schema_cache()
+
+# Read queries are answered from a cache for QUERY_CACHE_TTL_SECONDS, in
+# memory and, if QUERY_CACHE_DIR is set, on disk. Queries estimated by a
+# dry run to process more than MAXIMUM_BYTES_BILLED bytes are refused.
+query_cache = QueryCache(
+    get_client,
+    max_entries=int(os.getenv("QUERY_CACHE_MAX_ENTRIES", 128)),
+    ttl_seconds=float(os.getenv("QUERY_CACHE_TTL_SECONDS", 300)),
+    window_seconds=float(os.getenv("QUERY_CACHE_WINDOW_SECONDS", 300)),
+    disk_dir=os.getenv("QUERY_CACHE_DIR") or None,
+    max_rows=int(os.getenv("QUERY_CACHE_MAX_ROWS", 100000)),
+    maximum_bytes_billed=int(os.getenv("MAXIMUM_BYTES_BILLED", 10 * 1024 ** 3)) or None,
+)
 
 """#### General Table Functions ###############################################"""
 def display_table_info(table: bigquery.Table) -> None:
@@ -37,40 +144,88 @@ def display_table_info(table: bigquery.Table) -> None:
     print("Table has {} rows\n".format(table_rows))
     print("-----------------------------------------------------------")
 
-def send_query(query: str) -> bigquery.QueryJob.result:
+def send_query(query: str, use_cache: bool = True, parameters: list = None) -> bigquery.QueryJob.result:
     """
     send_query() takes a given query string and creates a QueryJob class based
     on the given BigQuery query. The function then executes the query job and
-    returns the iterator of the QueryJob class upon completion of the query job
+    returns its rows upon completion of the query job. Repeated read queries
+    are answered from query_cache. A query whose dry run estimates more than
+    MAXIMUM_BYTES_BILLED bytes raises query_cache.QueryCostError instead of
+    running.
     
     query: BigQuery query string
-    return: QueryJob.result() iterator
+    use_cache: set to False to always run the query
+    parameters: optional list of bigquery query parameters, e.g. from
+                window_parameters()
+    return: list of rows, or the QueryJob.result() iterator when use_cache
+            is False or the result is too large to cache
     """
-    query_job = client.query(query)
-    return query_job.result()
+    if not use_cache:
+        return query_cache.run(query, parameters).result()
+    return query_cache.query(query, parameters)
 
 """#### CREATE ################################################################"""
-def insert_json_uri(table: bigquery.Table, table_id: str, bucket_uri: str) -> None:
+# Load job source format for every ingest format
+source_formats = {
+    "json": bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+    "parquet": bigquery.SourceFormat.PARQUET,
+    "avro": bigquery.SourceFormat.AVRO,
+}
+
+def get_load_job(job_id: str) -> bigquery.LoadJob | None:
+    """
+    get_load_job() fetches a load job started earlier, e.g. by a previous
+    delivery of the same event.
+
+    job_id: id of the load job
+    return: the LoadJob, or None if no job has that id
+    """
+    try:
+        return get_client().get_job(job_id, location="us-west1")
+    except NotFound:
+        return None
+
+
+def insert_json_uri(table: bigquery.Table, table_id: str, bucket_uri: str | list[str],
+                    job_id: str = None, source_format: str = "json") -> bigquery.LoadJob:
     """
     insert_json_uri() takes as parameters table, table_id, and bucket uri and
     inserts the data from the GCS bucket uri into the given BigQuery table.
+    A list of uris is loaded by a single load job. If a job with the given
+    job_id already exists it is waited on instead of starting a new load.
+    Newline-delimited JSON may be gzip-compressed. Parquet and Avro files
+    carry their own schema, which must match the table's.
 
     table: destination BigQuery table
     table_id: destination BigQuery table identification
-    bucket_uri: URI of the GCS bucket from which to obtain data
-    return: None
+    bucket_uri: URI of the GCS bucket from which to obtain data, or a list of
+                URIs to load together
+    job_id: optional id of the load job
+    source_format: "json", "parquet" or "avro"
+    return: the completed LoadJob, check load_job.error_result for failures
     """
-    job_config = bigquery.LoadJobConfig(
-        schema=table.schema,
-        source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
-    )
+    if source_format == "json":
+        job_config = bigquery.LoadJobConfig(
+            schema=table.schema,
+            source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+        )
+    else:
+        job_config = bigquery.LoadJobConfig(
+            source_format=source_formats[source_format],
+            use_avro_logical_types=source_format == "avro",
+        )
     
-    load_job = client.load_table_from_uri(
-        bucket_uri,
-        table_id,
-        location="us-west1",   # Must match the destination dataset location
-        job_config=job_config,
-    )   # Make an API request.
+    try:
+        load_job = get_client().load_table_from_uri(
+            bucket_uri,
+            table_id,
+            job_id=job_id,
+            location="us-west1",   # Must match the destination dataset location
+            job_config=job_config,
+        )   # Make an API request.
+    except Conflict:
+        # A previous attempt already started this job
+        load_job = get_load_job(job_id)
 
     try:
         load_job.result()  # Waits for the job to complete.
@@ -78,49 +233,33 @@ def insert_json_uri(table: bigquery.Table, table_id: str, bucket_uri: str) -> No
         print("ERROR:")
         for error in load_job.errors:
             for reason in error.keys():
-                print(reason + ": " + error[reason])
+                print(reason + ": " + str(error[reason]))
             print('\n')
-        return
+        return load_job
 
-    destination_table = client.get_table(table_id)
-    print("Loaded {} rows.".format(destination_table.num_rows))
+    # The job statistics already hold the row count, no need to fetch the table
+    print("Loaded {} rows.".format(load_job.output_rows))
+    return load_job
 
 """#### READ ##################################################################"""
 # Query Statements
+# Window boundaries are named parameters aligned to the hour rather than
+# CURRENT_TIMESTAMP(), so repeated reports hit BigQuery's result cache;
+# run the windowed queries with send_query(query, parameters=...).
 multistream_queries = {
     "selectAll": """SELECT * FROM {}\n""".format(multistream_table_query_id),
-    "selectDown/Upload": """SELECT TestName, ClientIP, TestStartTime, TestEndTime, DownloadValue, DownloadUnit, UploadValue, UploadUnit FROM {}\n""".format(multistream_table_query_id),
-    "requested": """SELECT
-                        Timestamp,
-                        TestStartTime,
-                        ClientIP,
-                        ClientLat,
-                        ClientLon,
-                        DownloadValue,
-                        DownloadUnit,
-                        UploadValue,
-                        UploadUnit,
-                        Ping,
-                        PingUnit,
-                        ServerLatency,
-                        ServerLatencyUnit,
-                        Isp,
-                        IspDownloadAvg,
-                        IspUploadAvg
-                    FROM
-                        `cs467-capstone-dummy-data.DeviceBroadbandData.Multistream`
-                    WHERE
-                        Timestamp > TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 15 DAY) AND Timestamp <= CURRENT_TIMESTAMP()
-                    ORDER BY
-                        Timestamp"""
+    "selectDown/Upload": select_query(multistream_table_id, DOWN_UPLOAD_COLUMNS),
+    "requested": select_query(multistream_table_id, REPORT_COLUMNS, time_window("Multistream"), order_by="Timestamp"),
 }
+# Days in the window of the windowed queries in multistream_queries
+multistream_query_days = {"requested": 15}
 """Time Selection"""
-times = {
-    "daily": """WHERE TestStartTime > TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 1 DAY)\n""",
-    "weekly": """WHERE TestStartTime > TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 7 DAY)\n""",
-    "monthly": """WHERE TestStartTime > TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 31 DAY)\n""",
-    "yearly": """WHERE TestStartTime > TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 365 DAY)\n"""
-}
+# Days covered by each window. times select the window of Multistream tests
+# and ndt7_times that of NDT-7 tests, which has no Timestamp column; it is
+# set by window_parameters(time_days[time], table_name=...) for the table.
+time_days = WINDOW_DAYS
+times = {time: time_window("Multistream") for time in time_days}
+ndt7_times = {time: time_window("NDT-7") for time in time_days}
 
 """#### Testing Functions #####################################################"""
 def test_queries(query_dict: dict) -> None:
@@ -128,13 +267,15 @@ def test_queries(query_dict: dict) -> None:
     test_queries() runs through all of the queries in a given query dictionary
     and prints the results to STDOUT.
 
-    query_dict: dictionary of query statements to test
+    query_dict: dictionary of query statements, or of (query, parameters)
+                tuples, to test
     return: None
     """
     limiter = "LIMIT 1"
     for query in query_dict.keys():
         print("Running Query: {}".format(query))
-        for row in send_query(query_dict[query]+limiter):
+        statement, parameters = query_dict[query] if isinstance(query_dict[query], tuple) else (query_dict[query], None)
+        for row in send_query(statement+limiter, parameters=parameters):
             print(row)
         print("-----------------------------------------------------------")
 
@@ -142,8 +283,8 @@ def test_queries(query_dict: dict) -> None:
 if __name__ == '__main__':
     isTesting = False
 
-    display_table_info(multistream_table)
-    display_table_info(ndt7_table)
+    display_table_info(get_client().get_table(multistream_table_id))
+    display_table_info(get_client().get_table(ndt7_table_id))
 
     """
       -------------------------------------------------------------------------
@@ -169,8 +310,9 @@ if __name__ == '__main__':
         by the insert_bucket_uri function and printed to STDOUT.
     """
     # bucket_uri = "gs://pagcasa-dummy-data/200-ooklaRandomizedData.JSON"
-    # insert_json_uri(multistream_table, multistream_table_id, bucket_uri)
+    # insert_json_uri(get_table(multistream_table_id), multistream_table_id, bucket_uri)
 
     # -------------------------------------------------------------------------
     if isTesting:
-        test_queries(multistream_queries)  # run all read queries for test purposes
+        test_queries({name: (query, window_parameters(multistream_query_days[name]) if name in multistream_query_days else None)
+                      for name, query in multistream_queries.items()})  # run all read queries for test purposes
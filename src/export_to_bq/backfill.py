@@ -0,0 +1,354 @@
+import argparse
+import datetime as dt
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from google.cloud import bigquery
+import DeviceBroadbandData_DML as DML
+import main
+from load_retry import LoadFailedError, load_job_id, load_with_retry
+from rollups import refresh_query
+
+# Objects per load job (a load job accepts at most 10,000 source URIs) and
+# total object size per load job
+DEFAULT_BATCH_FILES = 1000
+DEFAULT_BATCH_BYTES = 4 * 1024 * 1024 * 1024
+# Load jobs running at the same time
+DEFAULT_CONCURRENCY = 8
+
+
+def plan_batches(objects: list, batch_files: int, batch_bytes: int) -> list:
+    """
+    plan_batches() groups the objects to load into batches of at most
+    batch_files objects and batch_bytes bytes per destination table. The
+    objects are sorted by name, so the same listing always gives the same
+    batches and load job ids.
+
+    objects: list of (table_id, name, generation, size) tuples
+    batch_files: most objects in one batch
+    batch_bytes: most bytes in one batch, a larger object gets its own batch
+    return: list of (table_id, [(name, generation, size), ...]) batches
+    """
+    batches = []
+    open_batches = {}
+    for table_id, name, generation, size in sorted(objects, key=lambda item: (item[0], item[1])):
+        items, total = open_batches.get(table_id, ([], 0))
+        if items and (len(items) >= batch_files or total + size > batch_bytes):
+            batches.append((table_id, items))
+            items, total = [], 0
+        items.append((name, generation, size))
+        open_batches[table_id] = (items, total + size)
+    batches += [(table_id, items) for table_id, (items, total) in open_batches.items() if items]
+    return batches
+
+
+class Manifest:
+    """
+    Manifest records the outcome of every batch in a local JSON file, so an
+    interrupted backfill can be restarted and skips the objects already
+    loaded. The file is rewritten atomically after every batch.
+    """
+
+    def __init__(self, path: str):
+        """
+        path: path of the manifest file, created if missing
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self.batches = {}
+        if os.path.exists(path):
+            with open(path) as manifest_file:
+                self.batches = json.load(manifest_file).get("batches", {})
+
+    def loaded_uris(self) -> set:
+        """
+        loaded_uris() returns the URIs, with their generation, that a
+        previous run loaded.
+
+        return: set of 'gs://bucket/name#generation' strings
+        """
+        with self._lock:
+            return {uri for batch in self.batches.values() for uri in batch.get("loaded", [])}
+
+    def record(self, batch_id: str, entry: dict) -> None:
+        """
+        record() stores the outcome of a batch and saves the manifest.
+
+        batch_id: id of the batch
+        entry: dictionary describing the outcome
+        return: None
+        """
+        with self._lock:
+            self.batches[batch_id] = entry
+            temporary_path = self.path + ".tmp"
+            with open(temporary_path, "w") as manifest_file:
+                json.dump({"batches": self.batches}, manifest_file, indent=1)
+            os.replace(temporary_path, self.path)
+
+
+class Progress:
+    """
+    Progress prints a line with the files and rows loaded so far, the rate
+    and the estimated time left after every batch.
+    """
+
+    def __init__(self, total_batches: int, total_files: int, total_bytes: int):
+        self.total_batches = total_batches
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.batches = self.files = self.bytes = self.rows = self.failed = 0
+        self.start = time.monotonic()
+        self._lock = threading.Lock()
+
+    def update(self, files: int, size: int, rows: int, failed: int) -> None:
+        with self._lock:
+            self.batches += 1
+            self.files += files
+            self.bytes += size
+            self.rows += rows
+            self.failed += failed
+            elapsed = time.monotonic() - self.start
+            remaining = elapsed / self.bytes * (self.total_bytes - self.bytes) if self.bytes else 0
+            print("[{}/{} batches] {}/{} files, {:.1f}/{:.1f} MB, {} rows, {} failed, {:.1f} files/s, "
+                  "{:.0f}s elapsed, ~{:.0f}s left".format(
+                      self.batches, self.total_batches, self.files, self.total_files, self.bytes / 1e6,
+                      self.total_bytes / 1e6, self.rows, self.failed, self.files / max(elapsed, 1e-9),
+                      elapsed, remaining), flush=True)
+
+
+def load_names(items: list, validate: bool) -> list:
+    """
+    load_names() gives the name every object of a batch is loaded under, as
+    get_new_data names it: its cleaned copy when validating, otherwise the
+    upload itself. Load job ids and claim markers are derived from these
+    names, so get_new_data and the backfill recognise each other's loads.
+
+    items: list of (name, generation, size) tuples
+    validate: the cleaned copies are loaded
+    return: list of (name, generation) tuples, in the order of items
+    """
+    return [(main.clean_upload_name(name, generation) if validate else name, generation)
+            for name, generation, size in items]
+
+
+def batch_job_id(bucket_name: str, names: list) -> str:
+    """
+    batch_job_id() derives the load job id of a batch from the names its
+    objects are loaded under, as commit_batch in main.py does.
+
+    bucket_name: bucket holding the objects
+    names: list of (name, generation) tuples from load_names()
+    return: load job id prefix
+    """
+    return load_job_id(*sorted(f"{bucket_name}/{name}#{generation}" for name, generation in names))
+
+
+def run_batch(bucket_name: str, table_id: str, items: list, validate: bool) -> dict:
+    """
+    run_batch() loads one batch of objects with a single load job. Every
+    object is first claimed with the same `_ingest/loads/` marker and load
+    job id as get_new_data uses, so objects it has loaded, or is loading,
+    are skipped, and a restarted backfill waits on a job that is still
+    running instead of loading the objects again. Only the claimed objects
+    are validated. When the load fails permanently, e.g. because of one
+    bad file, every object is loaded on its own so only the bad ones fail.
+
+    bucket_name: bucket holding the objects
+    table_id: destination table identification
+    items: list of (name, generation, size) tuples
+    validate: validate every object and load the cleaned copies in
+              INGEST_FORMAT; otherwise the objects are loaded as NDJSON
+    return: manifest entry of the batch
+    """
+    table = DML.get_table(table_id)
+    storage_client = main.get_storage_client()
+    names = load_names(items, validate)
+    batch_id = batch_job_id(bucket_name, names)
+    sources = {f"gs://{bucket_name}/{name}#{generation}": (name, generation, load_name)
+               for (name, generation, size), (load_name, _) in zip(items, names)}
+
+    def claim(name, generation, job_id):
+        # get_new_data in single mode writes no marker; the object's own
+        # load job shows that it was loaded
+        if main.load_succeeded(load_job_id(bucket_name, name, str(generation))):
+            return False
+        return main.claim_object(storage_client, bucket_name, name, generation, job_id)
+
+    entry = {"table_id": table_id, "uris": sorted(sources), "loaded": [], "failed": {}, "rows": 0}
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        claimed = list(pool.map(lambda source: claim(sources[source][2], sources[source][1], batch_id), sources))
+    loads = {}
+    for source, is_claimed in zip(sources, claimed):
+        name, generation, load_name = sources[source]
+        if not is_claimed:
+            # Already loaded, e.g. by get_new_data
+            entry["loaded"].append(source)
+        elif validate and main.validate_upload(table_id, bucket_name, name, generation) is None:
+            # No line was good, so there is nothing to load
+            entry["loaded"].append(source)
+        else:
+            loads[source] = (load_name, generation)
+
+    # Only the cleaned copies are transcoded
+    source_format = main.INGEST_FORMAT if validate else "json"
+
+    def load(names, job_id):
+        uris = [f"gs://{bucket_name}/{name}" for name, generation in names]
+        return load_with_retry(
+            lambda attempt_id: DML.insert_json_uri(table, table_id, uris, attempt_id, source_format),
+            job_id, main.LOAD_MAX_ATTEMPTS, main.LOAD_BASE_DELAY, main.LOAD_MAX_DELAY,
+        )
+
+    if not loads:
+        entry["state"] = "committed"
+        return entry
+    try:
+        load_job = load(list(loads.values()), batch_id)
+        entry.update(state="committed", job_id=load_job.job_id, rows=load_job.output_rows or 0)
+        entry["loaded"] += list(loads)
+        return entry
+    except LoadFailedError as error:
+        entry["job_id"] = error.job_id
+        if not error.permanent or len(loads) == 1:
+            entry["state"] = "failed"
+            entry["failed"] = {source: error.errors for source in loads}
+            return entry
+
+    for source, (name, generation) in loads.items():
+        object_job_id = load_job_id(bucket_name, name, str(generation))
+        try:
+            if claim(name, generation, object_job_id):
+                load_job = load([(name, generation)], object_job_id)
+                entry["rows"] += load_job.output_rows or 0
+            entry["loaded"].append(source)
+        except LoadFailedError as error:
+            entry["failed"][source] = error.errors
+    entry["state"] = "partial" if entry["failed"] else "committed"
+    return entry
+
+
+def refresh_rollup(started: dt.datetime) -> None:
+    """
+    refresh_rollup() recomputes the days of the Multistream rollup whose
+    Timestamp partitions were changed since a backfill started, as the
+    rollup refreshes of get_new_data only cover recent days. The days are
+    read from the table's partition metadata, so finding them scans no
+    tests, and only their partitions are scanned by the refresh.
+
+    started: time the backfill started
+    return: None
+    """
+    project_id, dataset_id, table_name = DML.multistream_table_id.split(".")
+    query = "SELECT partition_id FROM `{}.{}.INFORMATION_SCHEMA.PARTITIONS` " \
+            "WHERE table_name = @table_name AND last_modified_time >= @started".format(project_id, dataset_id)
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("table_name", "STRING", table_name),
+        bigquery.ScalarQueryParameter("started", "TIMESTAMP", started),
+    ])
+    # Day partitions are named YYYYMMDD; __NULL__ holds the rows without a Timestamp
+    days = [dt.datetime.strptime(row["partition_id"], "%Y%m%d").date()
+            for row in DML.get_client().query(query, job_config=job_config).result()
+            if row["partition_id"].isdigit()]
+    if not days:
+        return
+    job = DML.get_client().query(refresh_query(DML.multistream_table_id, DML.rollup_table_id, len(days), days))
+    job.result()
+    print("Refreshed {} days of {}: {} rows changed".format(len(days), DML.rollup_table_id,
+                                                            job.num_dml_affected_rows), flush=True)
+
+
+def backfill(uri: str, manifest_path: str, batch_files: int = DEFAULT_BATCH_FILES,
+             batch_bytes: int = DEFAULT_BATCH_BYTES, concurrency: int = DEFAULT_CONCURRENCY,
+             validate: bool = None, dry_run: bool = False) -> Progress:
+    """
+    backfill() loads every object under a bucket prefix into the table
+    get_new_data would route it to, in multi-URI load jobs run concurrently.
+    Objects a previous run with the same manifest loaded are skipped. The
+    rollup days holding the loaded Multistream tests are then recomputed.
+
+    uri: 'gs://bucket/prefix' to backfill
+    manifest_path: path of the resume manifest
+    batch_files: most objects per load job
+    batch_bytes: most bytes per load job
+    concurrency: number of load jobs running at the same time
+    validate: validate every object and load the cleaned copies; defaults
+              to VALIDATION_MODE, and is always done when INGEST_FORMAT
+              transcodes the uploads
+    dry_run: only print the planned batches
+    return: Progress with the totals
+    """
+    if validate is None:
+        validate = main.VALIDATION_MODE == "validate"
+    validate = validate or main.INGEST_FORMAT != "json"
+    started = dt.datetime.now(dt.timezone.utc)
+    bucket_name, _, prefix = uri[len("gs://"):].partition("/")
+    manifest = Manifest(manifest_path)
+    loaded = manifest.loaded_uris()
+
+    objects = []
+    for blob in main.get_storage_client().list_blobs(bucket_name, prefix=prefix):
+        if blob.name.startswith(main.INTERNAL_PREFIX) or f"gs://{bucket_name}/{blob.name}#{blob.generation}" in loaded:
+            continue
+        # Objects that are not uploads, or of unknown runner types, are skipped
+        if not main.registry.is_upload(blob.name):
+            continue
+        destination = main.route_table(bucket_name, blob.name, blob.generation)
+        if destination is None:
+            continue
+        objects.append((destination[1], blob.name, blob.generation, blob.size or 0))
+
+    batches = plan_batches(objects, batch_files, batch_bytes)
+    progress = Progress(len(batches), len(objects), sum(size for table_id, name, generation, size in objects))
+    print("Backfilling {} files ({:.1f} MB) from {} in {} load jobs, {} files already loaded".format(
+        len(objects), progress.total_bytes / 1e6, uri, len(batches), len(loaded)), flush=True)
+    if dry_run:
+        for table_id, items in batches:
+            print("{}: {} files, {:.1f} MB".format(table_id, len(items), sum(size for name, generation, size in items) / 1e6))
+        return progress
+
+    rollup_changed = False
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = {executor.submit(run_batch, bucket_name, table_id, items, validate): (table_id, items)
+                   for table_id, items in batches}
+        for future in as_completed(futures):
+            table_id, items = futures[future]
+            try:
+                entry = future.result()
+            except Exception as error:
+                # e.g. the validation of an object failed; the batch is retried by the next run
+                uris = sorted(f"gs://{bucket_name}/{name}#{generation}" for name, generation, size in items)
+                entry = {"table_id": table_id, "uris": uris, "loaded": [], "state": "failed", "rows": 0,
+                         "failed": {uri: [{"reason": type(error).__name__, "message": str(error)}] for uri in uris}}
+            manifest.record(batch_job_id(bucket_name, load_names(items, validate)), entry)
+            rollup_changed = rollup_changed or (table_id == DML.multistream_table_id and entry["rows"] > 0)
+            progress.update(len(items), sum(size for name, generation, size in items), entry["rows"],
+                            len(entry["failed"]))
+    if rollup_changed:
+        refresh_rollup(started)
+    return progress
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load every Murakami upload under a GCS prefix into BigQuery.")
+    parser.add_argument("uri", help="gs://bucket/prefix to backfill")
+    parser.add_argument("--manifest", default="backfill-manifest.json",
+                        help="resume manifest; objects it records as loaded are skipped")
+    parser.add_argument("--batch-files", type=int, default=DEFAULT_BATCH_FILES, help="most files per load job")
+    parser.add_argument("--batch-bytes", type=int, default=DEFAULT_BATCH_BYTES, help="most bytes per load job")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="load jobs run at the same time")
+    parser.add_argument("--validate", action=argparse.BooleanOptionalAction,
+                        help="validate every file as get_new_data does and load the cleaned copies "
+                             "(default: as VALIDATION_MODE says)")
+    parser.add_argument("--dry-run", action="store_true", help="only list the planned load jobs")
+    args = parser.parse_args()
+
+    # Progress lines replace the per-stage records get_new_data logs
+    os.environ.setdefault("METRICS_EXPORTER", "none")
+    result = backfill(args.uri, args.manifest, min(args.batch_files, 10000), args.batch_bytes, args.concurrency,
+                      args.validate, args.dry_run)
+    if result.failed:
+        print("{} files failed to load, see {}; run the same command again to retry them".format(
+            result.failed, args.manifest))
+        raise SystemExit(1)
@@ -0,0 +1,92 @@
+import threading
+
+
+class _Batch:
+    """Objects collected for one load job into a single table."""
+
+    def __init__(self):
+        self.items = []
+        self.size = 0
+        self.closed = False
+        self.done = threading.Event()
+        self.error = None
+
+
+class LoadBatcher:
+    """
+    LoadBatcher collects objects per destination table and commits them
+    as one load job. A batch is committed once it holds max_files objects or
+    max_bytes bytes, or window_seconds after its first object arrived,
+    whichever comes first.
+
+    submit() blocks until the batch holding the object has been committed and
+    raises if the commit failed. The triggering event is therefore only
+    acknowledged once its object has been loaded, and a failed batch is
+    redelivered by Eventarc (at-least-once).
+    """
+
+    def __init__(self, commit, window_seconds, max_files, max_bytes):
+        """
+        commit: callable(key, items) that loads the objects into the table
+        window_seconds: longest time a batch stays open
+        max_files: number of objects that closes a batch
+        max_bytes: total object size that closes a batch
+        """
+        self._commit_fn = commit
+        self.window_seconds = window_seconds
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._open = {}
+
+    def submit(self, key: str, item, size: int = 0) -> None:
+        """
+        submit() adds an object to the open batch for key and waits for that
+        batch to be committed.
+
+        key: destination table identification
+        item: the GCS object to load, passed through to commit
+        size: size of the object in bytes
+        return: None
+        """
+        with self._lock:
+            batch = self._open.get(key)
+            is_leader = batch is None
+            if is_leader:
+                batch = self._open[key] = _Batch()
+            batch.items.append(item)
+            batch.size += size
+            is_full = len(batch.items) >= self.max_files or batch.size >= self.max_bytes
+            if is_full:
+                self._close(key, batch)
+
+        if is_full:
+            self._commit(key, batch)
+        elif is_leader:
+            # The first event of a batch holds the window open, unless the
+            # batch fills up and is committed by another event first
+            batch.done.wait(self.window_seconds)
+            with self._lock:
+                should_commit = not batch.closed
+                if should_commit:
+                    self._close(key, batch)
+            if should_commit:
+                self._commit(key, batch)
+
+        batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
+
+    def _close(self, key, batch):
+        # Caller must hold self._lock
+        batch.closed = True
+        if self._open.get(key) is batch:
+            del self._open[key]
+
+    def _commit(self, key, batch):
+        try:
+            self._commit_fn(key, batch.items)
+        except Exception as error:
+            batch.error = error
+        finally:
+            batch.done.set()
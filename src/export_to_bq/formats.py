@@ -0,0 +1,200 @@
+import datetime as dt
+import gzip
+import json
+import re
+
+# File extension and content type of the cleaned copy for every INGEST_FORMAT
+FORMAT_FILES = {
+    "json": (".jsonl", "application/x-ndjson"),
+    "parquet": (".parquet", "application/vnd.apache.parquet"),
+    "avro": (".avro", "application/avro"),
+}
+# Rows buffered before a Parquet row group is written
+ROW_GROUP_ROWS = 10000
+# First bytes of every gzip file
+GZIP_MAGIC = b"\x1f\x8b"
+# Fractional seconds and trailing UTC offset of an ISO 8601 date and time
+ISO_FRACTION = re.compile(r"\.(\d+)")
+ISO_OFFSET = re.compile(r"(\d[T ]\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?)([+-]\d{2}):?(\d{2})$")
+
+
+def open_upload(source_file):
+    """
+    open_upload() returns a binary file reading the NDJSON of an upload,
+    decompressing it on the fly if it is gzip-compressed. Compression is
+    recognised by the content rather than the object name.
+
+    source_file: seekable binary file open on the upload
+    return: binary file-like object
+    """
+    magic = source_file.read(len(GZIP_MAGIC))
+    source_file.seek(0)
+    if magic == GZIP_MAGIC:
+        return gzip.GzipFile(fileobj=source_file, mode="rb")
+    return source_file
+
+
+def parse_datetime(value) -> dt.datetime:
+    """
+    parse_datetime() parses an ISO 8601 date and time as BigQuery reads it.
+    Unlike datetime.fromisoformat() on Python 3.10 it accepts any number of
+    fractional digits (digits past microseconds are dropped), a "Z" or
+    " UTC" suffix and UTC offsets without a colon.
+
+    value: date and time string
+    return: datetime, timezone-aware if the value has a time zone
+    """
+    text = str(value).strip()
+    if text.endswith(" UTC"):
+        text = text[:-4] + "+00:00"
+    elif text[-1:] in ("Z", "z"):
+        text = text[:-1] + "+00:00"
+    text = ISO_FRACTION.sub(lambda match: "." + match.group(1)[:6].ljust(6, "0"), text, count=1)
+    text = ISO_OFFSET.sub(r"\1\2:\3", text)
+    return dt.datetime.fromisoformat(text)
+
+
+def to_datetime(value, field_type: str) -> dt.datetime:
+    """
+    to_datetime() parses a coerced TIMESTAMP or DATETIME value, as returned
+    by validation.coerce_value(), into a datetime for a columnar file.
+
+    value: ISO 8601 string, or seconds since the epoch for a TIMESTAMP
+    field_type: "TIMESTAMP" or "DATETIME"
+    return: UTC datetime for a TIMESTAMP, naive datetime for a DATETIME
+    """
+    if isinstance(value, (int, float)):
+        return dt.datetime.fromtimestamp(value, dt.timezone.utc)
+    parsed = parse_datetime(value)
+    if field_type == "DATETIME":
+        return parsed
+    return parsed.replace(tzinfo=dt.timezone.utc) if parsed.tzinfo is None else parsed.astimezone(dt.timezone.utc)
+
+
+def flat_fields(schema: list) -> list:
+    """
+    flat_fields() returns the schema fields, raising ValueError if the table
+    has nested or repeated columns, which are only loaded from JSON.
+
+    schema: list of bigquery.SchemaField
+    return: list of bigquery.SchemaField
+    """
+    for field in schema:
+        if field.mode == "REPEATED" or field.field_type in ("RECORD", "STRUCT"):
+            raise ValueError("Column {} cannot be transcoded; use INGEST_FORMAT=json".format(field.name))
+    return list(schema)
+
+
+class NdjsonRowWriter:
+    """
+    NdjsonRowWriter writes rows as newline-delimited JSON.
+    """
+
+    def __init__(self, file, schema: list):
+        self._file = file
+
+    def write(self, row: dict) -> None:
+        self._file.write((json.dumps(row, separators=(",", ":")) + "\n").encode("utf-8"))
+
+    def close(self) -> None:
+        pass
+
+
+class ParquetRowWriter:
+    """
+    ParquetRowWriter buffers rows by column and writes them as a Parquet row
+    group every ROW_GROUP_ROWS rows, so at most one row group is held in
+    memory.
+    """
+
+    def __init__(self, file, schema: list, batch_rows: int = ROW_GROUP_ROWS):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        arrow_types = {
+            "STRING": pa.string(), "INTEGER": pa.int64(), "INT64": pa.int64(),
+            "FLOAT": pa.float64(), "FLOAT64": pa.float64(), "BOOLEAN": pa.bool_(), "BOOL": pa.bool_(),
+            # Parquet timestamps adjusted to UTC load as TIMESTAMP, others as DATETIME
+            "TIMESTAMP": pa.timestamp("us", tz="UTC"), "DATETIME": pa.timestamp("us"),
+        }
+        self._pa = pa
+        self._fields = flat_fields(schema)
+        self._schema = pa.schema([(field.name, arrow_types.get(field.field_type, pa.string()))
+                                  for field in self._fields])
+        self._writer = pq.ParquetWriter(file, self._schema, compression="snappy")
+        self._batch_rows = batch_rows
+        self._columns = [[] for field in self._fields]
+
+    def write(self, row: dict) -> None:
+        for column, field in zip(self._columns, self._fields):
+            value = row.get(field.name)
+            if value is not None and field.field_type in ("TIMESTAMP", "DATETIME"):
+                value = to_datetime(value, field.field_type)
+            column.append(value)
+        if len(self._columns[0]) >= self._batch_rows:
+            self._flush()
+
+    def _flush(self):
+        arrays = [self._pa.array(column, type=arrow_field.type)
+                  for column, arrow_field in zip(self._columns, self._schema)]
+        self._writer.write_table(self._pa.Table.from_arrays(arrays, schema=self._schema))
+        self._columns = [[] for field in self._fields]
+
+    def close(self) -> None:
+        if self._columns and self._columns[0]:
+            self._flush()
+        self._writer.close()
+
+
+class AvroRowWriter:
+    """
+    AvroRowWriter writes rows as deflate-compressed Avro blocks. TIMESTAMP
+    and DATETIME columns use the timestamp-micros and datetime logical
+    types, so the load job needs use_avro_logical_types.
+    """
+
+    def __init__(self, file, schema: list):
+        from fastavro import parse_schema
+        from fastavro.write import Writer
+
+        avro_types = {
+            "STRING": "string", "INTEGER": "long", "INT64": "long",
+            "FLOAT": "double", "FLOAT64": "double", "BOOLEAN": "boolean", "BOOL": "boolean",
+            "TIMESTAMP": {"type": "long", "logicalType": "timestamp-micros"},
+            "DATETIME": {"type": "string", "logicalType": "datetime"},
+        }
+        self._fields = flat_fields(schema)
+        avro_schema = {
+            "type": "record",
+            "name": "Row",
+            "fields": [{"name": field.name, "type": ["null", avro_types.get(field.field_type, "string")], "default": None}
+                       for field in self._fields],
+        }
+        self._writer = Writer(file, parse_schema(avro_schema), codec="deflate")
+
+    def write(self, row: dict) -> None:
+        record = {}
+        for field in self._fields:
+            value = row.get(field.name)
+            if value is not None and field.field_type == "TIMESTAMP":
+                value = to_datetime(value, field.field_type)
+            record[field.name] = value
+        self._writer.write(record)
+
+    def close(self) -> None:
+        self._writer.flush()
+
+
+def row_writer(output_format: str, file, schema: list):
+    """
+    row_writer() creates the writer for the cleaned copy of an upload.
+
+    output_format: "json", "parquet" or "avro"
+    file: writable binary file
+    schema: list of bigquery.SchemaField of the destination table
+    return: object with write(row) and close() methods
+    """
+    writers = {"json": NdjsonRowWriter, "parquet": ParquetRowWriter, "avro": AvroRowWriter}
+    if output_format not in writers:
+        raise ValueError("Unknown ingest format {}".format(output_format))
+    return writers[output_format](file, schema)
@@ -1,24 +1,27 @@
 
-import unittest
+from cloudevents.http import CloudEvent
 
 import main
 
 
 def test_print(capsys):
     name = 'test'
-    event = {
+    attributes = {
+        'id': 'some-id',
+        'type': 'google.cloud.storage.object.v1.finalized',
+        'source': '//storage.googleapis.com/projects/_/buckets/some-bucket',
+    }
+    data = {
         'bucket': 'some-bucket',
         'name': name,
+        'generation': '1',
         'metageneration': 'some-metageneration',
         'timeCreated': '0',
         'updated': '0'
     }
 
-    context = unittest.mock.MagicMock()
-    context.event_id = 'some-id'
-    context.event_type = 'gcs-event'
-
-    # Call tested function
-    main.get_new_data(event, context)
+    # Call tested function; an object that matches no table is only logged,
+    # so no GCP services are needed
+    main.get_new_data(CloudEvent(attributes, data))
     out, err = capsys.readouterr()
-    assert 'File: {}\n'.format(name) in out
\ No newline at end of file
+    assert 'File: {}\n'.format(name) in out
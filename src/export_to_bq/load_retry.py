@@ -0,0 +1,121 @@
+import hashlib
+import random
+import time
+
+from google.api_core import exceptions
+
+# Load job error reasons worth retrying; every other reason (invalid,
+# notFound, accessDenied, ...) means the file itself will never load
+RETRYABLE_REASONS = {
+    "backendError",
+    "internalError",
+    "jobBackendError",
+    "jobInternalError",
+    "rateLimitExceeded",
+}
+
+# API exceptions raised while starting a job that are worth retrying
+RETRYABLE_EXCEPTIONS = (
+    exceptions.InternalServerError,
+    exceptions.BadGateway,
+    exceptions.ServiceUnavailable,
+    exceptions.GatewayTimeout,
+    exceptions.TooManyRequests,
+    ConnectionError,
+)
+
+
+class LoadFailedError(Exception):
+    """
+    LoadFailedError is raised when a load cannot be completed, either because
+    of a permanent error or because every attempt failed.
+
+    job_id: id of the last load job attempted
+    errors: list of error dictionaries reported by the load job
+    attempts: number of attempts made
+    permanent: True if the error was classified as permanent
+    """
+
+    def __init__(self, job_id, errors, attempts, permanent):
+        super().__init__("Load job {} failed after {} attempt(s): {}".format(job_id, attempts, errors))
+        self.job_id = job_id
+        self.errors = errors
+        self.attempts = attempts
+        self.permanent = permanent
+
+
+def load_job_id(*sources: str) -> str:
+    """
+    load_job_id() derives a deterministic load job id from the sources being
+    loaded, e.g. bucket, name and generation. The same object always maps to
+    the same id, so a redelivered event finds the job started by the first
+    delivery instead of loading the file again.
+
+    sources: strings identifying what is being loaded
+    return: load job id prefix
+    """
+    digest = hashlib.sha256("\n".join(sources).encode("utf-8")).hexdigest()
+    return "ingest_" + digest[:40]
+
+
+def is_retryable(errors: list) -> bool:
+    """
+    is_retryable() classifies the errors of a failed load job.
+
+    errors: list of error dictionaries from load_job.errors
+    return: True if every error has a retryable reason
+    """
+    return bool(errors) and all(error.get("reason") in RETRYABLE_REASONS for error in errors)
+
+
+def backoff_delay(attempt: int, base_delay: float, max_delay: float) -> float:
+    """
+    backoff_delay() returns the capped exponential backoff with full jitter
+    for the given attempt.
+
+    attempt: zero based attempt number that just failed
+    base_delay: delay in seconds before the first retry
+    max_delay: upper bound of any delay in seconds
+    return: number of seconds to sleep
+    """
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def load_with_retry(start_load, base_job_id: str, max_attempts: int = 5,
+                    base_delay: float = 1.0, max_delay: float = 30.0):
+    """
+    load_with_retry() runs a load job until it succeeds, fails permanently or
+    runs out of attempts. Attempt n uses the job id '<base_job_id>_<n>', so
+    retrying after a crash reuses the job that already exists for that
+    attempt rather than starting a second, duplicate load.
+
+    start_load: callable(job_id) that starts or fetches the load job with the
+                given id and waits for it to finish
+    base_job_id: deterministic job id prefix from load_job_id()
+    max_attempts: maximum number of load jobs to run
+    base_delay: backoff delay in seconds before the first retry
+    max_delay: upper bound of any backoff delay in seconds
+    return: the successful LoadJob
+    """
+    errors = []
+    job_id = base_job_id
+    for attempt in range(max_attempts):
+        job_id = "{}_{}".format(base_job_id, attempt)
+        try:
+            load_job = start_load(job_id)
+        except RETRYABLE_EXCEPTIONS as error:
+            errors = [{"reason": type(error).__name__, "message": str(error)}]
+        except exceptions.GoogleAPICallError as error:
+            raise LoadFailedError(job_id, [{"reason": type(error).__name__, "message": str(error)}],
+                                  attempt + 1, True)
+        else:
+            if load_job.error_result is None:
+                return load_job
+            errors = load_job.errors or [load_job.error_result]
+            if not is_retryable(errors):
+                raise LoadFailedError(job_id, errors, attempt + 1, True)
+
+        if attempt + 1 < max_attempts:
+            time.sleep(backoff_delay(attempt, base_delay, max_delay))
+
+    raise LoadFailedError(job_id, errors, max_attempts, False)
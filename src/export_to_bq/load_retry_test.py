@@ -0,0 +1,55 @@
+from google.api_core import exceptions
+
+from load_retry import LoadFailedError, is_retryable, load_job_id, load_with_retry
+
+
+class FakeLoadJob:
+    def __init__(self, errors=None):
+        self.errors = errors
+        self.error_result = errors[0] if errors else None
+
+
+def run(outcomes, max_attempts=3):
+    # Start one fake load per outcome: a list of errors or an exception to raise
+    job_ids = []
+
+    def start_load(job_id):
+        job_ids.append(job_id)
+        outcome = outcomes[len(job_ids) - 1]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return FakeLoadJob(outcome)
+
+    try:
+        return load_with_retry(start_load, 'ingest_x', max_attempts, 0, 0), job_ids
+    except LoadFailedError as error:
+        return error, job_ids
+
+
+def test_is_retryable():
+    assert is_retryable([{'reason': 'backendError'}, {'reason': 'rateLimitExceeded'}])
+    assert not is_retryable([{'reason': 'backendError'}, {'reason': 'invalid'}])
+    assert not is_retryable([])
+
+
+def test_load_job_id_is_deterministic():
+    assert load_job_id('bucket', 'name', '1') == load_job_id('bucket', 'name', '1')
+    assert load_job_id('bucket', 'name', '1') != load_job_id('bucket', 'name', '2')
+
+
+def test_transient_errors_are_retried():
+    job, job_ids = run([[{'reason': 'backendError'}], exceptions.ServiceUnavailable('down'), None])
+    assert isinstance(job, FakeLoadJob)
+    assert job_ids == ['ingest_x_0', 'ingest_x_1', 'ingest_x_2']
+
+
+def test_permanent_errors_are_not_retried():
+    error, job_ids = run([[{'reason': 'invalid', 'message': 'bad row'}]])
+    assert error.permanent and error.attempts == 1 and job_ids == ['ingest_x_0']
+    error, job_ids = run([exceptions.BadRequest('bad request')])
+    assert error.permanent and error.errors[0]['reason'] == 'BadRequest'
+
+
+def test_attempts_run_out():
+    error, job_ids = run([[{'reason': 'internalError'}]] * 3)
+    assert not error.permanent and error.attempts == 3 and error.job_id == 'ingest_x_2'
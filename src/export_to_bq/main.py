@@ -1,27 +1,291 @@
 import functions_framework
 import json
 from google.cloud import storage
-from google.cloud import bigquery
 import DeviceBroadbandData_DML as DML
-import time, random
+import metrics
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from google.api_core.exceptions import GoogleAPICallError, PreconditionFailed
+from batching import LoadBatcher
+from load_retry import LoadFailedError, load_job_id, load_with_retry
+from rollups import RollupRefresher, refresh_query
+from formats import FORMAT_FILES
+from validation import validate_object
+from runner_types import RunnerRegistry
 
-def get_file_data(bucket, name):
-   # Connect to the storage bucket and retrieve the file data
-   storage_client = storage.Client()
-   gcs_bucket = storage_client.bucket(bucket)
-   blob = gcs_bucket.blob(name)
+# "single" loads every object with its own load job, "batch" groups the
+# objects finalized within a short window into one load job per table
+INGEST_MODE = os.getenv("INGEST_MODE", "single")
 
-   # Retrieve the contents of the file
-   file_content = blob.download_as_string().decode("utf-8")
+# A batch is committed after this many seconds, files or bytes, whichever
+# comes first. A load job accepts at most 10,000 source URIs.
+BATCH_WINDOW_SECONDS = float(os.getenv("BATCH_WINDOW_SECONDS", 5))
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", 500))
+BATCH_MAX_BYTES = int(os.getenv("BATCH_MAX_BYTES", 1024 * 1024 * 1024))
 
-   # Parse the contents of the file as a JSON object
-   json_content = json.loads(file_content)
+# Prefix of the objects this function writes to the bucket itself, which
+# must not be loaded when their own finalize events arrive
+INTERNAL_PREFIX = "_ingest/"
 
-   print(json_content)
-   return blob.self_link()
+# Load jobs are attempted at most LOAD_MAX_ATTEMPTS times with capped
+# exponential backoff between attempts
+LOAD_MAX_ATTEMPTS = int(os.getenv("LOAD_MAX_ATTEMPTS", 5))
+LOAD_BASE_DELAY = float(os.getenv("LOAD_BASE_DELAY", 1))
+LOAD_MAX_DELAY = float(os.getenv("LOAD_MAX_DELAY", 30))
+
+# Bucket for records of files that could not be loaded, defaults to the
+# bucket the file was uploaded to
+DEAD_LETTER_BUCKET = os.getenv("DEAD_LETTER_BUCKET")
+
+# "scheduled" leaves the daily rollup of the Multistream table to the
+# scheduled merges (see setup.sh); "load" also refreshes it after every load,
+# which runs a MERGE per load and suits only a single, lightly loaded instance
+ROLLUP_MODE = os.getenv("ROLLUP_MODE", "scheduled")
+
+# Days of the rollup recomputed after a load, today included. Tests older
+# than this that arrive late are picked up by the scheduled merge.
+ROLLUP_REFRESH_DAYS = int(os.getenv("ROLLUP_REFRESH_DAYS", 2))
+
+# "off" loads the upload as it is, so one bad line fails the whole file.
+# "validate" checks every line against the table schema and loads a cleaned
+# copy, quarantining the bad lines; every upload is then read and written
+# again, at least doubling the GCS traffic of a load.
+VALIDATION_MODE = os.getenv("VALIDATION_MODE", "off")
+
+# Format of the copy that is loaded: "json" loads newline-delimited JSON,
+# "parquet" or "avro" transcode the upload while it is validated, which
+# gives smaller objects and faster load jobs. Uploads are always validated
+# when transcoding. Gzip-compressed uploads are accepted in every mode.
+INGEST_FORMAT = os.getenv("INGEST_FORMAT", "json").lower()
+
+# Runner types recognised in uploads, with the table each one is loaded
+# into. Add a runner type (and its table, see DDL.py) to the file to
+# ingest a new Murakami runner.
+RUNNER_TYPES_FILE = os.getenv("RUNNER_TYPES_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "runner_types.json"))
+
+# Bytes read from the start of an upload whose name does not tell its
+# runner type, to recognise it by its content
+SNIFF_BYTES = int(os.getenv("SNIFF_BYTES", 4096))
+
+# Bucket uploads of unknown runner types are copied to, defaults to the
+# bucket the file was uploaded to
+HOLDING_BUCKET = os.getenv("HOLDING_BUCKET")
+
+registry = RunnerRegistry.from_file(RUNNER_TYPES_FILE, SNIFF_BYTES)
+
+# One storage client serves every event an instance handles. It is created
+# on first use, so nothing is fetched at import time.
+_storage_client = None
+_storage_lock = threading.Lock()
+
+def get_storage_client():
+   # Returns the process-wide storage client, creating it on first use
+   global _storage_client
+   with _storage_lock:
+      if _storage_client is None:
+         _storage_client = storage.Client()
+      return _storage_client
+
+def route_table(bucket, name, generation=None):
+   # Pick the destination table from the object name, reading only the
+   # first SNIFF_BYTES of the object when the name is ambiguous
+   # Returns (table, table_id, runner type name), or None for an unknown runner type
+   def read_head(size):
+      blob = get_storage_client().bucket(bucket).blob(name, generation=int(generation) if generation else None)
+      # Read the stored bytes; gzip heads are decompressed by the registry
+      return blob.download_as_bytes(start=0, end=size - 1, raw_download=True)
+
+   runner_type, found_by = registry.classify(name, read_head)
+   if found_by == "content":
+      print(f"Recognised gs://{bucket}/{name} as {runner_type.name} from its content")
+   if runner_type is None:
+      return None
+   table_id = '.'.join([DML.project_id, DML.dataset_id, runner_type.table])
+   return DML.get_table(table_id), table_id, runner_type.name
+
+def hold_unrouted(bucket, name, generation):
+   # Copy an upload of an unknown runner type to the holding area instead of
+   # dropping it. The upload itself is left in place, so it can be
+   # backfilled once its runner type is added to RUNNER_TYPES_FILE.
+   storage_client = get_storage_client()
+   source_bucket = storage_client.bucket(bucket)
+   holding_name = f"{INTERNAL_PREFIX}unrouted/{name}"
+   source_bucket.copy_blob(
+      source_bucket.blob(name), storage_client.bucket(HOLDING_BUCKET or bucket), holding_name,
+      source_generation=int(generation) if generation else None,
+   )
+   print(f"Unknown runner type for gs://{bucket}/{name}, copied to gs://{HOLDING_BUCKET or bucket}/{holding_name}")
+
+def refresh_rollup():
+   # Recompute the most recent days of the rollup from the Multistream table
+   query = refresh_query(DML.multistream_table_id, DML.rollup_table_id, ROLLUP_REFRESH_DAYS)
+   with metrics.span("refresh_rollup", days=ROLLUP_REFRESH_DAYS) as span:
+      job = DML.get_client().query(query)
+      job.result()
+      span.record_job(job)
+      span.set(rows_changed=job.num_dml_affected_rows)
+   print(f"Refreshed rollup {DML.rollup_table_id}: {job.num_dml_affected_rows} rows changed")
+
+rollup_refresher = RollupRefresher(refresh_rollup)
+
+def loaded(table_id):
+   # Bring the rollup up to date with a successful load
+   if ROLLUP_MODE == "load" and table_id == DML.multistream_table_id:
+      rollup_refresher.request()
+
+def write_batch_manifest(bucket, batch_id, table_id, uris, state, job_id=None):
+   # Record which objects a batch includes so every object can be traced to
+   # the load job that committed it
+   blob = get_storage_client().bucket(bucket).blob(f"{INTERNAL_PREFIX}batches/{batch_id}.json")
+   manifest = {"table_id": table_id, "uris": uris, "state": state, "job_id": job_id}
+   blob.upload_from_string(json.dumps(manifest), content_type="application/json")
+
+def write_dead_letter(bucket, name, generation, table_id, error):
+   # Park a file that cannot be loaded so the event can be acknowledged
+   blob = get_storage_client().bucket(DEAD_LETTER_BUCKET or bucket).blob(f"{INTERNAL_PREFIX}dead_letter/{name}.{generation}.json")
+   record = {
+      "uri": f"gs://{bucket}/{name}",
+      "generation": generation,
+      "table_id": table_id,
+      "job_id": error.job_id,
+      "attempts": error.attempts,
+      "permanent": error.permanent,
+      "errors": error.errors,
+   }
+   blob.upload_from_string(json.dumps(record, default=str), content_type="application/json")
+   print(f"Dead-lettered gs://{bucket}/{name}: {error}")
+
+def clean_upload_name(name, generation):
+   # Name of the cleaned copy of an upload that is loaded in its place
+   return f"{INTERNAL_PREFIX}clean/{name}.{generation}{FORMAT_FILES[INGEST_FORMAT][0]}"
+
+def validate_upload(table_id, bucket, name, generation):
+   # Write the good rows of an upload to a cleaned copy and the bad lines,
+   # with the reasons they are bad, to a quarantine object
+   # Returns the name of the cleaned copy, or None if no line was good
+   storage_client = get_storage_client()
+   clean_name = clean_upload_name(name, generation)
+   quarantine_name = f"{INTERNAL_PREFIX}quarantine/{name}.{generation}.jsonl"
+   with metrics.span("validate_upload", uri=f"gs://{bucket}/{name}", format=INGEST_FORMAT) as span:
+      result = validate_object(
+         storage_client.bucket(bucket), name, generation, DML.get_schema(table_id), clean_name,
+         storage_client.bucket(DEAD_LETTER_BUCKET or bucket), quarantine_name, INGEST_FORMAT,
+      )
+      span.set(rows=result.rows, bad_rows=result.bad_rows, dropped_fields=result.dropped_fields)
+   if result.bad_rows:
+      print(f"Quarantined {result.bad_rows} bad lines of gs://{bucket}/{name} in {result.quarantine_name}")
+   if result.rows == 0:
+      storage_client.bucket(bucket).blob(clean_name).delete()
+      return None
+   return clean_name
+
+def load_object(table, table_id, bucket, name, generation):
+   # Load a single object, retrying transient failures with a job id derived
+   # from the object so a retry never loads it twice
+   # Returns True if the object was loaded
+   uri = f"gs://{bucket}/{name}"
+   with metrics.span("load_object", uri=uri, table_id=table_id) as span:
+      def start_load(job_id):
+         span.add("attempts")
+         return DML.insert_json_uri(table, table_id, uri, job_id, INGEST_FORMAT)
+      try:
+         load_job = load_with_retry(
+            start_load, load_job_id(bucket, name, str(generation)),
+            LOAD_MAX_ATTEMPTS, LOAD_BASE_DELAY, LOAD_MAX_DELAY,
+         )
+      except LoadFailedError as error:
+         span.set(dead_lettered=True, permanent=error.permanent)
+         write_dead_letter(bucket, name, generation, table_id, error)
+         return False
+      span.record_job(load_job)
+   return True
+
+def load_succeeded(base_job_id):
+   # Check whether an attempt of a load job loaded its files, waiting for an
+   # attempt that is still running
+   for attempt in range(LOAD_MAX_ATTEMPTS):
+      load_job = DML.get_load_job(f"{base_job_id}_{attempt}")
+      if load_job is None:
+         return False
+      try:
+         load_job.result()
+         return True
+      except GoogleAPICallError:
+         continue
+   return False
+
+def claim_object(storage_client, bucket, name, generation, base_job_id):
+   # Record base_job_id as the load job of an object generation, unless an
+   # earlier job has loaded it. Redelivered events are grouped into other
+   # batches, so the record is kept per object rather than per batch.
+   # Returns True if the object is left to base_job_id to load
+   marker_name = f"{INTERNAL_PREFIX}loads/{load_job_id(bucket, name, str(generation))}.json"
+   marker_bucket = storage_client.bucket(bucket)
+   while True:
+      marker = marker_bucket.get_blob(marker_name)
+      if marker is not None:
+         previous_job_id = json.loads(marker.download_as_bytes())["job_id"]
+         if previous_job_id == base_job_id:
+            return True
+         if load_succeeded(previous_job_id):
+            print(f"gs://{bucket}/{name} was already loaded by {previous_job_id}")
+            return False
+      try:
+         # Fails if another delivery claimed the object meanwhile
+         marker_bucket.blob(marker_name).upload_from_string(
+            json.dumps({"job_id": base_job_id}), content_type="application/json",
+            if_generation_match=marker.generation if marker is not None else 0,
+         )
+         return True
+      except PreconditionFailed:
+         continue
+
+def commit_batch(table_id, items):
+   # Load every (bucket, name, generation) object in the batch with one load job
+   table = DML.get_table(table_id)
+   storage_client = get_storage_client()
+   batch_id = load_job_id(*sorted(f"{bucket}/{name}#{generation}" for bucket, name, generation in items))
+   with ThreadPoolExecutor(max_workers=16) as pool:
+      claimed = list(pool.map(lambda item: claim_object(storage_client, *item, batch_id), items))
+   items = [item for item, is_claimed in zip(items, claimed) if is_claimed]
+   if not items:
+      return
+   uris = [f"gs://{bucket}/{name}" for bucket, name, generation in items]
+   manifest_bucket = items[0][0]
+   write_batch_manifest(manifest_bucket, batch_id, table_id, uris, "pending")
+
+   with metrics.span("commit_batch", batch_id=batch_id, table_id=table_id, files=len(uris)) as span:
+      def start_load(job_id):
+         span.add("attempts")
+         return DML.insert_json_uri(table, table_id, uris, job_id, INGEST_FORMAT)
+      try:
+         load_job = load_with_retry(start_load, batch_id, LOAD_MAX_ATTEMPTS, LOAD_BASE_DELAY, LOAD_MAX_DELAY)
+      except LoadFailedError as error:
+         span.set(permanent=error.permanent)
+         write_batch_manifest(manifest_bucket, batch_id, table_id, uris, "failed", error.job_id)
+         if not error.permanent:
+            raise
+         # One bad file fails the whole load job, so load the files on their
+         # own and dead-letter only the ones that cannot be loaded
+         results = [
+            claim_object(storage_client, bucket, name, generation, load_job_id(bucket, name, str(generation)))
+            and load_object(table, table_id, bucket, name, generation)
+            for bucket, name, generation in items
+         ]
+         if any(results):
+            loaded(table_id)
+         return
+      span.record_job(load_job)
+   write_batch_manifest(manifest_bucket, batch_id, table_id, uris, "committed", load_job.job_id)
+   print(f"Batch {batch_id} loaded {len(uris)} files into {table_id}")
+   loaded(table_id)
+
+batcher = LoadBatcher(commit_batch, BATCH_WINDOW_SECONDS, BATCH_MAX_FILES, BATCH_MAX_BYTES)
 
 # Triggered by a change in a storage bucket
 @functions_framework.cloud_event
+@metrics.traced("get_new_data")
 def get_new_data(cloud_event):
    data = cloud_event.data
 
@@ -35,18 +299,40 @@ def get_new_data(cloud_event):
    print(f"Bucket: {bucket}")
    print(f"File: {name}")
    
+   if name.startswith(INTERNAL_PREFIX):
+      return
+   if not registry.is_upload(name):
+      # Neither named like a runner's upload nor an NDJSON file, e.g. a
+      # placeholder; it is not read, loaded or held
+      print(f"Skipping gs://{bucket}/{name}: not an upload")
+      return
+
    uri = f"gs://{bucket}/{name}"
    print(uri)
 
-   while True:
-      # Try to insert the data
-      try:
-         if "multi-stream" in name:
-            DML.insert_json_uri(DML.multistream_table, DML.multistream_table_id, uri)
-         
-         elif "ndt7" in name:
-            DML.insert_json_uri(DML.ndt7_table, DML.ndt7_table_id, uri)
-         break
-      except:
-         # Sleep for a while then try again
-         time.sleep(random.randint(1, 10))
+   generation = data.get("generation")
+
+   destination = route_table(bucket, name, generation)
+   if destination is None:
+      metrics.current_span().set(event_id=event_id, uri=uri, generation=generation, unrouted=True)
+      hold_unrouted(bucket, name, generation)
+      return
+   table, table_id, runner_type = destination
+
+   metrics.current_span().set(event_id=event_id, uri=uri, generation=generation, size=int(data.get("size", 0)),
+                              table_id=table_id, runner_type=runner_type, ingest_mode=INGEST_MODE)
+
+   if VALIDATION_MODE == "validate" or INGEST_FORMAT != "json":
+      # Load the cleaned copy in place of the upload
+      name = validate_upload(table_id, bucket, name, generation)
+      if name is None:
+         return
+
+   if INGEST_MODE == "batch":
+      # Wait for the batch holding this object to be committed; a failed
+      # batch raises so the event is redelivered
+      batcher.submit(table_id, (bucket, name, generation), int(data.get("size", 0)))
+      return
+
+   if load_object(table, table_id, bucket, name, generation):
+      loaded(table_id)
@@ -0,0 +1,309 @@
+import contextlib
+import datetime as dt
+import functools
+import json
+import os
+import queue
+import threading
+import time
+import urllib.request
+import uuid
+
+# Spans started on a thread nest under the span that thread has open
+_local = threading.local()
+_lock = threading.Lock()
+_exporters = None
+
+
+class LogExporter:
+    """
+    LogExporter prints every record as one JSON line, which Cloud Logging
+    stores as a structured entry.
+    """
+
+    def export(self, record: dict) -> None:
+        print(json.dumps(record, default=str), flush=True)
+
+    def flush(self) -> None:
+        pass
+
+
+class HttpExporter:
+    """
+    HttpExporter POSTs records as JSON arrays to a collector from a
+    background thread. Records are queued so a slow or missing collector
+    never delays the function; flush() waits for the queue to drain at the end of
+    an invocation. Failed requests are printed and dropped.
+    """
+
+    def __init__(self, endpoint: str, timeout: float = 2.0, batch_size: int = 100):
+        """
+        endpoint: URL of the collector, e.g. http://localhost:4318/spans
+        timeout: seconds to wait for each request
+        batch_size: most records sent in one request
+        """
+        self.endpoint = endpoint
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self._queue = queue.Queue()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def export(self, record: dict) -> None:
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="metrics-exporter", daemon=True)
+                self._thread.start()
+        self._queue.put(record)
+
+    def flush(self) -> None:
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get())
+            try:
+                request = urllib.request.Request(self.endpoint, data=json.dumps(batch, default=str).encode("utf-8"),
+                                                 headers={"Content-Type": "application/json"}, method="POST")
+                urllib.request.urlopen(request, timeout=self.timeout).close()
+            except Exception as error:
+                print("Could not send {} metric records to {}: {}".format(len(batch), self.endpoint, error))
+            for record in batch:
+                self._queue.task_done()
+
+
+def exporters_from_env() -> list:
+    """
+    exporters_from_env() builds the exporters named in METRICS_EXPORTER, a
+    comma separated list of "log", "http" or "none". "http" sends to
+    METRICS_ENDPOINT.
+
+    return: list of exporters
+    """
+    exporters = []
+    for name in os.getenv("METRICS_EXPORTER", "log").split(","):
+        name = name.strip().lower()
+        if name == "log":
+            exporters.append(LogExporter())
+        elif name == "http" and os.getenv("METRICS_ENDPOINT"):
+            exporters.append(HttpExporter(os.getenv("METRICS_ENDPOINT")))
+        elif name not in ("", "none"):
+            print("Ignoring unknown or unconfigured metrics exporter {}".format(name))
+    return exporters
+
+
+def set_exporters(exporters: list) -> None:
+    """
+    set_exporters() replaces the exporters, e.g. with a test collector.
+
+    exporters: list of objects with export(record) and flush() methods
+    return: None
+    """
+    global _exporters
+    with _lock:
+        _exporters = list(exporters)
+
+
+def get_exporters() -> list:
+    """
+    get_exporters() returns the exporters, configuring them from the
+    environment on first use.
+
+    return: list of exporters
+    """
+    global _exporters
+    with _lock:
+        if _exporters is None:
+            _exporters = exporters_from_env()
+        return _exporters
+
+
+class Span:
+    """
+    Span times one stage of an invocation. Its attributes hold what the
+    stage processed, e.g. files, rows, bytes, retries and BigQuery job statistics,
+    and are exported with its duration.
+    """
+
+    def __init__(self, name: str, parent=None, attributes: dict = None):
+        """
+        name: stage name
+        parent: optional Span this one nests under
+        attributes: initial attributes
+        """
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = dict(attributes or {})
+        self._lock = threading.Lock()
+
+    def set(self, **attributes) -> None:
+        with self._lock:
+            self.attributes.update(attributes)
+
+    def add(self, key: str, amount=1) -> None:
+        with self._lock:
+            self.attributes[key] = self.attributes.get(key, 0) + amount
+
+    def record_job(self, job) -> None:
+        """
+        record_job() adds the statistics of a finished BigQuery job to the
+        span. Bytes, rows and slot time are summed over every job recorded;
+        cache_hit tells whether a query was answered from BigQuery's cache.
+
+        job: LoadJob, QueryJob or ExtractJob
+        return: None
+        """
+        statistics = (getattr(job, "_properties", None) or {}).get("statistics", {})
+        slot_millis = getattr(job, "slot_millis", None) or statistics.get("totalSlotMs")
+        counters = {
+            "bytes_processed": getattr(job, "total_bytes_processed", None),
+            "bytes_billed": getattr(job, "total_bytes_billed", None),
+            "slot_ms": int(slot_millis) if slot_millis is not None else None,
+            "output_rows": getattr(job, "output_rows", None),
+            "input_file_bytes": getattr(job, "input_file_bytes", None),
+        }
+        with self._lock:
+            self.attributes.setdefault("job_ids", []).append(getattr(job, "job_id", None))
+            if getattr(job, "cache_hit", None) is not None:
+                self.attributes["cache_hit"] = job.cache_hit
+            for key, value in counters.items():
+                if value is not None:
+                    self.attributes[key] = self.attributes.get(key, 0) + value
+
+
+class TimedWriter:
+    """
+    TimedWriter is a binary sink that times and counts what is written to
+    another sink. It adds <key>_ms and <key>_bytes to a span, so the time
+    spent in e.g. a GCS upload can be told apart from the loop feeding it.
+    """
+
+    def __init__(self, sink, span: Span, key: str):
+        """
+        sink: writable binary file-like object
+        span: Span to add to
+        key: attribute name prefix
+        """
+        self._sink = sink
+        self._span = span
+        self._key = key
+        self.closed = False
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        start = time.perf_counter()
+        written = self._sink.write(data)
+        self._span.add(self._key + "_ms", (time.perf_counter() - start) * 1000)
+        self._span.add(self._key + "_bytes", len(data))
+        return written
+
+    def flush(self) -> None:
+        self._sink.flush()
+
+    def close(self) -> None:
+        if not self.closed:
+            start = time.perf_counter()
+            self._sink.close()
+            self._span.add(self._key + "_ms", (time.perf_counter() - start) * 1000)
+            self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def current_span():
+    """
+    current_span() returns the innermost open span of this thread.
+
+    return: Span or None
+    """
+    stack = getattr(_local, "stack", None)
+    return stack[-1] if stack else None
+
+
+def record_job(job) -> None:
+    """
+    record_job() adds a finished BigQuery job's statistics to the current
+    span, if any.
+
+    job: LoadJob, QueryJob or ExtractJob
+    return: None
+    """
+    current = current_span()
+    if current is not None:
+        current.record_job(job)
+
+
+@contextlib.contextmanager
+def span(name: str, parent=None, **attributes):
+    """
+    span() times a stage and exports it as a structured record when it
+    ends. The span nests under the thread's current span unless a parent is
+    given. Exceptions are recorded and re-raised. When the outermost span of
+    an invocation ends the exporters are flushed.
+
+    name: stage name, e.g. "load_object" or "export_query"
+    parent: optional Span to nest under, e.g. from another thread
+    attributes: initial attributes
+    return: the Span, to add attributes to
+    """
+    parent = parent or current_span()
+    current = Span(name, parent, attributes)
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    stack.append(current)
+    started_at = dt.datetime.now(dt.timezone.utc)
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield current
+    except BaseException as error:
+        status = "error"
+        current.set(error=type(error).__name__ + ": " + str(error))
+        raise
+    finally:
+        duration_ms = (time.perf_counter() - start) * 1000
+        stack.remove(current)
+        record = {
+            "severity": "ERROR" if status == "error" else "INFO",
+            "message": "{} took {:.1f} ms".format(name, duration_ms),
+            "span": name,
+            "trace_id": current.trace_id,
+            "span_id": current.span_id,
+            "parent_id": current.parent_id,
+            "start_time": started_at.isoformat(),
+            "duration_ms": round(duration_ms, 3),
+            "status": status,
+        }
+        record.update(current.attributes)
+        for exporter in get_exporters():
+            exporter.export(record)
+        if parent is None:
+            for exporter in get_exporters():
+                exporter.flush()
+
+
+def traced(name: str):
+    """
+    traced() is a decorator running every call of a function in a span.
+
+    name: span name
+    return: decorator
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,150 @@
+import datetime as dt
+import re
+from google.cloud import bigquery
+
+# Columns of the Multistream table exported to the CSV report
+EXPORT_COLUMNS = [
+    "TestStartTime", "ClientIP", "ClientLat", "ClientLon", "DownloadValue",
+    "DownloadUnit", "UploadValue", "UploadUnit", "Ping", "PingUnit",
+    "ServerLatency", "ServerLatencyUnit", "Isp", "IspDownloadAvg", "IspUploadAvg",
+]
+# Columns of the Multistream table read by the report queries
+REPORT_COLUMNS = ["Timestamp"] + EXPORT_COLUMNS
+# Columns of the download/upload query
+DOWN_UPLOAD_COLUMNS = [
+    "TestName", "ClientIP", "TestStartTime", "TestEndTime", "DownloadValue",
+    "DownloadUnit", "UploadValue", "UploadUnit",
+]
+# Report windows and the number of days each one covers
+WINDOW_DAYS = {"daily": 1, "weekly": 7, "monthly": 31, "yearly": 365}
+# Window ends are rounded down to a multiple of this many seconds, so the
+# same report run again within the hour sends an identical query that
+# BigQuery answers from its result cache
+WINDOW_ALIGN_SECONDS = 3600
+# Column each table's windows of tests are selected on, and its type.
+# NDT-7 has no Timestamp column, so its windows use the DATETIME start time.
+TIME_COLUMNS = {
+    "Multistream": ("Timestamp", "TIMESTAMP"),
+    "NDT-7": ("TestStartTime", "DATETIME"),
+}
+# Condition selecting a window of rollup days
+DAY_WINDOW = "WHERE Day > @start_day AND Day <= @end_day\n"
+
+
+def table_reference(*parts: str) -> str:
+    """
+    table_reference() backquotes a table id for use in a query. Table ids
+    cannot be query parameters, so ids with anything but plain project,
+    dataset and table names are refused.
+
+    parts: 'project_id.dataset_id.table_name', or its parts, e.g. the
+           dataset id and the table name
+    return: backquoted table id string
+    """
+    table_id = ".".join(map(str, parts))
+    for name in table_id.split("."):
+        if not re.fullmatch(r"[\w:-]+", name):
+            raise ValueError("Invalid table id {}".format(table_id))
+    return "`" + table_id + "`"
+
+
+def time_window(table_name: str = "Multistream") -> str:
+    """
+    time_window() builds the condition selecting the tests of a table
+    between the @start and @end parameters of window_parameters().
+
+    table_name: key of TIME_COLUMNS
+    return: WHERE clause string
+    """
+    column = TIME_COLUMNS[table_name][0]
+    return "WHERE {0} > @start AND {0} <= @end\n".format(column)
+
+
+def select_query(table_id: str, columns: list, where: str = "", order_by: str = None) -> str:
+    """
+    select_query() builds a query selecting the given columns of a table.
+
+    table_id: 'project_id.dataset_id.table_name'
+    columns: list of column names
+    where: optional WHERE clause, e.g. time_window()
+    order_by: optional column to order the rows by
+    return: query string
+    """
+    for column in columns + ([order_by] if order_by else []):
+        if not re.fullmatch(r"\w+", column):
+            raise ValueError("Invalid column {}".format(column))
+    query = "SELECT\n    " + ",\n    ".join(columns) + "\nFROM\n    " + table_reference(table_id) + "\n" + where
+    if order_by:
+        query += "ORDER BY\n    " + order_by + "\n"
+    return query
+
+
+def aggregate_select(table_id: str, aggregates: list, where: str = "", group_by: str = None) -> str:
+    """
+    aggregate_select() builds a query aggregating the rows of a table, over
+    all of them or per value of one column.
+
+    table_id: 'project_id.dataset_id.table_name'
+    aggregates: list of "<expression> AS <name>" select items
+    where: optional WHERE clause, e.g. time_window()
+    group_by: optional column selected before the aggregates and grouped by
+    return: query string
+    """
+    items = list(aggregates)
+    if group_by is not None:
+        if not re.fullmatch(r"\w+", group_by):
+            raise ValueError("Invalid column {}".format(group_by))
+        items.insert(0, group_by)
+    query = "SELECT\n    " + ",\n    ".join(items) + "\nFROM\n    " + table_reference(table_id) + "\n" + where
+    if group_by is not None:
+        query += "GROUP BY\n    " + group_by + "\n"
+    return query
+
+
+def aligned_window(days: int, now: dt.datetime = None, align_seconds: int = WINDOW_ALIGN_SECONDS) -> tuple:
+    """
+    aligned_window() returns the window of the last days days, ending on the
+    last multiple of align_seconds since the epoch.
+
+    days: number of days in the window
+    now: optional timezone-aware datetime to use instead of the current time
+    align_seconds: interval the end of the window is rounded down to
+    return: tuple of the start and end UTC datetimes
+    """
+    now = now or dt.datetime.now(dt.timezone.utc)
+    end = dt.datetime.fromtimestamp(int(now.timestamp()) // align_seconds * align_seconds, dt.timezone.utc)
+    return end - dt.timedelta(days=days), end
+
+
+def window_parameters(days: int, now: dt.datetime = None, table_name: str = "Multistream") -> list:
+    """
+    window_parameters() builds the @start and @end parameters of
+    time_window(table_name) for the last days days. DATETIME columns hold
+    UTC times without a time zone, so their parameters are naive UTC
+    datetimes.
+
+    days: number of days in the window
+    now: optional timezone-aware datetime to use instead of the current time
+    table_name: key of TIME_COLUMNS
+    return: list of bigquery.ScalarQueryParameter
+    """
+    field_type = TIME_COLUMNS[table_name][1]
+    start, end = aligned_window(days, now)
+    if field_type == "DATETIME":
+        start, end = start.replace(tzinfo=None), end.replace(tzinfo=None)
+    return [bigquery.ScalarQueryParameter("start", field_type, start),
+            bigquery.ScalarQueryParameter("end", field_type, end)]
+
+
+def day_parameters(days: int, now: dt.datetime = None) -> list:
+    """
+    day_parameters() builds the @start_day and @end_day parameters of
+    DAY_WINDOW for the last days calendar days, today (UTC) included.
+
+    days: number of days in the window
+    now: optional timezone-aware datetime to use instead of the current time
+    return: list of bigquery.ScalarQueryParameter
+    """
+    today = (now or dt.datetime.now(dt.timezone.utc)).astimezone(dt.timezone.utc).date()
+    return [bigquery.ScalarQueryParameter("start_day", "DATE", today - dt.timedelta(days=days)),
+            bigquery.ScalarQueryParameter("end_day", "DATE", today)]
@@ -0,0 +1,285 @@
+import base64
+import collections
+import datetime as dt
+import decimal
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from google.cloud import bigquery
+from google.cloud.bigquery.table import Row
+
+# Functions whose result depends on when the query runs; queries using them
+# are also keyed by the current time window
+TIME_FUNCTIONS = re.compile(r"\b(CURRENT_(TIMESTAMP|DATE|DATETIME|TIME)|NOW)\s*\(", re.IGNORECASE)
+# Quoted strings and identifiers, and comments, which normalisation must not touch
+SQL_TOKENS = re.compile(r"('(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|`[^`]*`|--[^\n]*|#[^\n]*|/\*.*?\*/)", re.DOTALL)
+# Key tagging the values of the on-disk tier that JSON has no type for
+TYPE_KEY = "__type__"
+
+
+class QueryCostError(Exception):
+    """
+    QueryCostError is raised when the dry run of a query estimates that it
+    would process more bytes than the cache allows.
+
+    query: the refused query
+    estimated_bytes: bytes the dry run estimated
+    maximum_bytes_billed: the limit
+    """
+
+    def __init__(self, query, estimated_bytes, maximum_bytes_billed):
+        super().__init__("Query would process {:,} bytes, more than the {:,} allowed".format(
+            estimated_bytes, maximum_bytes_billed))
+        self.query = query
+        self.estimated_bytes = estimated_bytes
+        self.maximum_bytes_billed = maximum_bytes_billed
+
+
+def normalise_sql(query: str) -> str:
+    """
+    normalise_sql() collapses whitespace and drops comments and trailing
+    semicolons outside quoted strings and identifiers, so that queries
+    differing only in layout share a cache entry.
+
+    query: BigQuery query string
+    return: normalised query string
+    """
+    parts = []
+    text = ""
+    for i, part in enumerate(SQL_TOKENS.split(query)):
+        if i % 2 == 0:
+            text += part
+        elif part.startswith(("--", "#", "/*")):
+            text += " "
+        else:
+            parts += [re.sub(r"\s+", " ", text), part]
+            text = ""
+    parts.append(re.sub(r"\s+", " ", text))
+    return "".join(parts).strip().rstrip(";").strip()
+
+
+def encode_value(value):
+    """
+    encode_value() is the json.dumps default for the values of BigQuery rows
+    that JSON has no type for; they are tagged so decode_value() restores them.
+
+    value: datetime, date, time, Decimal or bytes
+    return: dictionary holding the tagged value
+    """
+    if isinstance(value, (dt.datetime, dt.date, dt.time)):
+        return {TYPE_KEY: type(value).__name__, "value": value.isoformat()}
+    if isinstance(value, decimal.Decimal):
+        return {TYPE_KEY: "decimal", "value": str(value)}
+    if isinstance(value, bytes):
+        return {TYPE_KEY: "bytes", "value": base64.b64encode(value).decode("ascii")}
+    raise TypeError("Cannot cache a value of type {}".format(type(value).__name__))
+
+
+def decode_value(record: dict):
+    """
+    decode_value() is the json.loads object_hook restoring the values tagged
+    by encode_value().
+
+    record: decoded JSON object
+    return: the restored value, or record if it is not tagged
+    """
+    decoders = {
+        "datetime": dt.datetime.fromisoformat,
+        "date": dt.date.fromisoformat,
+        "time": dt.time.fromisoformat,
+        "decimal": decimal.Decimal,
+        "bytes": base64.b64decode,
+    }
+    if record.keys() == {TYPE_KEY, "value"} and record[TYPE_KEY] in decoders:
+        return decoders[record[TYPE_KEY]](record["value"])
+    return record
+
+
+def is_cacheable(query: str) -> bool:
+    """
+    is_cacheable() returns True for read-only queries; DML, DDL and scripts
+    always run.
+
+    query: normalised query string
+    return: bool
+    """
+    return re.match(r"\(?\s*(SELECT|WITH)\b", query, re.IGNORECASE) is not None and ";" not in query
+
+
+class QueryCache:
+    """
+    QueryCache runs read-only queries through an in-memory LRU cache with a
+    TTL and an optional on-disk JSON tier shared between processes. Results are
+    keyed by the normalised SQL, the query parameters and, for queries using
+    CURRENT_TIMESTAMP() and the like, the time window they ran in. Before a
+    query is run, a dry run estimates the bytes it will process, and queries
+    over maximum_bytes_billed are refused; the limit is also set on the job
+    so BigQuery enforces it.
+    """
+
+    def __init__(self, get_client, max_entries: int = 128, ttl_seconds: float = 300,
+                 window_seconds: float = 300, disk_dir: str = None, maximum_bytes_billed: int = None,
+                 max_rows: int = 100000):
+        """
+        get_client: callable() returning the bigquery.Client to use
+        max_entries: most results kept in memory
+        ttl_seconds: seconds a result is served from the cache
+        window_seconds: length of the time windows keying time-dependent queries
+        disk_dir: optional directory for the on-disk tier
+        maximum_bytes_billed: optional limit on the bytes a query may process
+        max_rows: results with more rows are returned as an iterator and not cached
+        """
+        self._get_client = get_client
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.window_seconds = window_seconds
+        self.disk_dir = disk_dir
+        self.maximum_bytes_billed = maximum_bytes_billed
+        self.max_rows = max_rows
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def key(self, query: str, parameters: list = None) -> str:
+        """
+        key() returns the cache key of a query.
+
+        query: normalised query string
+        parameters: optional list of bigquery query parameters
+        return: hex digest string
+        """
+        parts = [query]
+        parts += [repr(parameter.to_api_repr()) for parameter in parameters or []]
+        if TIME_FUNCTIONS.search(query):
+            parts.append("window={}".format(int(time.time() // self.window_seconds)))
+        return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()
+
+    def estimate_bytes(self, query: str, parameters: list = None) -> int:
+        """
+        estimate_bytes() dry runs a query, which is free, and returns the
+        number of bytes it would process.
+
+        query: BigQuery query string
+        parameters: optional list of bigquery query parameters
+        return: estimated bytes processed
+        """
+        job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False,
+                                             query_parameters=parameters or [])
+        return self._get_client().query(query, job_config=job_config).total_bytes_processed or 0
+
+    def run(self, query: str, parameters: list = None, dry_run: bool = True):
+        """
+        run() runs a query without the cache, refusing it if its dry run
+        estimates more than maximum_bytes_billed.
+
+        query: BigQuery query string
+        parameters: optional list of bigquery query parameters
+        dry_run: estimate the bytes processed first when there is a limit
+        return: QueryJob, not yet waited on
+        """
+        if self.maximum_bytes_billed and dry_run:
+            estimated_bytes = self.estimate_bytes(query, parameters)
+            if estimated_bytes > self.maximum_bytes_billed:
+                raise QueryCostError(query, estimated_bytes, self.maximum_bytes_billed)
+        job_config = bigquery.QueryJobConfig(query_parameters=parameters or [],
+                                             maximum_bytes_billed=self.maximum_bytes_billed)
+        return self._get_client().query(query, job_config=job_config)
+
+    def query(self, query: str, parameters: list = None):
+        """
+        query() returns the rows of a query, from the cache if an unexpired
+        result is in memory or on disk, else by running it. Statements that
+        are not read-only are run every time. Results of more than max_rows
+        rows are not cached, and are returned as the QueryJob.result()
+        iterator so they are never held in memory at once.
+
+        query: BigQuery query string
+        parameters: optional list of bigquery query parameters
+        return: list of bigquery Row, or the QueryJob.result() iterator for
+                results that are not cached
+        """
+        normalised = normalise_sql(query)
+        if not is_cacheable(normalised):
+            return self.run(query, parameters).result()
+
+        key = self.key(normalised, parameters)
+        cached = self._get(key)
+        if cached is not None:
+            return cached
+
+        results = self.run(query, parameters).result()
+        if results.total_rows is None or results.total_rows > self.max_rows:
+            return results
+        rows = list(results)
+        self._put(key, [field.name for field in results.schema], rows)
+        return rows
+
+    def clear(self) -> None:
+        """
+        clear() empties the in-memory tier and the on-disk tier.
+
+        return: None
+        """
+        with self._lock:
+            self._entries.clear()
+        if self.disk_dir:
+            for file_name in os.listdir(self.disk_dir):
+                if file_name.endswith(".json"):
+                    os.remove(os.path.join(self.disk_dir, file_name))
+
+    def _get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self._entries.pop(key, None)
+
+        entry = self._read_disk(key, now)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._remember(key, entry)
+            return entry[1]
+
+    def _put(self, key, field_names, rows):
+        expires = time.time() + self.ttl_seconds
+        with self._lock:
+            self._remember(key, (expires, rows))
+        if self.disk_dir:
+            record = {"expires": expires, "fields": field_names, "rows": [list(row.values()) for row in rows]}
+            path = os.path.join(self.disk_dir, key + ".json")
+            with open(path + ".tmp", "w") as cache_file:
+                json.dump(record, cache_file, default=encode_value)
+            os.replace(path + ".tmp", path)
+
+    def _remember(self, key, entry):
+        # Caller must hold self._lock
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _read_disk(self, key, now):
+        if not self.disk_dir:
+            return None
+        path = os.path.join(self.disk_dir, key + ".json")
+        try:
+            with open(path) as cache_file:
+                record = json.load(cache_file, object_hook=decode_value)
+        except (OSError, ValueError):
+            return None
+        if record["expires"] <= now:
+            return None
+        field_to_index = {name: i for i, name in enumerate(record["fields"])}
+        return record["expires"], [Row(tuple(values), field_to_index) for values in record["rows"]]
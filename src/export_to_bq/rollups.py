@@ -0,0 +1,136 @@
+import argparse
+import threading
+
+# Fields aggregated per day, as in the MultistreamDaily table in DDL.py
+ROLLUP_FIELDS = ["DownloadValue", "UploadValue", "Ping"]
+# Columns the rollup keeps one row per day for
+ROLLUP_DIMENSIONS = ["Isp", "MurakamiDeviceID", "MurakamiLocation"]
+# Fields counting the tests below the 25/3 Mbps standard, in bps
+BELOW_THRESHOLDS = {"DownloadValue": 25000000, "UploadValue": 3000000}
+# Accuracy of the KLL quantile sketches; higher is more accurate and larger
+KLL_PRECISION = 1000
+
+
+def refresh_query(source_table_id: str, rollup_table_id: str, days: int, dates: list = None) -> str:
+    """
+    refresh_query() builds the MERGE statement that recomputes the last
+    `days` days (today included) of the rollup from the raw test rows. Only
+    those day partitions of the source are scanned. Rows are replaced rather
+    than added to, so running the refresh again after a redelivered load,
+    or from both the load path and the scheduled merge, never counts a test
+    twice.
+
+    source_table_id: 'project_id.dataset_id.table_name' of the Multistream table
+    rollup_table_id: 'project_id.dataset_id.table_name' of the rollup table
+    days: number of days to recompute
+    dates: optional list of datetime.date days to recompute instead, e.g.
+           the partitions a backfill loaded into
+    return: query string
+    """
+    if dates:
+        days_sql = ["DATE '{}'".format(day.isoformat()) for day in sorted(set(dates))]
+        source_days = " OR ".join(
+            "(Timestamp >= TIMESTAMP({0}) AND Timestamp < TIMESTAMP(DATE_ADD({0}, INTERVAL 1 DAY)))".format(day)
+            for day in days_sql)
+        target_days = "target.Day IN (" + ", ".join(days_sql) + ")"
+    else:
+        first_day = "DATE_SUB(CURRENT_DATE(), INTERVAL {} DAY)".format(max(int(days), 1) - 1)
+        source_days = "Timestamp >= TIMESTAMP(" + first_day + ")"
+        target_days = "target.Day >= " + first_day
+
+    aggregates = ["COUNT(*) AS TestCount"]
+    for field in ROLLUP_FIELDS:
+        aggregates += [
+            "COUNT({0}) AS {0}_count".format(field),
+            "SUM({0}) AS {0}_sum".format(field),
+            "MIN({0}) AS {0}_min".format(field),
+            "MAX({0}) AS {0}_max".format(field),
+            "KLL_QUANTILES.INIT_FLOAT64({0}, {1}) AS {0}_sketch".format(field, KLL_PRECISION),
+        ]
+        if field in BELOW_THRESHOLDS:
+            aggregates.append("COUNTIF({0} < {1}) AS {0}_below".format(field, BELOW_THRESHOLDS[field]))
+    aggregates.append("CURRENT_TIMESTAMP() AS UpdatedAt")
+
+    columns = ["Day"] + ROLLUP_DIMENSIONS + [aggregate.rsplit(" AS ", 1)[1] for aggregate in aggregates]
+    match = " AND ".join(["target.Day = source.Day"] +
+                         ["target.{0} IS NOT DISTINCT FROM source.{0}".format(column) for column in ROLLUP_DIMENSIONS])
+
+    return "MERGE `" + rollup_table_id + "` AS target USING (" +\
+        "SELECT DATE(Timestamp) AS Day, " + ", ".join(ROLLUP_DIMENSIONS) + ", " + ", ".join(aggregates) +\
+        " FROM `" + source_table_id + "` WHERE " + source_days +\
+        " GROUP BY " + ", ".join(["Day"] + ROLLUP_DIMENSIONS) +\
+        ") AS source ON " + match + " AND " + target_days +\
+        " WHEN MATCHED THEN UPDATE SET " + ", ".join("{0} = source.{0}".format(column) for column in columns[len(ROLLUP_DIMENSIONS) + 1:]) +\
+        " WHEN NOT MATCHED BY TARGET THEN INSERT (" + ", ".join(columns) + ") VALUES (" + ", ".join("source." + column for column in columns) + ")" +\
+        " WHEN NOT MATCHED BY SOURCE AND " + target_days + " THEN DELETE"
+
+
+class RollupRefresher:
+    """
+    RollupRefresher coalesces the refreshes requested by concurrent loads on
+    one instance. At most one MERGE runs at a time; a request made while one
+    is running is served by a single follow-up MERGE started after it, so
+    every load is covered by a refresh that began after the load finished,
+    without one MERGE per load competing for the table.
+    """
+
+    def __init__(self, refresh):
+        """
+        refresh: callable() that runs one refresh of the rollup
+        """
+        self._refresh_fn = refresh
+        self._lock = threading.Lock()
+        self._running = False
+        self._generation = 0
+        self._done = threading.Condition(self._lock)
+        self._completed = 0
+
+    def request(self) -> None:
+        """
+        request() asks for a refresh covering everything loaded so far and
+        waits until one has completed. Refresh errors are printed rather than
+        raised: the tests are already loaded and the next refresh or the
+        scheduled merge brings the rollup up to date.
+
+        return: None
+        """
+        with self._lock:
+            self._generation += 1
+            wanted = self._generation
+            if self._running:
+                while self._completed < wanted:
+                    self._done.wait()
+                return
+            self._running = True
+
+        while True:
+            with self._lock:
+                covered = self._generation
+            try:
+                self._refresh_fn()
+            except Exception as error:
+                print("Rollup refresh failed: {}".format(error))
+            with self._lock:
+                self._completed = covered
+                self._done.notify_all()
+                if self._generation == covered:
+                    self._running = False
+                    return
+
+
+if __name__ == '__main__':
+    import DeviceBroadbandData_DML as DML
+
+    parser = argparse.ArgumentParser(description="Recompute the Multistream daily rollup.")
+    parser.add_argument("--days", type=int, default=31, help="number of days to recompute, today included")
+    parser.add_argument("--print-sql", action="store_true",
+                        help="only print the MERGE statement, e.g. for a BigQuery scheduled query")
+    args = parser.parse_args()
+
+    query = refresh_query(DML.multistream_table_id, DML.rollup_table_id, args.days)
+    if args.print_sql:
+        print(query)
+    else:
+        job = DML.get_client().query(query)
+        job.result()
+        print("Refreshed {} days of {}: {} rows changed".format(args.days, DML.rollup_table_id, job.num_dml_affected_rows))
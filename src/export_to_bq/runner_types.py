@@ -0,0 +1,135 @@
+import json
+import re
+import zlib
+from formats import GZIP_MAGIC
+
+# Bytes read from the start of an upload to recognise its runner type
+SNIFF_BYTES = 4096
+
+# Names of uploads whose content can be sniffed: NDJSON, possibly gzipped.
+# Other objects matching no runner type are never read.
+UPLOAD_NAME = re.compile(r"\.(json|jsonl|ndjson)(\.gz)?$", re.IGNORECASE)
+# Keys and the TestName value found in a (possibly truncated) NDJSON head
+JSON_KEY = re.compile(r'"((?:[^"\\]|\\.)*)"\s*:')
+TEST_NAME = re.compile(r'"TestName"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+
+class RunnerType:
+    """
+    RunnerType describes the uploads of one Murakami runner and the table
+    they are loaded into.
+
+    name: name of the runner type, e.g. "ndt7"
+    table: table name in the dataset, also the key of its schema in schemas.json
+    name_patterns: regular expressions matched against the object name
+    test_names: values of the TestName field written by the runner
+    fields: fields every record of the runner has, used when the TestName
+            is missing or unknown
+    """
+
+    def __init__(self, name: str, table: str, name_patterns: list = (), test_names: list = (), fields: list = ()):
+        self.name = name
+        self.table = table
+        self.name_patterns = [re.compile(pattern) for pattern in name_patterns]
+        self.test_names = set(test_names)
+        self.fields = set(fields)
+
+    def matches_name(self, object_name: str) -> bool:
+        return any(pattern.search(object_name) for pattern in self.name_patterns)
+
+    def matches_test_name(self, test_name: str) -> bool:
+        return test_name is not None and test_name in self.test_names
+
+    def matches_fields(self, keys: set) -> bool:
+        return bool(self.fields) and self.fields <= keys
+
+
+def sniff_head(head: bytes) -> tuple:
+    """
+    sniff_head() finds the TestName and the field names in the first bytes of
+    an upload. Gzip-compressed heads are decompressed as far as they go, and
+    a record cut off at the end of the head still yields its leading fields.
+
+    head: first bytes of the upload
+    return: tuple of the first TestName (None if there is none) and the set
+            of field names
+    """
+    if head[:len(GZIP_MAGIC)] == GZIP_MAGIC:
+        try:
+            head = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(head)
+        except zlib.error:
+            return None, set()
+    text = head.decode("utf-8", "replace")
+    test_name = TEST_NAME.search(text)
+    return test_name.group(1) if test_name else None, set(JSON_KEY.findall(text))
+
+
+class RunnerRegistry:
+    """
+    RunnerRegistry classifies uploads by runner type. The object name is
+    tried first; only when no runner type, or more than one, matches the
+    name are the first SNIFF_BYTES of the object read, so classifying costs
+    the same whatever the size of the upload. Objects matching no runner
+    type are only read if their name is that of an NDJSON upload.
+    """
+
+    def __init__(self, runner_types: list, sniff_bytes: int = SNIFF_BYTES):
+        """
+        runner_types: list of RunnerType, in order of precedence
+        sniff_bytes: bytes read from the start of an upload whose name is ambiguous
+        """
+        self.runner_types = list(runner_types)
+        self.sniff_bytes = sniff_bytes
+
+    @classmethod
+    def from_file(cls, path: str, sniff_bytes: int = SNIFF_BYTES):
+        """
+        from_file() reads the runner types from a JSON file holding a list
+        of objects with the arguments of RunnerType.
+
+        path: path of the runner types file
+        sniff_bytes: bytes read from the start of an upload whose name is ambiguous
+        return: RunnerRegistry
+        """
+        with open(path) as registry_file:
+            entries = json.load(registry_file)
+        return cls([RunnerType(**entry) for entry in entries], sniff_bytes)
+
+    def is_upload(self, object_name: str) -> bool:
+        """
+        is_upload() returns True if an object may be an upload: its name
+        matches a runner type or is that of an NDJSON file.
+
+        object_name: name of the object
+        return: bool
+        """
+        return UPLOAD_NAME.search(object_name) is not None or \
+            any(runner_type.matches_name(object_name) for runner_type in self.runner_types)
+
+    def classify(self, object_name: str, read_head) -> tuple:
+        """
+        classify() returns the runner type of an upload.
+
+        object_name: name of the uploaded object
+        read_head: callable(size) returning the first size bytes of the object,
+                   only called when the name is ambiguous and is_upload()
+        return: tuple of the RunnerType (None if no runner type matches) and
+                how it was found: "name", "content" or "unknown"
+        """
+        candidates = [runner_type for runner_type in self.runner_types if runner_type.matches_name(object_name)]
+        if len(candidates) == 1:
+            return candidates[0], "name"
+        if not candidates and UPLOAD_NAME.search(object_name) is None:
+            return None, "unknown"
+
+        test_name, keys = sniff_head(read_head(self.sniff_bytes))
+        for runner_type in candidates or self.runner_types:
+            if runner_type.matches_test_name(test_name):
+                return runner_type, "content"
+        for runner_type in candidates or self.runner_types:
+            if runner_type.matches_fields(keys):
+                return runner_type, "content"
+        if candidates:
+            # The name matched several runner types; the first one wins
+            return candidates[0], "name"
+        return None, "unknown"
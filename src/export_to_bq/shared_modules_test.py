@@ -0,0 +1,12 @@
+import os
+import subprocess
+import sys
+
+SYNC_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'config', 'sync_shared.py')
+
+
+def test_shared_modules_in_sync():
+    # The copies of query_builder.py and the other shared modules in the
+    # other functions' folders must match the ones in this folder
+    check = subprocess.run([sys.executable, SYNC_SCRIPT, '--check'], capture_output=True, text=True)
+    assert check.returncode == 0, check.stdout
@@ -0,0 +1,214 @@
+import datetime as dt
+import json
+from formats import FORMAT_FILES, open_upload, parse_datetime, row_writer
+
+# Value columns converted to a common unit, with the column holding their unit
+SPEED_FIELDS = {"DownloadValue": "DownloadUnit", "UploadValue": "UploadUnit"}
+LATENCY_FIELDS = {"Ping": "PingUnit", "ServerLatency": "ServerLatencyUnit", "MinRTTValue": "MinRTTUnit"}
+# Factors converting each unit to bit/s and to ms, keyed by lowercase unit
+SPEED_UNITS = {
+    "bit/s": 1, "bps": 1, "b/s": 1,
+    "kbit/s": 1e3, "kbps": 1e3, "kb/s": 1e3,
+    "mbit/s": 1e6, "mbps": 1e6, "mb/s": 1e6,
+    "gbit/s": 1e9, "gbps": 1e9, "gb/s": 1e9,
+}
+LATENCY_UNITS = {"ms": 1, "s": 1e3, "us": 1e-3, "µs": 1e-3, "ns": 1e-6}
+SPEED_UNIT = "bit/s"
+LATENCY_UNIT = "ms"
+# Longest part of a bad line kept in the quarantine object
+MAX_QUARANTINE_LINE = 10000
+
+
+class ValidationResult:
+    """
+    ValidationResult counts the lines of one validated upload.
+
+    rows: number of good rows written to the cleaned object
+    bad_rows: number of lines written to the quarantine object
+    dropped_fields: number of values dropped because the table has no such column
+    clean_name: name of the cleaned object
+    quarantine_name: name of the quarantine object, None if every line was good
+    """
+
+    def __init__(self, clean_name):
+        self.rows = 0
+        self.bad_rows = 0
+        self.dropped_fields = 0
+        self.clean_name = clean_name
+        self.quarantine_name = None
+
+
+def coerce_value(value, field_type: str):
+    """
+    coerce_value() converts a JSON value to what BigQuery accepts for a column
+    of the given type, e.g. "42" or 42.0 for an INTEGER column. TIMESTAMP
+    and DATETIME strings are rewritten in the ISO 8601 form BigQuery reads,
+    with at most six fractional digits; DATETIME values with a time zone are
+    converted to UTC without one.
+
+    value: value decoded from JSON, not None
+    field_type: BigQuery type of the column
+    return: the coerced value, raises ValueError if it cannot be converted
+    """
+    if field_type == "STRING":
+        if isinstance(value, (dict, list)):
+            raise ValueError("expected a string, got {}".format(type(value).__name__))
+        return value if isinstance(value, str) else json.dumps(value)
+    if field_type in ("INTEGER", "INT64"):
+        if isinstance(value, bool):
+            raise ValueError("expected an integer, got a boolean")
+        if isinstance(value, int):
+            return value
+        number = float(value)
+        if not number.is_integer():
+            raise ValueError("expected an integer, got {!r}".format(value))
+        return int(number)
+    if field_type in ("FLOAT", "FLOAT64", "NUMERIC", "BIGNUMERIC"):
+        if isinstance(value, bool):
+            raise ValueError("expected a number, got a boolean")
+        return float(value)
+    if field_type in ("BOOLEAN", "BOOL"):
+        if isinstance(value, bool):
+            return value
+        if str(value).lower() in ("true", "false"):
+            return str(value).lower() == "true"
+        raise ValueError("expected a boolean, got {!r}".format(value))
+    if field_type == "TIMESTAMP":
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            # Seconds since the epoch
+            return value
+        return parse_datetime(value).isoformat()
+    if field_type == "DATETIME":
+        parsed = parse_datetime(value)
+        if parsed.tzinfo is not None:
+            parsed = parsed.astimezone(dt.timezone.utc).replace(tzinfo=None)
+        return parsed.isoformat()
+    return value
+
+
+def normalise_units(row: dict, value_fields: dict, units: dict, unit: str) -> list:
+    """
+    normalise_units() converts value columns to a common unit in place,
+    e.g. DownloadValue in Mbit/s to bit/s. Values without a unit are taken
+    to be in the common unit already.
+
+    row: coerced row
+    value_fields: dictionary mapping value column to its unit column
+    units: dictionary mapping lowercase unit to conversion factor
+    unit: name of the common unit
+    return: list of reasons the row is bad, empty if it is good
+    """
+    reasons = []
+    for value_field, unit_field in value_fields.items():
+        if value_field not in row or unit_field not in row:
+            continue
+        value = row[value_field]
+        if value is None:
+            continue
+        factor = units.get(str(row[unit_field] or unit).strip().lower())
+        if factor is None:
+            reasons.append("{}: unknown unit {!r}".format(unit_field, row[unit_field]))
+            continue
+        row[value_field] = value * factor
+        row[unit_field] = unit
+    return reasons
+
+
+def clean_row(record, schema: list) -> tuple:
+    """
+    clean_row() checks one decoded line against the table schema, coerces
+    its values and normalises speeds to bit/s and latencies to ms.
+
+    record: value decoded from one line of the upload
+    schema: list of bigquery.SchemaField of the destination table
+    return: tuple of the cleaned row, the list of reasons it is bad (empty
+            if it is good) and the number of values dropped because the
+            table has no such column
+    """
+    if not isinstance(record, dict):
+        return None, ["expected a JSON object, got {}".format(type(record).__name__)], 0
+
+    row = {}
+    reasons = []
+    for field in schema:
+        value = record.get(field.name)
+        if value is None:
+            if field.mode == "REQUIRED":
+                reasons.append("{}: missing required value".format(field.name))
+            elif field.name in record:
+                row[field.name] = None
+            continue
+        if field.mode == "REPEATED" or field.field_type in ("RECORD", "STRUCT"):
+            # Nested values are left for the load job to check
+            row[field.name] = value
+            continue
+        try:
+            row[field.name] = coerce_value(value, field.field_type)
+        except (TypeError, ValueError) as error:
+            reasons.append("{}: {}".format(field.name, error))
+
+    if not reasons:
+        reasons += normalise_units(row, SPEED_FIELDS, SPEED_UNITS, SPEED_UNIT)
+        reasons += normalise_units(row, LATENCY_FIELDS, LATENCY_UNITS, LATENCY_UNIT)
+    dropped = len(record.keys() - {field.name for field in schema})
+    return row, reasons, dropped
+
+
+def validate_object(bucket, name: str, generation, schema: list, clean_name: str,
+                    quarantine_bucket, quarantine_name: str, output_format: str = "json") -> ValidationResult:
+    """
+    validate_object() streams an uploaded NDJSON object line by line, writing
+    the good rows to a cleaned object for loading and the bad lines, with
+    the reasons they are bad, to a quarantine object. Only one line (or one
+    Parquet row group) is held in memory at a time. Gzip-compressed uploads
+    are decompressed as they are read. The quarantine object is only
+    created if a line is bad.
+
+    bucket: bucket holding the upload, where the cleaned object is written
+    name: name of the uploaded object
+    generation: generation of the upload, so a newer upload is never read
+    schema: list of bigquery.SchemaField of the destination table; columns
+            with a default value, such as IngestedAt, are left to BigQuery
+    clean_name: name of the cleaned object
+    quarantine_bucket: bucket the quarantine object is written to
+    quarantine_name: name of the quarantine object
+    output_format: format of the cleaned object, "json", "parquet" or "avro"
+    return: ValidationResult
+    """
+    result = ValidationResult(clean_name)
+    uri = "gs://{}/{}".format(bucket.name, name)
+    schema = [field for field in schema if not field.default_value_expression]
+    source = bucket.blob(name, generation=int(generation) if generation else None)
+    quarantine_file = None
+    with source.open("rb") as source_file, \
+            bucket.blob(clean_name).open("wb", content_type=FORMAT_FILES[output_format][1]) as clean_file:
+        writer = row_writer(output_format, clean_file, schema)
+        try:
+            for line_number, line in enumerate(open_upload(source_file), 1):
+                text = line.decode("utf-8", "replace").strip()
+                if not text:
+                    continue
+                try:
+                    row, reasons, dropped = clean_row(json.loads(text), schema)
+                except ValueError as error:
+                    row, reasons, dropped = None, ["invalid JSON: {}".format(error)], 0
+
+                if not reasons:
+                    writer.write(row)
+                    result.rows += 1
+                    result.dropped_fields += dropped
+                    continue
+
+                if quarantine_file is None:
+                    quarantine_file = quarantine_bucket.blob(quarantine_name).open(
+                        "wb", content_type="application/x-ndjson")
+                    result.quarantine_name = quarantine_name
+                record = {"source": uri, "generation": generation, "line": line_number, "reasons": reasons,
+                          "raw": text[:MAX_QUARANTINE_LINE]}
+                quarantine_file.write((json.dumps(record) + "\n").encode("utf-8"))
+                result.bad_rows += 1
+            writer.close()
+        finally:
+            if quarantine_file is not None:
+                quarantine_file.close()
+    return result
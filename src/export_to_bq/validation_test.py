@@ -0,0 +1,66 @@
+import datetime as dt
+
+import pytest
+from google.cloud import bigquery
+
+from validation import clean_row, coerce_value
+
+
+def test_coerce_numbers():
+    assert coerce_value('42', 'INTEGER') == 42
+    assert coerce_value(42.0, 'INT64') == 42
+    assert coerce_value('1.5', 'FLOAT') == 1.5
+    with pytest.raises(ValueError):
+        coerce_value(1.5, 'INTEGER')
+    with pytest.raises(ValueError):
+        coerce_value(True, 'INTEGER')
+    with pytest.raises(ValueError):
+        coerce_value('fast', 'FLOAT')
+
+
+def test_coerce_strings_and_booleans():
+    assert coerce_value(7, 'STRING') == '7'
+    assert coerce_value('TRUE', 'BOOLEAN') is True
+    assert coerce_value('false', 'BOOL') is False
+    with pytest.raises(ValueError):
+        coerce_value({'a': 1}, 'STRING')
+    with pytest.raises(ValueError):
+        coerce_value('yes', 'BOOLEAN')
+
+
+def test_coerce_times():
+    assert coerce_value('2023-04-05T06:07:08.123456789Z', 'TIMESTAMP') == '2023-04-05T06:07:08.123456+00:00'
+    assert coerce_value('2023-04-05 06:07:08 UTC', 'TIMESTAMP') == '2023-04-05T06:07:08+00:00'
+    assert coerce_value(1680674828, 'TIMESTAMP') == 1680674828
+    # DATETIME columns hold UTC without a time zone
+    assert coerce_value('2023-04-05T08:07:08.5+0200', 'DATETIME') == '2023-04-05T06:07:08.500000'
+    assert coerce_value('2023-04-05T06:07:08', 'DATETIME') == dt.datetime(2023, 4, 5, 6, 7, 8).isoformat()
+    with pytest.raises(ValueError):
+        coerce_value('yesterday', 'TIMESTAMP')
+
+
+SCHEMA = [
+    bigquery.SchemaField('TestName', 'STRING', mode='REQUIRED'),
+    bigquery.SchemaField('DownloadValue', 'FLOAT'),
+    bigquery.SchemaField('DownloadUnit', 'STRING'),
+    bigquery.SchemaField('Ping', 'FLOAT'),
+    bigquery.SchemaField('PingUnit', 'STRING'),
+]
+
+
+def test_clean_row_normalises_units():
+    row, reasons, dropped = clean_row({'TestName': 'ndt7', 'DownloadValue': '12.5', 'DownloadUnit': 'Mbit/s',
+                                      'Ping': 0.02, 'PingUnit': 's', 'Extra': 1}, SCHEMA)
+    assert reasons == []
+    assert dropped == 1
+    assert row == {'TestName': 'ndt7', 'DownloadValue': 12.5e6, 'DownloadUnit': 'bit/s',
+                   'Ping': 20.0, 'PingUnit': 'ms'}
+
+
+def test_clean_row_reports_bad_values():
+    row, reasons, dropped = clean_row({'DownloadValue': 'fast', 'DownloadUnit': 'Mbit/s'}, SCHEMA)
+    assert reasons[0] == 'TestName: missing required value'
+    assert reasons[1].startswith('DownloadValue: ')
+    row, reasons, dropped = clean_row({'TestName': 'ndt7', 'DownloadValue': 1, 'DownloadUnit': 'furlongs'}, SCHEMA)
+    assert reasons == ["DownloadUnit: unknown unit 'furlongs'"]
+    assert clean_row([1, 2], SCHEMA)[1] == ['expected a JSON object, got list']